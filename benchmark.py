@@ -0,0 +1,251 @@
+import os
+import io
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import contextlib
+from datetime import datetime
+import numpy as np
+
+# Every repeat tokenizes and scores from scratch, so the token ID and result caches are disabled
+os.environ["TOKEN_CACHE_SIZE"] = "0"
+os.environ["RESULT_CACHE"] = "off"
+os.environ["PREFILTER"] = "off"
+os.environ["CASCADE"] = "off"
+
+import koala
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_lambda_deployment"))
+from koala_lambda import TextModerationLambda
+
+# Message length buckets, in characters: (name, shortest, longest)
+LENGTH_BUCKETS = [
+    ("short", 0, 80),
+    ("medium", 81, 300),
+    ("long", 301, 1500),
+    ("very_long", 1501, None)
+]
+
+def load_buckets(file_path, per_bucket, seed):
+    """
+    Split the labelled rows of a test cases CSV into length buckets and draw a fixed subset of
+    up to per_bucket rows from each. The same file and seed always give the same subsets.
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        rows = [
+            (row["message"].strip(), row["result"])
+            for row in csv.DictReader(file, delimiter=';')
+            if row.get("message") and row["message"].strip() and row.get("result") in koala.RESULT_MAPPING
+        ]
+    
+    buckets = {}
+    for name, shortest, longest in LENGTH_BUCKETS:
+        bucket = [row for row in rows if len(row[0]) >= shortest and (longest is None or len(row[0]) <= longest)]
+        chosen = sorted(random.Random(seed).sample(range(len(bucket)), min(per_bucket, len(bucket))))
+        buckets[name] = [bucket[i] for i in chosen]
+    return buckets
+
+def build_tiny_model(directory, messages, seed=0):
+    """
+    Save a tiny randomly-initialized BERT classifier with the 9 category outputs, and a WordPiece
+    tokenizer trained on messages, in the model/ and tokenizer/ layout of the Lambda models directory.
+    Nothing is downloaded, so the benchmark runs offline.
+    """
+    import torch
+    from tokenizers import BertWordPieceTokenizer
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+    
+    tokenizer_path = os.path.join(directory, "tokenizer")
+    os.makedirs(tokenizer_path, exist_ok=True)
+    wordpiece = BertWordPieceTokenizer(lowercase=True)
+    wordpiece.train_from_iterator(messages, vocab_size=2000)
+    wordpiece.save_model(tokenizer_path)
+    BertTokenizerFast(os.path.join(tokenizer_path, "vocab.txt")).save_pretrained(tokenizer_path)
+    
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=wordpiece.get_vocab_size(),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=512,
+        num_labels=len(koala.CATEGORIES),
+        problem_type="multi_label_classification"
+    )
+    BertForSequenceClassification(config).save_pretrained(os.path.join(directory, "model"))
+    return os.path.join(directory, "model"), tokenizer_path
+
+def summarize(timings, messages=None):
+    """
+    Percentile statistics of a list of timings in seconds, reported in milliseconds
+    """
+    timings_ms = np.array(timings) * 1000
+    stats = {
+        'samples': len(timings_ms),
+        'mean_ms': float(timings_ms.mean()),
+        'p50_ms': float(np.percentile(timings_ms, 50)),
+        'p90_ms': float(np.percentile(timings_ms, 90)),
+        'p99_ms': float(np.percentile(timings_ms, 99)),
+        'min_ms': float(timings_ms.min()),
+        'max_ms': float(timings_ms.max())
+    }
+    if messages:
+        stats['messages_per_second'] = float(messages / (timings_ms.sum() / 1000))
+    return stats
+
+def measure(run, items, warmup, repeat):
+    """
+    Call run on every item warmup times without timing it, then repeat times timing each call.
+    Output printed by run is discarded.
+    """
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for iteration in range(warmup + repeat):
+            for item in items:
+                start_time = time.perf_counter()
+                run(item)
+                if iteration >= warmup:
+                    timings.append(time.perf_counter() - start_time)
+    return timings
+
+def write_subset(rows, path):
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(["message", "result"])
+        writer.writerows(rows)
+
+def run_benchmark(args, model_dir, work_dir):
+    """
+    Time model load, tokenization, single-message predict, batched predict and evaluate_test_cases
+    on every length bucket, and return the results as a JSON-serializable report
+    """
+    buckets = load_buckets(args.file, args.per_bucket, args.seed)
+    os.environ["MODEL_DIR"] = model_dir
+    koala.model_path = os.path.join(model_dir, "model")
+    koala.tokenizer_path = os.path.join(model_dir, "tokenizer")
+    results = []
+    
+    def record(stage, bucket, timings, messages=None):
+        results.append({'stage': stage, 'bucket': bucket, **summarize(timings, messages)})
+        print(f"{stage:<14} {bucket:<10} p50 {results[-1]['p50_ms']:>9.2f} ms  p99 {results[-1]['p99_ms']:>9.2f} ms")
+    
+    # The last instance built is the one benchmarked
+    models = []
+    record("model_load", "all", measure(lambda _: models.append(TextModerationLambda(args.backend)), [None], args.warmup, args.repeat))
+    model = models[-1]
+    
+    # evaluate_test_cases scores with koala.py's own model, loaded once outside the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        koala.get_model()
+    
+    for name, rows in buckets.items():
+        if not rows:
+            continue
+        messages = [message for message, _ in rows]
+        batches = [messages[start:start + args.batch_size] for start in range(0, len(messages), args.batch_size)]
+        subset_path = os.path.join(work_dir, f"{name}.csv")
+        write_subset(rows, subset_path)
+        
+        record("tokenize", name, measure(lambda message: model.tokens([message]), messages, args.warmup, args.repeat))
+        record("predict", name, measure(model.predict, messages, args.warmup, args.repeat))
+        record("predict_batch", name, measure(model.predict_batch, batches, args.warmup, args.repeat), len(messages) * args.repeat)
+        record(
+            "evaluate", name,
+            measure(lambda path: koala.evaluate_test_cases(path, batch_size=args.batch_size), [subset_path], args.warmup, args.repeat),
+            len(messages) * args.repeat
+        )
+    
+    import torch
+    import transformers
+    
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'transformers': transformers.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads()
+        },
+        'model': {
+            'version': model.model_version,
+            'tiny': args.tiny_model,
+            'window_mode': model.window_mode
+        },
+        'config': {
+            'file': os.path.basename(args.file),
+            'warmup': args.warmup,
+            'repeat': args.repeat,
+            'per_bucket': args.per_bucket,
+            'batch_size': args.batch_size,
+            'seed': args.seed
+        },
+        'buckets': {
+            name: {
+                'messages': len(rows),
+                'min_chars': min((len(message) for message, _ in rows), default=0),
+                'max_chars': max((len(message) for message, _ in rows), default=0)
+            }
+            for name, rows in buckets.items()
+        },
+        'results': results
+    }
+
+def compare_reports(baseline, report):
+    """
+    Print the p50 and p99 change of every stage and bucket against a baseline report
+    """
+    previous = {(row['stage'], row['bucket']): row for row in baseline['results']}
+    print(f"\nAgainst {baseline['model']['version']} ({baseline['created']}):")
+    print(f"|{'Stage':<14}|{'Bucket':<10}|{'p50 ms':>9}|{'Base p50':>9}|{'Change':>8}|{'p99 ms':>9}|{'Base p99':>9}|{'Change':>8}|")
+    for row in report['results']:
+        base = previous.get((row['stage'], row['bucket']))
+        if base is None:
+            continue
+        print(
+            f"|{row['stage']:<14}|{row['bucket']:<10}|{row['p50_ms']:>9.2f}|{base['p50_ms']:>9.2f}|{(row['p50_ms'] / base['p50_ms'] - 1) * 100:>+7.1f}%"
+            f"|{row['p99_ms']:>9.2f}|{base['p99_ms']:>9.2f}|{(row['p99_ms'] / base['p99_ms'] - 1) * 100:>+7.1f}%|"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark model load, tokenization, prediction and evaluation by message length")
+    parser.add_argument("--file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_cases.csv"))
+    parser.add_argument("--backend", default=os.environ.get("INFERENCE_BACKEND", "torch"), help="torch, onnx or onnx-int8")
+    parser.add_argument("--model-dir", default=None, help="Lambda models directory, defaults to python_lambda_deployment/models")
+    parser.add_argument("--tiny-model", action="store_true", help="Benchmark a tiny randomly-initialized model, offline")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--per-bucket", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON report path, defaults to benchmarks/benchmark_<backend>_<time>.json")
+    parser.add_argument("--compare", default=None, help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+    
+    if args.tiny_model and args.backend != "torch":
+        parser.error("--tiny-model only has torch weights")
+    
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_dir = args.model_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_lambda_deployment", "models")
+        if args.tiny_model:
+            with open(args.file, 'r', encoding='utf-8') as file:
+                corpus = [row["message"] for row in csv.DictReader(file, delimiter=';') if row.get("message")]
+            model_dir = os.path.join(work_dir, "models")
+            build_tiny_model(model_dir, corpus, args.seed)
+        report = run_benchmark(args, model_dir, work_dir)
+    
+    output = args.output or os.path.join("benchmarks", f"benchmark_{args.backend}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved benchmark report to {output}")
+    
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare_reports(json.load(file), report)
@@ -0,0 +1,176 @@
+import os
+import re
+import csv
+import glob
+import zlib
+import argparse
+import unicodedata
+from collections import Counter, defaultdict
+import numpy as np
+
+# Character shingles compared between normalized messages
+SHINGLE_SIZE = 5
+
+# MinHash permutations, split into LSH bands of LSH_ROWS rows. Two messages with shingle Jaccard
+# similarity s share at least one band with probability 1 - (1 - s ** 8) ** 16: 0.98 at s = 0.8, 0.2 at s = 0.5
+NUM_PERMUTATIONS = 128
+LSH_ROWS = 8
+
+# Jaccard similarity from which two messages count as near-duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+# Modulus of the MinHash permutations; a * x + b stays below 2 ** 63 for 31-bit a, b and x
+PRIME = (1 << 31) - 1
+
+# Whether a labelled message should be blocked, see RESULT_MAPPING in koala.py; other labels are unreviewed
+SHOULD_BLOCK = {'TP': True, 'FN': True, 'TN': False, 'FP': False}
+
+def normalize_text(text):
+    """
+    Normalize a message for duplicate detection: Unicode compatibility forms, case, punctuation and whitespace
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+def shingles(text):
+    """
+    Hashes of the character shingles of a normalized message
+    """
+    if len(text) <= SHINGLE_SIZE:
+        return frozenset([zlib.crc32(text.encode('utf-8')) % PRIME])
+    return frozenset(zlib.crc32(text[i:i + SHINGLE_SIZE].encode('utf-8')) % PRIME for i in range(len(text) - SHINGLE_SIZE + 1))
+
+def jaccard(first, second):
+    return len(first & second) / len(first | second)
+
+class MinHashIndex:
+    """
+    MinHash signatures of message shingles, bucketed by LSH band.
+    Only messages sharing a band bucket are compared, so indexing and lookups take roughly linear time;
+    candidates are confirmed on their exact shingle Jaccard similarity.
+    """
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD, num_permutations=NUM_PERMUTATIONS, rows=LSH_ROWS, seed=1):
+        random_state = np.random.RandomState(seed)
+        self.a = random_state.randint(1, PRIME, size=num_permutations).astype(np.uint64)
+        self.b = random_state.randint(0, PRIME, size=num_permutations).astype(np.uint64)
+        self.threshold = threshold
+        self.rows = rows
+        self.bands = [defaultdict(list) for _ in range(num_permutations // rows)]
+        self.shingles = []
+    
+    def signature(self, text_shingles):
+        hashes = np.fromiter(text_shingles, dtype=np.uint64, count=len(text_shingles))
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % PRIME).min(axis=1)
+    
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(len(self.bands))]
+    
+    def add(self, text):
+        """
+        Index a message and return its id, the number of messages indexed before it
+        """
+        text_shingles = shingles(normalize_text(text))
+        key = len(self.shingles)
+        self.shingles.append(text_shingles)
+        for bucket, band_key in zip(self.bands, self.band_keys(self.signature(text_shingles))):
+            bucket[band_key].append(key)
+        return key
+    
+    def find(self, text, per_bucket=None):
+        """
+        Return the ids of the indexed messages that are near-duplicates of text.
+        per_bucket limits the candidates compared per band bucket, e.g. 1 to compare only its first message.
+        """
+        text_shingles = shingles(normalize_text(text))
+        candidates = set()
+        for bucket, band_key in zip(self.bands, self.band_keys(self.signature(text_shingles))):
+            candidates.update(bucket.get(band_key, [])[:per_bucket])
+        return [key for key in candidates if jaccard(text_shingles, self.shingles[key]) >= self.threshold]
+
+def near_duplicate_groups(messages, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """
+    Assign a group id to every message so that exact and near-duplicate messages share a group.
+    Exact duplicates after normalization are merged first; every distinct message is then compared
+    with the first message of each band bucket it falls into, and matches are merged with union-find.
+    """
+    distinct = {}
+    message_ids = [distinct.setdefault(normalize_text(message), len(distinct)) for message in messages]
+    
+    parents = list(range(len(distinct)))
+    
+    def root(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+    
+    index = MinHashIndex(threshold)
+    for text in distinct:
+        for match in index.find(text, per_bucket=1):
+            parents[root(match)] = root(len(index.shingles))
+        index.add(text)
+    
+    roots = [root(node) for node in range(len(distinct))]
+    return [roots[message_id] for message_id in message_ids]
+
+def load_rows(file_path):
+    """
+    Load the (message, result) rows of a ;-delimited CSV with a non-empty message
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [(row["message"].strip(), row.get("result")) for row in csv.DictReader(file, delimiter=';') if row.get("message") and row["message"].strip()]
+
+def report_duplicates(file_paths, threshold=NEAR_DUPLICATE_THRESHOLD, output=None):
+    """
+    Print the exact and near-duplicate rows within and across CSV files, and the near-duplicate groups
+    whose rows disagree on whether the message should be blocked
+    """
+    names = [os.path.basename(file_path) for file_path in file_paths]
+    rows = [(name, row, message, result) for name, file_path in zip(names, file_paths) for row, (message, result) in enumerate(load_rows(file_path))]
+    groups = near_duplicate_groups([message for _, _, message, _ in rows], threshold)
+    
+    files_of_group = defaultdict(set)
+    labels_of_group = defaultdict(set)
+    for (name, _, _, result), group in zip(rows, groups):
+        files_of_group[group].add(name)
+        if result in SHOULD_BLOCK:
+            labels_of_group[group].add(SHOULD_BLOCK[result])
+    
+    print(f"{len(rows)} rows in {len(names)} files, {len(set(groups))} near-duplicate groups (Jaccard >= {threshold}):")
+    print(f"|{'File':<24}|{'Rows':>6}|{'Exact dups':>11}|{'Near dups':>10}|{'In other files':>15}|")
+    for name in names:
+        file_rows = [(message, group) for (row_name, _, message, _), group in zip(rows, groups) if row_name == name]
+        exact = len(file_rows) - len({normalize_text(message) for message, _ in file_rows})
+        near = len(file_rows) - len({group for _, group in file_rows}) - exact
+        shared = sum(1 for _, group in file_rows if len(files_of_group[group]) > 1)
+        print(f"|{name[:24]:<24}|{len(file_rows):>6}|{exact:>11}|{near:>10}|{shared:>15}|")
+    
+    print("\nRows of each file with a near-duplicate in file #n:")
+    print(f"|{'File':<28}|" + "|".join(f"{f'#{n}':>6}" for n in range(1, len(names) + 1)) + "|")
+    for n, name in enumerate(names, 1):
+        file_groups = [group for (row_name, _, _, _), group in zip(rows, groups) if row_name == name]
+        print(f"|{f'#{n} {name}'[:28]:<28}|" + "|".join(
+            f"{'-' if other == name else sum(1 for group in file_groups if other in files_of_group[group]):>6}" for other in names
+        ) + "|")
+    
+    conflicts = [group for group, labels in labels_of_group.items() if len(labels) > 1]
+    sizes = Counter(groups)
+    print(f"\nScoring one row per group would skip {len(rows) - len(sizes)} of {len(rows)} rows.")
+    print(f"{len(conflicts)} groups have rows labelled both to block (TP/FN) and to pass (TN/FP).")
+    
+    if output:
+        with open(output, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file, delimiter=';')
+            writer.writerow(["file", "row", "group", "group_size", "message", "result"])
+            for (name, row, message, result), group in zip(rows, groups):
+                writer.writerow([name, row, group, sizes[group], message, result])
+        print(f"Saved near-duplicate groups to {output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find exact and near-duplicate messages within and across the test and training CSVs")
+    parser.add_argument("files", nargs="*", default=sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.csv"))))
+    parser.add_argument("--threshold", type=float, default=NEAR_DUPLICATE_THRESHOLD, help="Shingle Jaccard similarity of near-duplicates")
+    parser.add_argument("--output", help="CSV to write the group of every row to")
+    args = parser.parse_args()
+    
+    report_duplicates(args.files, args.threshold, args.output)
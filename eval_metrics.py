@@ -0,0 +1,126 @@
+import json
+import numpy as np
+
+# Thresholds (in percent) shown in the evaluation report
+REPORT_THRESHOLDS = [10, 20, 30, 40, 50, 60, 70, 80, 85, 90, 95, 99]
+
+# File holding the decision threshold shared by koala.py and the Lambda deployment
+THRESHOLD_FILE = "threshold.json"
+
+def scores_and_labels(results, category='sexual/minors'):
+    """
+    Collect the category probabilities (in percent) and block labels of evaluation results as NumPy arrays.
+    A label of 1 means the message should be blocked (expected result 0).
+    """
+    scores = np.fromiter((r['categories'][category] for r in results), dtype=np.float64, count=len(results))
+    labels = np.fromiter((r['expected'] == 0 for r in results), dtype=np.int64, count=len(results))
+    return scores, labels
+
+def dense_grid(step=0.5):
+    """
+    Return a dense threshold grid (in percent) from 0 to 100
+    """
+    return np.round(np.arange(0, 100 + step, step), 6)
+
+def threshold_sweep(scores, labels, thresholds=REPORT_THRESHOLDS, inclusive=False):
+    """
+    Compute the confusion matrix and metrics for every threshold in one sort-and-cumsum pass.
+    A message is predicted as blocked when its score is > threshold, or >= threshold if inclusive.
+    Returns a dict of arrays aligned with thresholds.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    
+    order = np.argsort(scores, kind='stable')
+    sorted_scores = scores[order]
+    # positives_below[k] = number of positive labels among the k lowest scores
+    positives_below = np.concatenate(([0], np.cumsum(labels[order])))
+    
+    total = len(scores)
+    total_positives = int(positives_below[-1])
+    
+    # Number of scores that fall below the cut for each threshold
+    below = np.searchsorted(sorted_scores, thresholds, side='left' if inclusive else 'right')
+    fn = positives_below[below]
+    tp = total_positives - fn
+    fp = (total - below) - tp
+    tn = below - fn
+    
+    return metrics_from_counts(thresholds, tp, fp, tn, fn)
+
+def metrics_from_counts(thresholds, tp, fp, tn, fn):
+    """
+    Derive precision, recall, F1 and accuracy from per-threshold confusion counts.
+    """
+    predicted_positive = tp + fp
+    positives = tp + fn
+    total = tp + fp + tn + fn
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted_positive > 0, tp / np.maximum(predicted_positive, 1), 0.0)
+        recall = np.where(positives > 0, tp / np.maximum(positives, 1), 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+        accuracy = np.where(total > 0, (tp + tn) / np.maximum(total, 1), 0.0)
+    
+    return {
+        'thresholds': thresholds,
+        'predicted_positive': predicted_positive,
+        'tp': tp,
+        'fp': fp,
+        'tn': tn,
+        'fn': fn,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'accuracy': accuracy
+    }
+
+class RunningSweep:
+    """
+    Confusion counts for a fixed threshold grid, accumulated chunk by chunk in constant memory.
+    """
+    def __init__(self, thresholds, inclusive=False):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.inclusive = inclusive
+        self.counts = {name: np.zeros(len(self.thresholds), dtype=np.int64) for name in ('tp', 'fp', 'tn', 'fn')}
+    
+    def update(self, scores, labels):
+        """
+        Add the confusion counts of one chunk of scores and labels.
+        """
+        chunk = threshold_sweep(scores, labels, self.thresholds, self.inclusive)
+        for name in self.counts:
+            self.counts[name] += chunk[name]
+    
+    def sweep(self):
+        """
+        Return the metrics for everything seen so far, in the same form as threshold_sweep.
+        """
+        return metrics_from_counts(self.thresholds, **self.counts)
+
+def best_threshold(sweep, metric='accuracy'):
+    """
+    Return the threshold (in percent) that maximizes metric, and the metric value.
+    Ties go to the lowest threshold.
+    """
+    index = int(np.argmax(sweep[metric]))
+    return float(sweep['thresholds'][index]), float(sweep[metric][index])
+
+def load_threshold(path=THRESHOLD_FILE, default=0.60):
+    """
+    Load the decision threshold (as a fraction) from a threshold file, falling back to default
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return float(json.load(file)['threshold'])
+    except FileNotFoundError:
+        return default
+
+def save_threshold(threshold, metric, value, path=THRESHOLD_FILE):
+    """
+    Save the decision threshold (as a fraction) together with the metric it was chosen for
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'threshold': threshold, 'metric': metric, 'value': value}, file, indent=4)
+        file.write('\n')
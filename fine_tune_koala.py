@@ -1,10 +1,19 @@
+import os
+import sys
+import time
+import argparse
 import torch
-from transformers import Trainer, TrainingArguments, AutoModelForSequenceClassification, AutoTokenizer, AutoConfig
+from transformers import Trainer, TrainerCallback, TrainingArguments, AutoModelForSequenceClassification, AutoTokenizer, AutoConfig, DataCollatorWithPadding
+from transformers.trainer_pt_utils import LengthGroupedSampler
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from datasets import Dataset
+from sklearn.model_selection import GroupShuffleSplit
 from torch.nn import BCEWithLogitsLoss
 import datetime
+from dedup import MinHashIndex, load_rows, near_duplicate_groups
+
+# Tokenization is shared with the Lambda deployment
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_lambda_deployment"))
+from tokenization import TokenCache
 
 # Load the model and tokenizer with memory optimizations
 model_name = "./models/text_moderation_model"
@@ -22,10 +31,15 @@ model = AutoModelForSequenceClassification.from_pretrained(
     config=config,
     torch_dtype=torch.float32    # Back to float32 since MPS doesn't support fp16
 )
-tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+tokens = TokenCache(tokenizer, max_length=256)  # Reduced from 512
 # Enable gradient checkpointing after model creation
 model.gradient_checkpointing_enable()
 
+# Training batch size and gradient accumulation, shared by the trainer and the pipeline report
+TRAIN_BATCH_SIZE = 2
+GRADIENT_ACCUMULATION_STEPS = 8
+
 # Define category indices and result mappings
 CATEGORIES = ['S', 'H', 'V', 'HR', 'SH', 'S3', 'H2', 'V2', 'OK']
 S3_INDEX = CATEGORIES.index('S3')  # Index for sexual/minors category
@@ -59,21 +73,22 @@ def augment_text(text):
     return augmented
 
 # Load and prepare the data
-def load_data(file_path):
-    df = pd.read_csv(file_path, delimiter=';')
-    df = df.dropna(subset=['message', 'result'])
-    
-    # Map string results to numerical values
-    df['result'] = df['result'].map(RESULT_MAPPING)
-    
-    # Augment the data
+def load_data(file_path, chunk_size=10000, augment=True):
+    # Augment the data, reading the CSV in chunks so large replay files are never fully in memory twice.
+    # With augment=False only the original messages are returned, see AugmentedDataset.
     augmented_messages = []
     augmented_results = []
     
-    for idx, row in df.iterrows():
-        augmented_texts = augment_text(row['message'])
-        augmented_messages.extend(augmented_texts)
-        augmented_results.extend([row['result']] * len(augmented_texts))
+    for df in pd.read_csv(file_path, delimiter=';', chunksize=chunk_size):
+        df = df.dropna(subset=['message', 'result'])
+        
+        # Map string results to numerical values
+        df['result'] = df['result'].map(RESULT_MAPPING)
+        
+        for message, result in zip(df['message'], df['result']):
+            augmented_texts = augment_text(message) if augment else [message]
+            augmented_messages.extend(augmented_texts)
+            augmented_results.extend([result] * len(augmented_texts))
     
     # Create new dataframe with augmented data
     augmented_df = pd.DataFrame({
@@ -89,16 +104,78 @@ def load_data(file_path):
     augmented_df['labels'] = labels
     return augmented_df
 
-# Tokenize the dataset
-def tokenize_function(examples):
-    tokenized = tokenizer(
-        examples['message'],
-        truncation=True,
-        padding='max_length',
-        max_length=256  # Reduced from 512
-    )
-    tokenized['labels'] = examples['labels']
-    return tokenized
+class AugmentedDataset(torch.utils.data.Dataset):
+    """
+    One example per original message instead of one row per augmented variant.
+    The variants of each message are tokenized once and variants that tokenize identically
+    (e.g. the lowercase copy with an uncased tokenizer) are dropped. Every epoch serves the next
+    distinct variant of each message, so augmentation is never materialized as extra rows.
+    """
+    def __init__(self, messages, labels, augment=True):
+        self.labels = list(labels)
+        self.variants = []
+        for message in messages:
+            distinct = {}
+            for encoding in tokens.encode(augment_text(message) if augment else [message]):
+                distinct.setdefault(tuple(encoding['input_ids']), encoding)
+            self.variants.append(list(distinct.values()))
+        self.epoch = 0
+    
+    def __len__(self):
+        return len(self.variants)
+    
+    def __getitem__(self, idx):
+        variants = self.variants[idx]
+        encoding = variants[(self.epoch + idx) % len(variants)]
+        return {**encoding, 'labels': self.labels[idx]}
+    
+    def lengths(self):
+        """
+        Token count of the variant served in the current epoch, for each example
+        """
+        return [len(self[idx]['input_ids']) for idx in range(len(self))]
+    
+    def variant_count(self):
+        return sum(len(variants) for variants in self.variants)
+
+class AugmentationEpochCallback(TrainerCallback):
+    """
+    Move the training dataset on to the next augmented variants at the start of every epoch
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+    
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.dataset.epoch = int(state.epoch or 0)
+
+def split_data(data_file, holdout_files=()):
+    """
+    Load the original messages and split them before augmentation, keeping near-duplicate messages
+    on the same side, so neither variants nor near-copies of an evaluation message end up in the training data.
+    Training messages that are near-duplicates of a message in one of the holdout files are dropped.
+    """
+    df = load_data(data_file, augment=False)
+    groups = near_duplicate_groups(df['message'].tolist())
+    # test_size is the fraction of near-duplicate groups, not of messages
+    train_index, eval_index = next(GroupShuffleSplit(n_splits=1, test_size=0.2, random_state=42).split(df, groups=groups))
+    train_df, eval_df = df.iloc[train_index], df.iloc[eval_index]
+    print(f"Split {len(df)} messages in {len(set(groups))} near-duplicate groups: {len(train_df)} train, {len(eval_df)} eval")
+    
+    if holdout_files:
+        index = MinHashIndex()
+        for holdout_file in holdout_files:
+            for message, _ in load_rows(holdout_file):
+                index.add(message)
+        leaked = train_df['message'].map(lambda message: bool(index.find(message))).to_numpy()
+        train_df = train_df[~leaked]
+        print(f"Dropped {leaked.sum()} training messages with a near-duplicate in {', '.join(holdout_files)}")
+    return train_df, eval_df
+
+def build_datasets(data_file, holdout_files=()):
+    train_df, eval_df = split_data(data_file, holdout_files)
+    train_dataset = AugmentedDataset(train_df['message'], train_df['labels'])
+    eval_dataset = AugmentedDataset(eval_df['message'], eval_df['labels'], augment=False)
+    return train_dataset, eval_dataset
 
 # Custom Trainer class with weighted loss
 class CustomTrainer(Trainer):
@@ -118,18 +195,9 @@ class CustomTrainer(Trainer):
         return (loss, outputs) if return_outputs else loss
 
 # Fine-tune the model
-def fine_tune_model(data_file):
-    # Load data
-    df = load_data(data_file)
-    
-    # Split the data
-    train_df, eval_df = train_test_split(df, test_size=0.2, random_state=42)
-    train_dataset = Dataset.from_pandas(train_df)
-    eval_dataset = Dataset.from_pandas(eval_df)
-    
-    # Tokenize datasets
-    train_dataset = train_dataset.map(tokenize_function, batched=True)
-    eval_dataset = eval_dataset.map(tokenize_function, batched=True)
+def fine_tune_model(data_file, holdout_files=()):
+    # Load, split and tokenize the data, augmented variants are served lazily per epoch
+    train_dataset, eval_dataset = build_datasets(data_file, holdout_files)
     
     # Define training arguments with improvements
     training_args = TrainingArguments(
@@ -137,13 +205,13 @@ def fine_tune_model(data_file):
         eval_strategy="steps",
         eval_steps=50,
         learning_rate=2e-5,
-        per_device_train_batch_size=2,
-        per_device_eval_batch_size=2,
+        per_device_train_batch_size=TRAIN_BATCH_SIZE,
+        per_device_eval_batch_size=TRAIN_BATCH_SIZE,
         num_train_epochs=3,
         weight_decay=0.1,
         logging_dir='./logs',
         logging_steps=10,
-        gradient_accumulation_steps=8,
+        gradient_accumulation_steps=GRADIENT_ACCUMULATION_STEPS,
         warmup_ratio=0.1,
         save_strategy="steps",
         save_steps=50,
@@ -155,7 +223,8 @@ def fine_tune_model(data_file):
         greater_is_better=False,
         fp16=False,               # Disable fp16 since MPS doesn't support it
         dataloader_num_workers=1,
-        gradient_checkpointing=True
+        gradient_checkpointing=True,
+        group_by_length=True      # Batch messages of similar length so little padding is needed
     )
     
     # Initialize CustomTrainer
@@ -164,6 +233,8 @@ def fine_tune_model(data_file):
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
+        data_collator=DataCollatorWithPadding(tokenizer),
+        callbacks=[AugmentationEpochCallback(train_dataset)]
     )
     
     # Fine-tune the model
@@ -182,6 +253,78 @@ def fine_tune_model(data_file):
     print(f"Tokenizer: {tokenizer_save_path}")
     print("\nTo use this version, update the paths in koala.py")
 
+def padded_tokens(batches, lengths):
+    """
+    Tokens processed for batches padded to their longest example
+    """
+    return sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+
+def time_training_steps(batches, steps):
+    """
+    Average time of a forward and backward pass over the first steps batches, in seconds
+    """
+    model.train()
+    loss_fct = BCEWithLogitsLoss()
+    start_time = time.perf_counter()
+    for inputs in batches[:steps]:
+        labels = inputs.pop("labels")
+        logits = model(**inputs).logits
+        loss_fct(logits[:, S3_INDEX], labels[:, S3_INDEX].float()).backward()
+        model.zero_grad()
+    return (time.perf_counter() - start_time) / min(steps, len(batches))
+
+def report_pipeline(data_file, steps=20):
+    """
+    Compare one training epoch of the materialized pipeline padded to max_length
+    with the lazily augmented, deduplicated, length-grouped and dynamically padded pipeline
+    """
+    train_df, _ = split_data(data_file)
+    train_dataset = AugmentedDataset(train_df['message'], train_df['labels'])
+    
+    # Previous pipeline: every augmented variant is a row, padded to max_length, in random order
+    augmented = [(text, labels) for message, labels in zip(train_df['message'], train_df['labels']) for text in augment_text(message)]
+    baseline_tokens = len(augmented) * tokens.max_length
+    baseline_order = torch.randperm(len(augmented)).tolist()
+    baseline_batches = []
+    for start in range(0, min(steps, -(-len(augmented) // TRAIN_BATCH_SIZE)) * TRAIN_BATCH_SIZE, TRAIN_BATCH_SIZE):
+        rows = [augmented[i] for i in baseline_order[start:start + TRAIN_BATCH_SIZE]]
+        inputs = tokenizer([text for text, _ in rows], truncation=True, padding='max_length', max_length=tokens.max_length, return_tensors='pt')
+        inputs['labels'] = torch.tensor([labels for _, labels in rows])
+        baseline_batches.append(inputs)
+    
+    # New pipeline: one example per message, grouped by length like Trainer(group_by_length=True)
+    lengths = train_dataset.lengths()
+    order = list(LengthGroupedSampler(TRAIN_BATCH_SIZE * GRADIENT_ACCUMULATION_STEPS, lengths=lengths))
+    grouped_batches = [order[i:i + TRAIN_BATCH_SIZE] for i in range(0, len(order), TRAIN_BATCH_SIZE)]
+    random_order = torch.randperm(len(train_dataset)).tolist()
+    random_batches = [random_order[i:i + TRAIN_BATCH_SIZE] for i in range(0, len(random_order), TRAIN_BATCH_SIZE)]
+    grouped_tokens = padded_tokens(grouped_batches, lengths)
+    
+    print(f"\nTokens processed per epoch on {data_file} (batch size {TRAIN_BATCH_SIZE}):")
+    print(f"Materialized, padded to {tokens.max_length}: {len(augmented)} rows, {baseline_tokens} tokens")
+    print(f"Lazy augmentation:           {len(train_dataset)} rows, {train_dataset.variant_count()} distinct variants")
+    print(f"  dynamic padding:           {padded_tokens(random_batches, lengths)} tokens")
+    print(f"  length-grouped:            {grouped_tokens} tokens ({(1 - grouped_tokens / baseline_tokens) * 100:.1f}% fewer)")
+    
+    # Time training steps of both pipelines on CPU and scale them to a full epoch
+    collator = DataCollatorWithPadding(tokenizer)
+    new_batches = [collator([train_dataset[i] for i in batch]) for batch in grouped_batches[:steps]]
+    baseline_epoch = time_training_steps(baseline_batches, steps) * -(-len(augmented) // TRAIN_BATCH_SIZE)
+    new_epoch = time_training_steps(new_batches, steps) * len(grouped_batches)
+    
+    print(f"\nCPU time per epoch, from {steps} timed forward and backward steps:")
+    print(f"Materialized, padded to {tokens.max_length}: {baseline_epoch:.1f}s")
+    print(f"Lazy, length-grouped:        {new_epoch:.1f}s ({baseline_epoch / new_epoch:.2f}x faster)")
+
 if __name__ == "__main__":
-    data_file_path = "./test_cases.csv"
-    fine_tune_model(data_file_path)
+    parser = argparse.ArgumentParser(description="Fine-tune the moderation model")
+    parser.add_argument("file", nargs="?", default="./test_cases.csv")
+    parser.add_argument("--report", action="store_true", help="Report tokens and CPU time per epoch of the data pipeline instead of training")
+    parser.add_argument("--steps", type=int, default=20, help="Training steps timed per pipeline by --report")
+    parser.add_argument("--holdout", nargs="+", default=[], help="Test CSVs whose near-duplicates are dropped from the training data")
+    args = parser.parse_args()
+    
+    if args.report:
+        report_pipeline(args.file, args.steps)
+    else:
+        fine_tune_model(args.file, args.holdout)
@@ -1,7 +1,15 @@
 import os
+import sys
 import csv
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
-import torch
+import time
+import numpy as np
+from eval_metrics import REPORT_THRESHOLDS, RunningSweep, best_threshold, dense_grid, load_threshold, save_threshold, scores_and_labels, threshold_sweep
+from score_store import SCORE_STORE_DIR, ScoreStore, message_hash
+
+# Tokenization and the moderation policy are shared with the Lambda deployment
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_lambda_deployment"))
+from policy import PolicyFile
+from tokenization import TokenCache
 
 # Define the model folder and file names
 model_name = "KoalaAI/Text-Moderation"
@@ -16,37 +24,71 @@ def load_model():
     """
     Load the model and tokenizer. If they are not locally available, download and save them.
     """
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    
     if os.path.exists(model_path) and os.path.exists(tokenizer_path):
         print("Loading model and tokenizer from local files...")
         model = AutoModelForSequenceClassification.from_pretrained(model_path)
-        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True)
     else:
         print("Downloading model and tokenizer...")
         model = AutoModelForSequenceClassification.from_pretrained(model_name)
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
         print("Saving model and tokenizer locally...")
         model.save_pretrained(model_path)
         tokenizer.save_pretrained(tokenizer_path)
     return model, tokenizer
 
-# Load the model and tokenizer
-model, tokenizer = load_model()
+# The model and tokenizer are loaded on first use, so reports served from the score store never load them
+model = None
+tokenizer = None
+tokens = None
 
-def process_message(message):
+def get_model():
     """
-    Process a single message and return probabilities for each category.
+    Return the model and tokenizer, loading them on first use.
+    """
+    global model, tokenizer, tokens
+    if model is None:
+        model, tokenizer = load_model()
+        tokens = TokenCache(tokenizer, max_length=512)
+    return model, tokenizer
+
+# Categories of the model output, see fine_tune_koala.CATEGORIES
+CATEGORIES = ['S', 'H', 'V', 'HR', 'SH', 'S3', 'H2', 'V2', 'OK']
+
+# Index for sexual/minors category (S3)
+S3_INDEX = 5
+
+# Decision threshold for the S3 category, chosen from accuracy statistics and stored in threshold.json
+THRESHOLD = load_threshold(default=0.60)
+
+# Per-category thresholds and actions applied by process_message, see python_lambda_deployment/policy.json
+POLICY = PolicyFile.from_environment(CATEGORIES, THRESHOLD)
+
+# Number of messages scored per forward pass in evaluate_test_cases
+EVAL_BATCH_SIZE = 32
+
+# Rows read and scored at a time by evaluate_test_cases_streaming
+STREAM_CHUNK_SIZE = 2048
+
+# Newly scored rows the streaming evaluation buffers before writing them to the score store
+STORE_FLUSH_ROWS = 50000
+
+# Sliding-window scoring: "off" scores the first 512 tokens of a message, "max" and "noisy-or"
+# score overlapping windows of WINDOW_TOKENS tokens, WINDOW_STRIDE tokens apart, and combine them
+WINDOW_MODES = ("off", "max", "noisy-or")
+WINDOW_MODE = os.environ.get("WINDOW_MODE", "off")
+WINDOW_TOKENS = int(os.environ.get("WINDOW_TOKENS", 128))
+WINDOW_STRIDE = int(os.environ.get("WINDOW_STRIDE", 96))
+
+if WINDOW_MODE not in WINDOW_MODES:
+    raise ValueError(f"Unknown window mode: {WINDOW_MODE}")
+
+def build_result(s3_probability):
+    """
+    Build the moderation result for a single S3 probability (in percent).
     """
-    inputs = tokenizer(message, return_tensors="pt", truncation=True, max_length=512)
-    outputs = model(**inputs)
-    probabilities = torch.sigmoid(outputs.logits)[0]
-    
-    # Get probability for sexual/minors category (S3)
-    s3_index = 5
-    s3_probability = probabilities[s3_index].item() * 100
-    
-    # Constants
-    THRESHOLD = 0.60  # Updated threshold based on accuracy statistics (96.0% accuracy at 60%)
-    
     # Decision threshold set to THRESHOLD for S3 category
     should_block = s3_probability >= THRESHOLD * 100
     
@@ -57,6 +99,152 @@ def process_message(message):
         }
     }
 
+def process_message(message):
+    """
+    Process a single message and return the probabilities of the categories in the policy,
+    with every category whose rule triggered.
+    """
+    import torch
+    
+    if WINDOW_MODE != "off":
+        logits = score_messages([message], report=False)
+    else:
+        model, tokenizer = get_model()
+        inputs = tokens([message])
+        with torch.no_grad():
+            logits = model(**inputs).logits.numpy()
+    
+    result = POLICY.current().evaluate(1 / (1 + np.exp(-logits.astype(np.float64))))[0]
+    return {
+        "should_block": result["should_block"],
+        "probabilities": result["probabilities"],
+        "triggered_categories": result["triggered_categories"]
+    }
+
+def window_encodings(tokenizer, messages):
+    """
+    Split every message into overlapping windows of WINDOW_TOKENS tokens, special tokens included,
+    starting every WINDOW_STRIDE tokens. Returns the window encodings and, for each window, the index of its message.
+    """
+    overlap = WINDOW_TOKENS - tokenizer.num_special_tokens_to_add() - WINDOW_STRIDE
+    if overlap < 0:
+        raise ValueError(f"WINDOW_STRIDE must be at most {WINDOW_TOKENS - tokenizer.num_special_tokens_to_add()} tokens")
+    
+    encodings = tokenizer(
+        messages,
+        truncation=True,
+        max_length=WINDOW_TOKENS,
+        stride=overlap,
+        return_overflowing_tokens=True
+    )
+    owners = np.array(encodings.pop("overflow_to_sample_mapping"))
+    return encodings, owners
+
+def aggregate_windows(window_logits, owners, count):
+    """
+    Combine the window logits of each message into one row of logits with WINDOW_MODE:
+    the most confident window ("max"), or the probability that any window is positive ("noisy-or")
+    """
+    if WINDOW_MODE == "max":
+        # The sigmoid is monotonic, so the largest logit is the largest probability
+        logits = np.full((count, window_logits.shape[1]), -np.inf, dtype=np.float32)
+        np.maximum.at(logits, owners, window_logits)
+        return logits
+    
+    # noisy-OR: p = 1 - prod(1 - p_window), kept in log space so long messages do not underflow
+    log_negative = np.zeros((count, window_logits.shape[1]), dtype=np.float64)
+    np.add.at(log_negative, owners, -np.logaddexp(0, window_logits.astype(np.float64)))
+    with np.errstate(divide='ignore'):
+        return (np.log(-np.expm1(log_negative)) - log_negative).astype(np.float32)
+
+def score_messages(messages, batch_size=EVAL_BATCH_SIZE, report=True):
+    """
+    Return the logits for every category as a float32 array with one row per message, in input order.
+    Messages are sorted by token length so each batch is only padded to its own longest message.
+    With WINDOW_MODE set, every window of every message is scored and the windows are combined per message.
+    """
+    import torch
+    
+    model, tokenizer = get_model()
+    if WINDOW_MODE != "off":
+        windows, owners = window_encodings(tokenizer, messages)
+        encodings = [{key: values[i] for key, values in windows.items()} for i in range(len(owners))]
+    else:
+        encodings, owners = tokens.encode(messages), None
+    rows = len(encodings)
+    order = sorted(range(rows), key=lambda i: len(encodings[i]["input_ids"]))
+    
+    start_time = time.perf_counter()
+    logits = np.zeros((rows, model.config.num_labels), dtype=np.float32)
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+            inputs = tokens.pad([encodings[i] for i in batch_indices])
+            outputs = model(**inputs)
+            
+            # Scatter the batch back to the original row positions
+            logits[batch_indices] = outputs.logits.numpy()
+    
+    if owners is not None:
+        logits = aggregate_windows(logits, owners, len(messages))
+    
+    elapsed = time.perf_counter() - start_time
+    rows_per_second = len(messages) / elapsed if elapsed > 0 else 0
+    if report:
+        print(f"Scored {len(messages)} messages in {elapsed:.2f}s "
+              f"({rows_per_second:.1f} rows/sec, batch size {batch_size})")
+        if owners is not None:
+            print(f"Window mode {WINDOW_MODE}: {rows} windows of up to {WINDOW_TOKENS} tokens, stride {WINDOW_STRIDE}")
+    
+    return logits
+
+def results_from_logits(logits):
+    """
+    Build one moderation result per row of logits.
+    """
+    s3_probabilities = 1 / (1 + np.exp(-logits[:, S3_INDEX]))
+    return [build_result(float(probability) * 100) for probability in s3_probabilities]
+
+def process_messages(messages, batch_size=EVAL_BATCH_SIZE):
+    """
+    Process a list of messages in mini-batches and return one result per message, in input order.
+    """
+    return results_from_logits(score_messages(messages, batch_size))
+
+def score_messages_in_workers(messages, batch_size, workers, report=True, pool=None):
+    """
+    Score messages in the current process, or shard them across worker processes when workers > 1.
+    A pool from sharded_eval.create_pool is reused instead of starting new workers.
+    """
+    if workers > 1:
+        from sharded_eval import score_messages_sharded
+        return score_messages_sharded(messages, workers, batch_size, pool=pool, report=report)
+    return score_messages(messages, batch_size, report=report)
+
+def score_messages_with_store(messages, batch_size, score_store, workers=1, report=True, pool=None):
+    """
+    Return the logits for every message, scoring only the messages missing from the score store.
+    With report=False new rows are only buffered; the caller flushes the store.
+    """
+    hashes = [message_hash(message) for message in messages]
+    logits, found = score_store.lookup(hashes)
+    
+    # Score each new or changed message once, even if it appears in several rows
+    missing = {}
+    for i in np.flatnonzero(~found):
+        missing.setdefault(hashes[i], []).append(i)
+    
+    if missing:
+        rows = [indices[0] for indices in missing.values()]
+        new_logits = score_messages_in_workers([messages[i] for i in rows], batch_size, workers, report, pool)
+        for indices, row_logits in zip(missing.values(), new_logits):
+            logits[indices] = row_logits
+        score_store.add(list(missing.keys()), new_logits, flush=report)
+    
+    if report:
+        print(f"Score store {score_store.path}: reused {int(found.sum())} rows, scored {len(missing)} new or changed messages")
+    return logits
+
 # Result mappings for string to numerical conversion
 RESULT_MAPPING = {
     'TN': 1,  # True Negative - Should pass moderation
@@ -65,7 +253,44 @@ RESULT_MAPPING = {
     'FP': 1   # False Positive - Should pass moderation
 }
 
-def evaluate_test_cases(file_path):
+def iter_test_cases(file_path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Read a ;-delimited test cases CSV row by row and yield (messages, expected_results) chunks
+    of up to chunk_size valid rows, so the whole file never has to be held in memory.
+    """
+    messages = []
+    expected_results = []
+    with open(file_path, 'r', encoding='utf-8') as file:
+        reader = csv.DictReader(file, delimiter=';')
+        for row in reader:
+            try:
+                message = row["message"].strip()
+                expected_result = RESULT_MAPPING[row["result"]]  # Convert string to numerical value
+                
+                if not message:  # Skip empty messages
+                    continue
+                
+                messages.append(message)
+                expected_results.append(expected_result)
+            except KeyError as e:
+                print(f"Missing required field in row: {e}")
+                continue
+            except ValueError as e:
+                print(f"Invalid value in row: {e}")
+                continue
+            except Exception as e:
+                print(f"Unexpected error processing row: {e}")
+                continue
+            
+            if len(messages) >= chunk_size:
+                yield messages, expected_results
+                messages = []
+                expected_results = []
+    
+    if messages:
+        yield messages, expected_results
+
+def evaluate_test_cases(file_path, batch_size=EVAL_BATCH_SIZE, score_store=None, workers=1):
     """
     Evaluate test cases from a CSV file.
     Result mappings:
@@ -73,65 +298,55 @@ def evaluate_test_cases(file_path):
     - FN (False Negative) = 0 -> Should be blocked
     - TP (True Positive) = 0  -> Should be blocked
     - FP (False Positive) = 1 -> Should pass moderation
+    
+    Messages are scored in mini-batches of batch_size; batch_size=1 scores row by row.
+    With a score_store, only messages without stored logits are scored.
+    With workers > 1, messages are sharded across that many worker processes.
     """
     results = []
     category_totals = {
         'sexual/minors': {
             'count': 0, 
-            'total_prob': 0,
-            'thresholds': {10: 0, 20: 0, 30: 0, 40: 0, 50: 0, 60: 0, 70: 0, 80: 0, 85: 0, 90: 0, 95: 0, 99: 0}
+            'total_prob': 0
         }
     }
     
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file, delimiter=';')
-            for row in reader:
-                try:
-                    message = row["message"].strip()
-                    expected_result = RESULT_MAPPING[row["result"]]  # Convert string to numerical value
-                    
-                    if not message:  # Skip empty messages
-                        continue
-                    
-                    # Process the message
-                    model_result = process_message(message)
-                    
-                    # Update category totals
-                    for cat, prob in model_result['probabilities'].items():
-                        if cat not in category_totals:
-                            category_totals[cat] = {
-                                'count': 0, 
-                                'total_prob': 0,
-                                'thresholds': {10: 0, 20: 0, 30: 0, 40: 0, 50: 0, 60: 0, 70: 0, 80: 0, 85: 0, 90: 0, 95: 0, 99: 0}
-                            }
-                        category_totals[cat]['total_prob'] += prob
-                        
-                        # Update threshold counts
-                        prob_percentage = prob
-                        for threshold in [10, 20, 30, 40, 50, 60, 70, 80, 85, 90, 95, 99]:
-                            if prob_percentage > threshold:
-                                category_totals[cat]['thresholds'][threshold] += 1
-                    
-                    # Compare and record the result
-                    predicted_result = 1 if not model_result['should_block'] else 0
-                    
-                    results.append({
-                        "message": message,
-                        "expected": expected_result,
-                        "predicted": predicted_result,
-                        "match": predicted_result == expected_result,
-                        "categories": model_result['probabilities']
-                    })
-                except KeyError as e:
-                    print(f"Missing required field in row: {e}")
-                    continue
-                except ValueError as e:
-                    print(f"Invalid value in row: {e}")
-                    continue
-                except Exception as e:
-                    print(f"Unexpected error processing row: {e}")
-                    continue
+        # Read and validate all rows first so they can be scored in batches
+        messages = []
+        expected_results = []
+        for chunk_messages, chunk_expected_results in iter_test_cases(file_path):
+            messages.extend(chunk_messages)
+            expected_results.extend(chunk_expected_results)
+        
+        # Process the messages
+        if score_store is not None:
+            logits = score_messages_with_store(messages, batch_size, score_store, workers)
+        else:
+            logits = score_messages_in_workers(messages, batch_size, workers)
+        model_results = results_from_logits(logits)
+        
+        for message, expected_result, model_result in zip(messages, expected_results, model_results):
+            # Update category totals
+            for cat, prob in model_result['probabilities'].items():
+                if cat not in category_totals:
+                    category_totals[cat] = {
+                        'count': 0, 
+                        'total_prob': 0
+                    }
+                category_totals[cat]['count'] += 1
+                category_totals[cat]['total_prob'] += prob
+            
+            # Compare and record the result
+            predicted_result = 1 if not model_result['should_block'] else 0
+            
+            results.append({
+                "message": message,
+                "expected": expected_result,
+                "predicted": predicted_result,
+                "match": predicted_result == expected_result,
+                "categories": model_result['probabilities']
+            })
                 
     except FileNotFoundError:
         print(f"File not found: {file_path}")
@@ -142,17 +357,87 @@ def evaluate_test_cases(file_path):
     
     return results, category_totals
 
-def print_results(results, category_totals):
+def evaluate_test_cases_streaming(file_path, batch_size=EVAL_BATCH_SIZE, score_store=None, workers=1,
+                                  chunk_size=STREAM_CHUNK_SIZE, report_every=50000, store_flush_rows=STORE_FLUSH_ROWS):
     """
-    Print the results of the evaluation in a table format with category probabilities.
+    Evaluate a test cases CSV of any size in constant memory.
+    Rows are read and scored chunk by chunk and folded into running confusion counts;
+    the message text is only kept for mismatches. Partial results are printed every report_every rows.
+    With workers > 1 one pool of worker processes scores every chunk. Newly scored rows are written to
+    the score store as a new segment every store_flush_rows rows.
+    """
+    summary = {
+        'total': 0,
+        'matches': 0,
+        'total_prob': 0.0,
+        'report_sweep': RunningSweep(REPORT_THRESHOLDS),
+        'dense_sweep': RunningSweep(dense_grid(), inclusive=True),
+        'mismatches': []
+    }
+    
+    pool = None
+    if workers > 1:
+        from sharded_eval import create_pool
+        pool = create_pool(workers)
+    
+    start_time = time.perf_counter()
+    next_report = report_every
+    try:
+        for messages, expected_results in iter_test_cases(file_path, chunk_size):
+            if score_store is not None:
+                logits = score_messages_with_store(messages, batch_size, score_store, workers, report=False, pool=pool)
+                if score_store.pending_rows >= store_flush_rows:
+                    score_store.flush_segment()
+            else:
+                logits = score_messages_in_workers(messages, batch_size, workers, report=False, pool=pool)
+            
+            # Fold the chunk into the running counts
+            scores = (1 / (1 + np.exp(-logits[:, S3_INDEX]))).astype(np.float64) * 100
+            labels = np.array([expected == 0 for expected in expected_results], dtype=np.int64)
+            summary['report_sweep'].update(scores, labels)
+            summary['dense_sweep'].update(scores, labels)
+            summary['total'] += len(messages)
+            summary['total_prob'] += float(scores.sum())
+            
+            for message, expected_result, model_result in zip(messages, expected_results, results_from_logits(logits)):
+                predicted_result = 1 if not model_result['should_block'] else 0
+                if predicted_result == expected_result:
+                    summary['matches'] += 1
+                else:
+                    summary['mismatches'].append({
+                        "message": message,
+                        "expected": expected_result,
+                        "predicted": predicted_result,
+                        "match": False,
+                        "categories": model_result['probabilities']
+                    })
+            
+            if summary['total'] >= next_report:
+                next_report += report_every
+                elapsed = time.perf_counter() - start_time
+                print(f"Processed {summary['total']} rows in {elapsed:.1f}s ({summary['total'] / elapsed:.1f} rows/sec): "
+                      f"accuracy {summary['matches'] / summary['total'] * 100:.2f}%, {len(summary['mismatches'])} mismatches")
+    except FileNotFoundError:
+        print(f"File not found: {file_path}")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if score_store is not None:
+            score_store.flush_segment()
+    
+    return summary
+
+def print_message_table(results, title="Moderation Results"):
+    """
+    Print one table row per result with its expected and predicted decision.
     """
-    # First print the message results table
     message_width = 65
     status_width = 8
     match_width = 6
     cat_width = 11
     
-    print("\nModeration Results:")
+    print(f"\n{title}:")
     header = (
         "+" + "-" * message_width + "+" + "-" * status_width + "+" + "-" * status_width + 
         "+" + "-" * match_width + "+" + "-" * cat_width + "+"
@@ -194,10 +479,43 @@ def print_results(results, category_totals):
         )
     
     print(header)
+
+def print_streaming_results(summary):
+    """
+    Print the report of evaluate_test_cases_streaming: the mismatched messages and the threshold statistics.
+    """
+    print_message_table(summary['mismatches'], title="Mismatched Results")
+    avg_prob = summary['total_prob'] / summary['total'] if summary['total'] > 0 else 0
+    print_statistics(summary['total'], summary['report_sweep'].sweep(), avg_prob, summary['matches'])
+    if summary['total'] > 0:
+        print_threshold_recommendation(summary['dense_sweep'].sweep())
+
+def print_results(results, category_totals):
+    """
+    Print the results of the evaluation in a table format with category probabilities.
+    """
+    # First print the message results table
+    print_message_table(results)
     
     # Print category statistics
     total_cases = len(results)
-    thresholds = [10, 20, 30, 40, 50, 60, 70, 80, 85, 90, 95, 99]
+    category = 'sexual/minors'
+    
+    # Score every threshold at once from the probabilities collected in the scoring pass
+    scores, labels = scores_and_labels(results, category)
+    sweep = threshold_sweep(scores, labels, REPORT_THRESHOLDS)
+    avg_prob = float(scores.mean()) if total_cases > 0 else 0
+    matches = sum(1 for r in results if r['match'])
+    print_statistics(total_cases, sweep, avg_prob, matches, category)
+    
+    if total_cases > 0:
+        print_threshold_recommendation(threshold_sweep(scores, labels, dense_grid(), inclusive=True))
+
+def print_statistics(total_cases, sweep, avg_prob, matches, category='sexual/minors'):
+    """
+    Print the count, percentage and accuracy tables for the report thresholds, followed by the summary.
+    """
+    thresholds = sweep['thresholds'].astype(int)
     
     print("\nCategory Statistics:")
     header_line = "+" + "-" * 30
@@ -215,16 +533,13 @@ def print_results(results, category_totals):
     print(header_line)
     
     # Print data for each category
-    category = 'sexual/minors'
     data_line = f"|{category:<30}"
     
-    # Calculate counts for each threshold
-    for threshold in thresholds:
-        count = sum(1 for r in results if r['categories'][category] > threshold)
+    # Counts for each threshold
+    for count in sweep['predicted_positive']:
         data_line += f"|{count:>15}"
     
-    # Calculate average probability
-    avg_prob = sum(r['categories'][category] for r in results) / total_cases if total_cases > 0 else 0
+    # Average probability
     data_line += f"|{avg_prob:>13.1f}%|"
     print(data_line)
     print(header_line)
@@ -243,8 +558,7 @@ def print_results(results, category_totals):
     
     # Print percentage data
     data_line = f"|{category:<30}"
-    for threshold in thresholds:
-        count = sum(1 for r in results if r['categories'][category] > threshold)
+    for count in sweep['predicted_positive']:
         percentage = (count / total_cases * 100) if total_cases > 0 else 0
         data_line += f"|{percentage:>13.1f}%"
     data_line += f"|{avg_prob:>13.1f}%|"
@@ -265,27 +579,14 @@ def print_results(results, category_totals):
     
     # Print accuracy data
     data_line = f"|{category:<30}"
-    for threshold in thresholds:
-        # Calculate accuracy for this threshold
-        correct_predictions = 0
-        total_predictions = len(results)
-        
-        for result in results:
-            prob = result['categories'][category]
-            predicted_block = prob > threshold
-            expected_block = result['expected'] == 0  # 0 means should block
-            if predicted_block == expected_block:
-                correct_predictions += 1
-        
-        accuracy = (correct_predictions / total_predictions * 100) if total_predictions > 0 else 0
-        data_line += f"|{accuracy:>13.1f}%"
+    for accuracy in sweep['accuracy']:
+        data_line += f"|{accuracy * 100:>13.1f}%"
     
     data_line += f"|{avg_prob:>13.1f}%|"
     print(data_line)
     print(header_line)
     
     # Print summary statistics
-    matches = sum(1 for r in results if r['match'])
     accuracy = (matches / total_cases * 100) if total_cases > 0 else 0
     
     print(f"\nSummary:")
@@ -293,9 +594,50 @@ def print_results(results, category_totals):
     print(f"Correct predictions: {matches}")
     print(f"Accuracy: {accuracy:.2f}%")
 
-# Path to the test cases file
-csv_file_path = "test_cases.csv"
+def print_threshold_recommendation(sweep):
+    """
+    Print the best thresholds of a dense sweep computed with the same >= rule used by build_result.
+    """
+    print(f"\nThreshold Sweep ({len(sweep['thresholds'])} thresholds):")
+    for name in ('accuracy', 'f1'):
+        threshold, value = best_threshold(sweep, name)
+        index = int(np.searchsorted(sweep['thresholds'], threshold))
+        print(
+            f"Best {name}: {value * 100:.2f}% at {threshold:.1f}% "
+            f"(precision {sweep['precision'][index] * 100:.1f}%, recall {sweep['recall'][index] * 100:.1f}%, "
+            f"TP {sweep['tp'][index]}, FP {sweep['fp'][index]}, TN {sweep['tn'][index]}, FN {sweep['fn'][index]})"
+        )
+    print(f"Current threshold: {THRESHOLD * 100:.1f}%")
 
-# Evaluate and print the results
-evaluation_results, category_totals = evaluate_test_cases(csv_file_path)
-print_results(evaluation_results, category_totals)
\ No newline at end of file
+if __name__ == "__main__":
+    # Path to the test cases file
+    csv_file_path = "test_cases.csv"
+    
+    # Batch size for evaluation, override with EVAL_BATCH_SIZE=1 to score row by row
+    eval_batch_size = int(os.environ.get("EVAL_BATCH_SIZE", EVAL_BATCH_SIZE))
+    
+    # Number of worker processes, each scoring its own shard of the CSV
+    eval_workers = int(os.environ.get("EVAL_WORKERS", 1))
+    
+    # Logits are kept in the score store so report changes do not rerun the model, disable with SCORE_STORE=off
+    score_store_dir = os.environ.get("SCORE_STORE", SCORE_STORE_DIR)
+    if score_store_dir != "off" and WINDOW_MODE != "off":
+        # Windowed scores are kept apart from the truncated ones
+        score_store_dir = os.path.join(score_store_dir, f"window_{WINDOW_MODE}_{WINDOW_TOKENS}_{WINDOW_STRIDE}")
+    score_store = ScoreStore(model_path, score_store_dir) if score_store_dir != "off" else None
+    
+    # Replay files too large for memory can be evaluated chunk by chunk with EVAL_STREAMING=1
+    if os.environ.get("EVAL_STREAMING") == "1":
+        print_streaming_results(evaluate_test_cases_streaming(csv_file_path, batch_size=eval_batch_size, score_store=score_store, workers=eval_workers))
+        raise SystemExit(0)
+    
+    # Evaluate and print the results
+    evaluation_results, category_totals = evaluate_test_cases(csv_file_path, batch_size=eval_batch_size, score_store=score_store, workers=eval_workers)
+    print_results(evaluation_results, category_totals)
+    
+    # Store the most accurate threshold in threshold.json with SAVE_THRESHOLD=1, instead of editing THRESHOLD by hand
+    if os.environ.get("SAVE_THRESHOLD") == "1" and evaluation_results:
+        scores, labels = scores_and_labels(evaluation_results)
+        best, value = best_threshold(threshold_sweep(scores, labels, dense_grid(), inclusive=True), 'accuracy')
+        save_threshold(best / 100, 'accuracy', value)
+        print(f"Saved threshold {best / 100:.3f} to threshold.json")
\ No newline at end of file
@@ -0,0 +1,315 @@
+import os
+import io
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import itertools
+
+# The Lambda model class, with its caches, pre-filter, cascade and policy
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_lambda_deployment"))
+from koala_lambda import MAX_BATCH_MESSAGES, TextModerationLambda, format_result
+
+# Rows scored and written between two checkpoints; a crash loses at most one chunk of work
+CHUNK_SIZE = 2048
+
+# Columns (CSV) or keys (JSONL) searched for the message when none is given, in order
+TEXT_COLUMNS = ("message", "content", "text")
+
+def open_input(path):
+    """
+    Open a UTF-8 input file, or stdin for "-"
+    """
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+def detect_format(path, first_line):
+    """
+    Guess the input format from the file extension, or from the first line when reading stdin
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    if extension in (".csv", ".tsv"):
+        return "csv"
+    return "jsonl" if first_line.lstrip().startswith(("{", '"')) else "csv"
+
+def find_column(columns, text_column):
+    if text_column:
+        if text_column not in columns:
+            raise ValueError(f"Input has no {text_column} column")
+        return text_column
+    for column in TEXT_COLUMNS:
+        if column in columns:
+            return column
+    raise ValueError(f"Input has none of the {', '.join(TEXT_COLUMNS)} columns, pass --text-column")
+
+def read_rows(file, path, input_format="auto", text_column=None, id_column=None, delimiter=None):
+    """
+    Yield (id, text) for every row of a CSV file with a header, or of a JSONL file of objects or strings.
+    The id is taken from id_column, or None. The CSV delimiter is guessed from the header when not given.
+    """
+    first_line = file.readline()
+    lines = itertools.chain([first_line], file)
+    if input_format == "auto":
+        input_format = detect_format(path, first_line)
+    
+    if input_format == "csv":
+        # The test case files are ;-delimited, exports are usually ,-delimited
+        reader = csv.DictReader(lines, delimiter=delimiter or max(";,\t", key=first_line.count))
+        column = find_column(reader.fieldnames or [], text_column)
+        for row in reader:
+            yield row.get(id_column) if id_column else None, row[column]
+        return
+    
+    column = None
+    for line in lines:
+        if not line.strip():
+            continue
+        value = json.loads(line)
+        if not isinstance(value, dict):
+            # A bare string is the message; other values are skipped by score_chunk like empty rows
+            yield None, value
+            continue
+        column = column or find_column(value, text_column)
+        yield value.get(id_column) if id_column else None, value.get(column)
+
+def iter_chunks(rows, chunk_size):
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def chunk_digest(previous, chunk):
+    """
+    Chain a digest of the chunk's rows onto the digest of the rows before it, so a resumed run can
+    check that it skips the same rows the checkpoint was written for
+    """
+    digest = hashlib.sha1(previous.encode('ascii'))
+    for row_id, text in chunk:
+        digest.update(json.dumps([row_id, text]).encode('utf-8'))
+    return digest.hexdigest()
+
+def score_chunk(model, chunk, first_row, batch_size=MAX_BATCH_MESSAGES):
+    """
+    Score a chunk of (id, text) rows and return one output record per non-empty text, in input order.
+    Empty rows and values that are not strings, such as numbers or objects in JSONL input, are skipped.
+    Texts are sorted by length before batching, so each padded forward pass wastes few tokens.
+    """
+    pending = sorted((i for i, (_, text) in enumerate(chunk) if isinstance(text, str) and text.strip()), key=lambda i: len(chunk[i][1]))
+    results = [None] * len(chunk)
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        for i, result in zip(batch, model.predict_batch([chunk[i][1] for i in batch])):
+            results[i] = result
+    
+    records = []
+    for i, ((row_id, _), result) in enumerate(zip(chunk, results)):
+        if result is None:
+            continue
+        response = format_result(result)
+        records.append({
+            "row": first_row + i,
+            "id": row_id,
+            "is_flagged": response["is_flagged"],
+            "probability": response["probability"],
+            "category": response["category"],
+            "stage": response["stage"],
+            "triggered_categories": response["triggered_categories"],
+            # Only the model stage reports every category of the policy
+            "probabilities": result.get("probabilities")
+        })
+    return records
+
+class JSONLWriter:
+    """
+    Appends one JSON line per record. Opening at a checkpointed position drops whatever a crashed
+    run wrote after its last checkpoint.
+    """
+    def __init__(self, path, position=None):
+        self.file = open(path, 'r+b' if position and os.path.exists(path) else 'wb')
+        self.file.truncate((position or {}).get("bytes", 0))
+        self.file.seek(0, os.SEEK_END)
+    
+    def write(self, records):
+        self.file.write("".join(json.dumps(record) + "\n" for record in records).encode('utf-8'))
+    
+    def commit(self):
+        """
+        Make the written records durable and return the position to resume from
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {"bytes": self.file.tell()}
+    
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    """
+    Writes every chunk as its own part file of a Parquet dataset directory. A part is renamed into place
+    once complete, and opening at a checkpointed position deletes the parts written after it.
+    """
+    def __init__(self, path, position=None):
+        import pyarrow as pa
+        
+        self.path = path
+        self.parts = (position or {}).get("parts", 0)
+        self.schema = pa.schema([
+            ("row", pa.int64()),
+            ("id", pa.string()),
+            ("is_flagged", pa.bool_()),
+            ("probability", pa.float64()),
+            ("category", pa.string()),
+            ("stage", pa.string()),
+            ("triggered_categories", pa.list_(pa.struct([("category", pa.string()), ("probability", pa.float64()), ("action", pa.string())]))),
+            ("probabilities", pa.map_(pa.string(), pa.float64()))
+        ])
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith(".tmp") or (name.startswith("part-") and int(name[5:10]) >= self.parts):
+                os.remove(os.path.join(path, name))
+    
+    def write(self, records):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        rows = [
+            {
+                **record,
+                "id": None if record["id"] is None else str(record["id"]),
+                "probabilities": None if record["probabilities"] is None else list(record["probabilities"].items())
+            }
+            for record in records
+        ]
+        part_path = os.path.join(self.path, f"part-{self.parts:05d}.parquet")
+        pq.write_table(pa.Table.from_pylist(rows, schema=self.schema), part_path + ".tmp")
+        os.replace(part_path + ".tmp", part_path)
+        self.parts += 1
+    
+    def commit(self):
+        return {"parts": self.parts}
+    
+    def close(self):
+        pass
+
+WRITERS = {"jsonl": JSONLWriter, "parquet": ParquetWriter}
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_checkpoint(path, checkpoint):
+    # Replace the checkpoint in one step, so a crash leaves either the old or the new one
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        json.dump(checkpoint, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+def moderate_bulk(input_path, output_path, checkpoint_path=None, input_format="auto", output_format="auto",
+                  text_column=None, id_column=None, delimiter=None, chunk_size=CHUNK_SIZE, batch_size=MAX_BATCH_MESSAGES,
+                  restart=False):
+    """
+    Moderate every row of input_path ("-" for stdin) and write one record per non-empty text message to output_path.
+    After every chunk the output is flushed and the checkpoint records how many rows were read and where the
+    output ends, so an interrupted run started again with the same arguments resumes after the last chunk.
+    """
+    if output_format == "auto":
+        output_format = "parquet" if output_path.endswith(".parquet") else "jsonl"
+    checkpoint_path = checkpoint_path or output_path.rstrip("/") + ".checkpoint.json"
+    
+    model = TextModerationLambda()
+    # Everything that changes the rows or their scores; a resumed run must match the checkpoint on all of it
+    settings = {
+        "input": input_path if input_path == "-" else os.path.abspath(input_path),
+        "input_format": input_format,
+        "text_column": text_column,
+        "id_column": id_column,
+        "delimiter": delimiter,
+        "chunk_size": chunk_size,
+        "output_format": output_format,
+        "model_version": model.model_version
+    }
+    
+    checkpoint = None if restart else load_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        if os.path.exists(output_path) and not restart:
+            raise SystemExit(f"{output_path} exists but has no checkpoint, pass --restart to overwrite it")
+        checkpoint = {"settings": settings, "rows_read": 0, "records_written": 0, "flagged": 0, "digest": "", "position": None, "done": False}
+    else:
+        changed = [key for key in settings if checkpoint["settings"].get(key) != settings[key]]
+        if changed:
+            raise SystemExit(f"Cannot resume from {checkpoint_path}, {', '.join(changed)} changed, pass --restart to start over")
+        if checkpoint["position"] and not os.path.exists(output_path):
+            raise SystemExit(f"Cannot resume, {output_path} is missing, pass --restart to start over")
+        if checkpoint["done"]:
+            print(f"{output_path} is complete: {checkpoint['records_written']} records from {checkpoint['rows_read']} rows")
+            return checkpoint
+        print(f"Resuming after row {checkpoint['rows_read']} from {checkpoint_path}")
+    
+    writer = WRITERS[output_format](output_path, checkpoint["position"])
+    start_time = time.perf_counter()
+    scored_rows = 0
+    try:
+        with open_input(input_path) as file:
+            chunks = iter_chunks(read_rows(file, input_path, input_format, text_column, id_column, delimiter), chunk_size)
+            
+            # Skip the checkpointed rows, checking they are the rows that were scored
+            digest, skipped = "", 0
+            while skipped < checkpoint["rows_read"]:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise SystemExit(f"Cannot resume, the input ends after {skipped} of the {checkpoint['rows_read']} checkpointed rows")
+                digest = chunk_digest(digest, chunk)
+                skipped += len(chunk)
+            if digest != checkpoint["digest"]:
+                raise SystemExit("Cannot resume, the input differs from the rows in the checkpoint, pass --restart to start over")
+            
+            for chunk in chunks:
+                records = score_chunk(model, chunk, checkpoint["rows_read"], batch_size)
+                writer.write(records)
+                checkpoint["position"] = writer.commit()
+                checkpoint["digest"] = chunk_digest(checkpoint["digest"], chunk)
+                checkpoint["rows_read"] += len(chunk)
+                checkpoint["records_written"] += len(records)
+                checkpoint["flagged"] += sum(record["is_flagged"] for record in records)
+                save_checkpoint(checkpoint_path, checkpoint)
+                
+                scored_rows += len(chunk)
+                elapsed = time.perf_counter() - start_time
+                print(f"{checkpoint['rows_read']} rows, {checkpoint['flagged']} flagged ({scored_rows / elapsed:.1f} rows/sec)")
+    finally:
+        writer.close()
+    
+    checkpoint["done"] = True
+    save_checkpoint(checkpoint_path, checkpoint)
+    skipped = checkpoint["rows_read"] - checkpoint["records_written"]
+    print(f"Wrote {checkpoint['records_written']} records to {output_path} ({checkpoint['flagged']} flagged, {skipped} empty or non-text rows skipped)")
+    return checkpoint
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moderate a CSV or JSONL file in batches, with checkpoints to resume an interrupted run")
+    parser.add_argument("input", nargs="?", default="-", help="CSV or JSONL file, - for stdin")
+    parser.add_argument("--output", "-o", required=True, help="JSONL file, or a Parquet dataset directory when it ends in .parquet")
+    parser.add_argument("--input-format", choices=["auto", "csv", "jsonl"], default="auto")
+    parser.add_argument("--output-format", choices=["auto", "jsonl", "parquet"], default="auto")
+    parser.add_argument("--text-column", help=f"Column or key holding the message, default the first of {', '.join(TEXT_COLUMNS)}")
+    parser.add_argument("--id-column", help="Column or key copied to the id field of every record")
+    parser.add_argument("--delimiter", help="CSV delimiter, guessed from the header by default")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows between checkpoints")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_MESSAGES)
+    parser.add_argument("--checkpoint", help="Checkpoint file, default <output>.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and overwrite the output")
+    args = parser.parse_args()
+    
+    moderate_bulk(
+        args.input, args.output, args.checkpoint, args.input_format, args.output_format,
+        args.text_column, args.id_column, args.delimiter, args.chunk_size, args.batch_size, args.restart
+    )
@@ -0,0 +1,141 @@
+import io
+import json
+import time
+import asyncio
+import argparse
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from orchestrator import HTTPModelClient, NotificationQueue, OpenAIModerationClient, Orchestrator
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the model endpoint (/model), the OpenAI moderation endpoint (/moderations) and the Slack
+    webhook (/slack). Every answer takes the path's latency; every slow_every-th request to a path takes
+    slow_factor times longer, the tail that hedged requests are meant to cut. Markers in a message script the
+    answers: @omax and @omin for OpenAI scores, @s3 and @s3low for model scores, @oerr and @merr for errors.
+    """
+    daemon_threads = True
+    
+    def __init__(self, latencies, slow_every=0, slow_factor=10):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latencies = latencies
+        self.slow_every = slow_every
+        self.slow_factor = slow_factor
+        self.lock = threading.Lock()
+        self.counts = {path: 0 for path in latencies}
+    
+    def handle_error(self, request, client_address):
+        # Hedged and timed-out requests are cancelled by closing their connection
+        pass
+    
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+    
+    def respond(self, path, body):
+        with self.lock:
+            self.counts[path] += 1
+            count = self.counts[path]
+        slow = self.slow_every and count % self.slow_every == 0
+        time.sleep(self.latencies[path] * (self.slow_factor if slow else 1))
+        
+        if path == "/model":
+            text = body["inputs"]
+            if "@merr" in text:
+                return 500, {"error": "model unavailable"}
+            if "@s3low" in text:
+                return 200, [{"label": "S3", "score": 0.4}]
+            if "@s3" in text:
+                return 200, [{"label": "S3", "score": 0.9}]
+            return 200, [{"label": "OK", "score": 0.95}]
+        if path == "/moderations":
+            text = body["input"]
+            if "@oerr" in text:
+                return 500, {"error": "moderation unavailable"}
+            score = 0.99 if "@omax" in text else 0.7 if "@omin" in text else 0.01
+            return 200, {"results": [{"categories": {"sexual/minors": score >= 0.5}, "category_scores": {"sexual/minors": score}}]}
+        return 200, {}
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the orchestration's pooled connections are reused
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        status, payload = self.server.respond(self.path, body)
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, format, *args):
+        pass
+
+def build_orchestrator(http, stubs, hedge_delay):
+    model = HTTPModelClient(http, stubs.url("/model"), "token", hedge_delay=hedge_delay)
+    external = OpenAIModerationClient(http, "key", url=stubs.url("/moderations"), hedge_delay=hedge_delay)
+    notifications = NotificationQueue(http, stubs.url("/slack"))
+    notifications.start()
+    return Orchestrator(model, external, notifications)
+
+async def timed(orchestrator, message):
+    start_time = time.perf_counter()
+    body = await orchestrator.moderate(message)
+    return body, time.perf_counter() - start_time
+
+async def run_load(stubs, requests, concurrency, hedge_delay):
+    """
+    Send requests messages from concurrency clients and return the latencies, the HTTP requests sent per
+    dependency call and the notifications dropped
+    """
+    import httpx
+    
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=2 * concurrency)) as http:
+        orchestrator = build_orchestrator(http, stubs, hedge_delay)
+        counter = iter(range(requests))
+        latencies = []
+        
+        async def client():
+            for _ in counter:
+                latencies.append((await timed(orchestrator, "both agree @omin @s3"))[1])
+        
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+            await orchestrator.notifications.flush(30)
+        await orchestrator.notifications.stop()
+        requests_per_call = (orchestrator.model.requests + orchestrator.external.requests) / (2 * requests)
+        return np.array(latencies), requests_per_call, orchestrator.notifications.dropped
+
+async def main(args):
+    latencies = {"/model": args.model_ms / 1000, "/moderations": args.external_ms / 1000, "/slack": args.slack_ms / 1000}
+    print(f"Stub latencies: model {args.model_ms} ms, external moderation {args.external_ms} ms, Slack {args.slack_ms} ms")
+    
+    # Every slow_every-th request to a dependency is slow_factor times slower
+    print(f"{args.requests} flagged messages from {args.concurrency} clients, every {args.slow_every}th dependency request {args.slow_factor}x slower:")
+    print(f"|{'Hedge delay':>12}|{'p50 ms':>8}|{'p90 ms':>8}|{'p99 ms':>8}|{'Requests per call':>18}|{'Notifications dropped':>22}|")
+    for hedge_delay in (0, args.hedge_ms / 1000):
+        stubs = StubServer(latencies, args.slow_every, args.slow_factor)
+        threading.Thread(target=stubs.serve_forever, daemon=True).start()
+        timings, requests_per_call, dropped = await run_load(stubs, args.requests, args.concurrency, hedge_delay)
+        stubs.shutdown()
+        p50, p90, p99 = np.percentile(timings * 1000, [50, 90, 99])
+        label = f"{hedge_delay * 1000:.0f} ms" if hedge_delay else "off"
+        print(f"|{label:>12}|{p50:>8.1f}|{p90:>8.1f}|{p99:>8.1f}|{requests_per_call:>18.2f}|{dropped:>22}|")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the concurrent orchestration against local stub dependencies")
+    parser.add_argument("--model-ms", type=float, default=80)
+    parser.add_argument("--external-ms", type=float, default=120)
+    parser.add_argument("--slack-ms", type=float, default=150)
+    parser.add_argument("--hedge-ms", type=float, default=200, help="Hedge delay compared against no hedging")
+    parser.add_argument("--slow-every", type=int, default=20)
+    parser.add_argument("--slow-factor", type=float, default=10)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    
+    asyncio.run(main(args))
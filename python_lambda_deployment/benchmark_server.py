@@ -0,0 +1,118 @@
+import os
+import csv
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from inference_server import InferenceServer, MicroBatcher, MICROBATCH_MAX_QUEUE
+
+async def send_request(reader, writer, message):
+    """
+    Send one moderation request on a keep-alive connection and return the status code
+    """
+    body = json.dumps({'message': message}).encode('utf-8')
+    writer.write(
+        f"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body
+    )
+    await writer.drain()
+    
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+async def generate_load(port, messages, concurrency, total_requests):
+    """
+    Send total_requests requests from concurrency clients, each waiting for its response before sending the next.
+    Returns the latencies of the successful requests, the number of rejected requests and the elapsed time.
+    """
+    latencies = []
+    rejected = 0
+    counter = iter(range(total_requests))
+    
+    async def client():
+        nonlocal rejected
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for i in counter:
+            start_time = time.perf_counter()
+            status = await send_request(reader, writer, messages[i % len(messages)])
+            if status == 200:
+                latencies.append(time.perf_counter() - start_time)
+            elif status == 429:
+                rejected += 1
+        writer.close()
+    
+    start_time = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, rejected, time.perf_counter() - start_time
+
+async def run_benchmark(model, messages, concurrency, total_requests, max_batch_size, max_wait_ms, max_queue, port):
+    batcher = MicroBatcher(model, max_batch_size, max_wait_ms, max_queue)
+    server = InferenceServer(batcher)
+    await server.start("127.0.0.1", port)
+    try:
+        # Warm up so the first forward pass is not counted
+        await generate_load(port, messages, 1, 2)
+        batcher.batches = batcher.batched_messages = 0
+        latencies, rejected, elapsed = await generate_load(port, messages, concurrency, total_requests)
+    finally:
+        await server.stop()
+    
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'requests': total_requests,
+        'rejected': rejected,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)) if len(latencies) else 0.0,
+        'p95_ms': float(np.percentile(latencies_ms, 95)) if len(latencies) else 0.0,
+        'p99_ms': float(np.percentile(latencies_ms, 99)) if len(latencies) else 0.0,
+        'average_batch_size': batcher.average_batch_size()
+    }
+
+def load_messages(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [row["message"].strip() for row in csv.DictReader(file, delimiter=';') if row.get("message") and row["message"].strip()]
+
+def main(args):
+    # Repeated messages would otherwise be answered from the result cache
+    os.environ.setdefault("RESULT_CACHE", "off")
+    from koala_lambda import TextModerationLambda
+    
+    model = TextModerationLambda()
+    messages = load_messages(args.file)
+    configurations = [
+        ("one-at-a-time", 1, 0),
+        ("micro-batched", args.max_batch_size, args.max_wait_ms)
+    ]
+    
+    rows = []
+    for name, max_batch_size, max_wait_ms in configurations:
+        stats = asyncio.run(run_benchmark(model, messages, args.concurrency, args.requests, max_batch_size, max_wait_ms, args.max_queue, args.port))
+        rows.append((name, max_batch_size, max_wait_ms, stats))
+    
+    print(f"\n{args.requests} requests from {args.concurrency} concurrent clients:")
+    print(f"|{'Mode':<15}|{'Batch':>6}|{'Wait ms':>8}|{'Avg batch':>10}|{'p50 ms':>9}|{'p95 ms':>9}|{'p99 ms':>9}|{'Req/sec':>9}|{'429s':>6}|")
+    for name, max_batch_size, max_wait_ms, stats in rows:
+        print(
+            f"|{name:<15}|{max_batch_size:>6}|{max_wait_ms:>8.1f}|{stats['average_batch_size']:>10.1f}"
+            f"|{stats['p50_ms']:>9.1f}|{stats['p95_ms']:>9.1f}|{stats['p99_ms']:>9.1f}|{stats['throughput']:>9.1f}|{stats['rejected']:>6}|"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare micro-batched and one-at-a-time serving under concurrent load")
+    parser.add_argument("--file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_cases.csv"))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--max-queue", type=int, default=MICROBATCH_MAX_QUEUE)
+    parser.add_argument("--port", type=int, default=8181)
+    main(parser.parse_args())
@@ -0,0 +1,76 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+
+def load_messages(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [row["message"].strip() for row in csv.DictReader(file, delimiter=';') if row.get("message") and row["message"].strip()]
+
+def time_requests(messages, batch_size, tokenize, run_model):
+    """
+    Time tokenization and the forward pass separately for every batch of messages, in milliseconds
+    """
+    tokenize_ms = []
+    model_ms = []
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start:start + batch_size]
+        start_time = time.perf_counter()
+        inputs = tokenize(batch)
+        tokenized = time.perf_counter()
+        run_model(inputs)
+        tokenize_ms.append((tokenized - start_time) * 1000)
+        model_ms.append((time.perf_counter() - tokenized) * 1000)
+    return np.array(tokenize_ms), np.array(model_ms)
+
+def benchmark_tokenization(file_path, batch_sizes):
+    """
+    Report the share of end-to-end latency spent in tokenization, for the previous per-call tokenizer
+    path padded to max_length and for the shared TokenCache before and after its cache is warm
+    """
+    os.environ["RESULT_CACHE"] = "off"
+    from koala_lambda import TextModerationLambda
+    from tokenization import TokenCache
+    import torch
+    
+    model = TextModerationLambda("torch")
+    messages = load_messages(file_path)
+    
+    def run_model(inputs):
+        with torch.no_grad():
+            return model.forward(inputs)
+    
+    def padded_tokenize(batch):
+        return model.tokenizer(batch, return_tensors="pt", truncation=True, padding="max_length", max_length=model.MAX_LENGTH)
+    
+    paths = [
+        ("max_length padding", lambda: padded_tokenize),
+        ("TokenCache, cold", lambda: TokenCache(model.tokenizer, model.MAX_LENGTH)),
+        ("TokenCache, warm", None)
+    ]
+    
+    # Warm up the model so the first forward pass is not counted
+    run_model(padded_tokenize(messages[:2]))
+    
+    print(f"Tokenization share of end-to-end latency on {len(messages)} messages ({model.tokenizer.__class__.__name__}):")
+    print(f"|{'Path':<20}|{'Batch':>6}|{'Tokenize ms':>12}|{'Model ms':>10}|{'Total ms':>10}|{'Share':>7}|")
+    for batch_size in batch_sizes:
+        tokens = None
+        for name, make in paths:
+            if make is not None:
+                tokens = make()
+            tokenize_ms, model_ms = time_requests(messages, batch_size, tokens, run_model)
+            total_ms = tokenize_ms.sum() + model_ms.sum()
+            print(
+                f"|{name:<20}|{batch_size:>6}|{tokenize_ms.mean():>12.3f}|{model_ms.mean():>10.3f}"
+                f"|{total_ms / len(tokenize_ms):>10.3f}|{tokenize_ms.sum() / total_ms * 100:>6.1f}%|"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the tokenization share of end-to-end latency")
+    parser.add_argument("--file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_cases.csv"))
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 32])
+    args = parser.parse_args()
+    
+    benchmark_tokenization(args.file, args.batch_size)
@@ -0,0 +1,61 @@
+import os
+import csv
+import sys
+import argparse
+from koala_lambda import TextModerationLambda
+
+def load_messages(file_path):
+    """
+    Load the non-empty messages from a ;-delimited test cases CSV
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        reader = csv.DictReader(file, delimiter=';')
+        return [row["message"].strip() for row in reader if row.get("message") and row["message"].strip()]
+
+def score(model, messages, batch_size):
+    """
+    Return the S3 probability (in percent) the backend computes for every message. The model output is
+    compared directly: predict_batch would answer some messages from the pre-filter, the cascade or a cache,
+    which never reach the backend under test.
+    """
+    probabilities = []
+    for start in range(0, len(messages), batch_size):
+        rows = model.compute_probabilities(messages[start:start + batch_size])
+        probabilities.extend(float(row[model.S3_INDEX]) * 100 for row in rows)
+    return probabilities
+
+def compare_backends(file_path, backend, tolerance, batch_size=16):
+    """
+    Compare the S3 probabilities of an ONNX backend against the torch backend.
+    Returns True when every probability is within tolerance percentage points.
+    """
+    messages = load_messages(file_path)
+    print(f"Comparing {backend} against torch on {len(messages)} messages from {file_path}")
+    
+    reference = TextModerationLambda(backend="torch")
+    candidate = TextModerationLambda(backend=backend)
+    reference_probabilities = score(reference, messages, batch_size)
+    candidate_probabilities = score(candidate, messages, batch_size)
+    
+    threshold = reference.THRESHOLD * 100
+    differences = [abs(a - b) for a, b in zip(reference_probabilities, candidate_probabilities)]
+    flips = sum(1 for a, b in zip(reference_probabilities, candidate_probabilities) if (a >= threshold) != (b >= threshold))
+    max_difference = max(differences) if differences else 0
+    mean_difference = sum(differences) / len(differences) if differences else 0
+    
+    print(f"Max S3 difference:  {max_difference:.4f} percentage points")
+    print(f"Mean S3 difference: {mean_difference:.4f} percentage points")
+    print(f"Decision flips:     {flips}")
+    
+    within_tolerance = max_difference <= tolerance
+    print(f"{'PASS' if within_tolerance else 'FAIL'}: tolerance {tolerance} percentage points")
+    return within_tolerance
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check ONNX backend S3 probabilities against the torch backend")
+    parser.add_argument("--backend", default="onnx-int8", choices=["onnx", "onnx-int8"])
+    parser.add_argument("--tolerance", type=float, default=2.0, help="Maximum allowed S3 difference in percentage points")
+    parser.add_argument("--file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_cases.csv"))
+    args = parser.parse_args()
+    
+    sys.exit(0 if compare_backends(args.file, args.backend, args.tolerance) else 1)
@@ -0,0 +1,174 @@
+import os
+import csv
+import glob
+import time
+import argparse
+import numpy as np
+from koala_lambda import TextModerationLambda
+from student import STUDENT_BUCKETS, StudentModel, student_features
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Labels whose messages should be blocked, see RESULT_MAPPING in koala.py
+BLOCK_LABELS = ('TP', 'FN')
+PASS_LABELS = ('TN', 'FP')
+
+# Uncertainty bands compared in the cascade report, around the threshold (as fractions)
+REPORT_BANDS = [0.05, 0.10, 0.15, 0.20, 0.30]
+
+def load_corpus(file_paths):
+    """
+    Load the unique non-empty messages of ;-delimited CSV files
+    """
+    messages = {}
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for row in csv.DictReader(file, delimiter=';'):
+                if row.get("message") and row["message"].strip():
+                    messages.setdefault(row["message"].strip(), None)
+    return list(messages)
+
+def load_labelled(file_path):
+    """
+    Load the messages of a test cases CSV with a known label, and whether each should be blocked
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        rows = [
+            (row["message"].strip(), row["result"] in BLOCK_LABELS)
+            for row in csv.DictReader(file, delimiter=';')
+            if row.get("message") and row["message"].strip() and row.get("result") in BLOCK_LABELS + PASS_LABELS
+        ]
+    return [message for message, _ in rows], np.array([label for _, label in rows])
+
+def teacher_logits(model, messages, batch_size=32):
+    """
+    Score messages with the full model and return their S3 logits
+    """
+    order = sorted(range(len(messages)), key=lambda i: len(messages[i]))
+    probabilities = np.zeros(len(messages))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        probabilities[batch] = model.compute_probabilities([messages[i] for i in batch])[:, model.S3_INDEX]
+    probabilities = np.clip(probabilities, 1e-6, 1 - 1e-6)
+    return np.log(probabilities) - np.log1p(-probabilities)
+
+def train_student(messages, logits, buckets=STUDENT_BUCKETS, epochs=40, batch_size=64, learning_rate=0.05, seed=0):
+    """
+    Fit the student to the teacher's S3 probabilities with a soft-target cross-entropy loss
+    """
+    import torch
+    import torch.nn.functional as F
+    
+    torch.manual_seed(seed)
+    features = [student_features(message, buckets) for message in messages]
+    targets = torch.sigmoid(torch.tensor(logits, dtype=torch.float32))
+    
+    # An EmbeddingBag with one output is a linear model over sparse hashed features
+    bag = torch.nn.EmbeddingBag(buckets, 1, mode='sum')
+    torch.nn.init.zeros_(bag.weight)
+    bias = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.Adam(list(bag.parameters()) + [bias], lr=learning_rate)
+    
+    for epoch in range(epochs):
+        order = torch.randperm(len(messages)).tolist()
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            indices = torch.tensor([index for i in batch for index in features[i][0]])
+            values = torch.tensor([value for i in batch for value in features[i][1]], dtype=torch.float32)
+            offsets = torch.tensor([0] + list(np.cumsum([len(features[i][0]) for i in batch[:-1]])))
+            
+            student_logits = bag(indices, offsets, per_sample_weights=values).squeeze(1) + bias
+            loss = F.binary_cross_entropy_with_logits(student_logits, targets[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    
+    return StudentModel(bag.weight.detach().numpy()[:, 0].copy(), bias.item(), buckets)
+
+def out_of_fold_probabilities(messages, logits, test_messages, folds=5, **train_args):
+    """
+    Student probabilities for the test messages, each from a student that never saw it.
+    Every fold's student is trained on the whole corpus except that fold's test messages.
+    """
+    fold_of = {message: i % folds for i, message in enumerate(test_messages)}
+    probabilities = np.zeros(len(test_messages))
+    for fold in range(folds):
+        train = [i for i, message in enumerate(messages) if fold_of.get(message) != fold]
+        student = train_student([messages[i] for i in train], logits[train], **train_args)
+        held_out = [i for i, message in enumerate(test_messages) if fold_of[message] == fold]
+        probabilities[held_out] = student.probabilities([test_messages[i] for i in held_out])
+        print(f"Fold {fold + 1}/{folds}: trained on {len(train)} messages, scored {len(held_out)} held-out messages")
+    return probabilities
+
+def time_per_message(score, messages):
+    """
+    Time scoring each message on its own, the way the Lambda scores single-message requests
+    """
+    timings = np.zeros(len(messages))
+    for i, message in enumerate(messages):
+        start_time = time.perf_counter()
+        score([message])
+        timings[i] = time.perf_counter() - start_time
+    return timings
+
+def cascade_report(model, student_probabilities, teacher_probabilities, labels, student_times, teacher_times, bands):
+    """
+    Print the escalation rate, accuracy and speedup of the cascade for each uncertainty band
+    """
+    threshold = model.THRESHOLD
+    teacher_blocks = teacher_probabilities >= threshold
+    teacher_accuracy = np.mean(teacher_blocks == labels) * 100
+    teacher_time = teacher_times.sum()
+    
+    print(f"\nCascade on {len(labels)} labelled messages (threshold {threshold * 100:.1f}%):")
+    print(f"Full model only: accuracy {teacher_accuracy:.2f}%, {teacher_time / len(labels) * 1000:.1f} ms per message")
+    print(f"Student only:    accuracy {np.mean((student_probabilities >= threshold) == labels) * 100:.2f}%, "
+          f"{student_times.mean() * 1000:.2f} ms per message")
+    print(f"|{'Band':>7}|{'Escalated':>10}|{'Accuracy':>9}|{'Delta':>7}|{'Agreement':>10}|{'ms/msg':>8}|{'Speedup':>8}|")
+    for band in bands:
+        escalate = np.abs(student_probabilities - threshold) < band
+        blocks = np.where(escalate, teacher_blocks, student_probabilities >= threshold)
+        accuracy = np.mean(blocks == labels) * 100
+        cascade_time = student_times.sum() + teacher_times[escalate].sum()
+        print(
+            f"|{band * 100:>6.1f}%|{escalate.mean() * 100:>9.1f}%|{accuracy:>8.2f}%|{accuracy - teacher_accuracy:>+7.2f}"
+            f"|{np.mean(blocks == teacher_blocks) * 100:>9.1f}%|{cascade_time / len(labels) * 1000:>8.2f}|{teacher_time / cascade_time:>7.2f}x|"
+        )
+
+def distill_student(corpus_files, test_file, output_path, bands, folds=5, epochs=40):
+    # The student is distilled from the deployed model, the one escalated messages are sent to
+    os.environ["RESULT_CACHE"] = "off"
+    os.environ["CASCADE"] = "off"
+    model = TextModerationLambda()
+    
+    messages = load_corpus(corpus_files)
+    print(f"Scoring {len(messages)} unique messages from {len(corpus_files)} files with the full model...")
+    logits = teacher_logits(model, messages)
+    
+    student = train_student(messages, logits, epochs=epochs)
+    student.save(output_path)
+    print(f"Saved student to {output_path}")
+    
+    # Report on held-out student scores only, so the accuracy is not inflated by memorized messages
+    test_messages, labels = load_labelled(test_file)
+    student_probabilities = out_of_fold_probabilities(messages, logits, test_messages, folds, epochs=epochs)
+    known = dict(zip(messages, logits))
+    missing = [message for message in test_messages if message not in known]
+    known.update(zip(missing, teacher_logits(model, missing)))
+    teacher_probabilities = 1 / (1 + np.exp(-np.array([known[message] for message in test_messages])))
+    
+    student_times = time_per_message(student.probabilities, test_messages)
+    teacher_times = time_per_message(model.compute_probabilities, test_messages)
+    cascade_report(model, student_probabilities, teacher_probabilities, labels, student_times, teacher_times, bands)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill a hashed n-gram student from the S3 logits of the full model")
+    parser.add_argument("--corpus", nargs="+", default=sorted(glob.glob(os.path.join(BASE_DIR, "*.csv"))))
+    parser.add_argument("--test-file", default=os.path.join(BASE_DIR, "test_cases.csv"))
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "student.npz"))
+    parser.add_argument("--band", type=float, nargs="+", default=REPORT_BANDS)
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--epochs", type=int, default=40)
+    args = parser.parse_args()
+    
+    distill_student(args.corpus, args.test_file, args.output, args.band, args.folds, args.epochs)
@@ -0,0 +1,228 @@
+import os
+from student import student_features
+
+# Dimensions of the dense hashed n-gram embeddings, see student.student_features
+EMBEDDING_DIMENSIONS = 1024
+
+def embed(texts, dimensions=EMBEDDING_DIMENSIONS):
+    """
+    Embed texts as L2-normalized vectors of hashed word and character n-grams, one row per text.
+    Resends with other casing or punctuation, or a few changed words, keep most of their n-grams,
+    so their embeddings stay close in cosine similarity.
+    """
+    import numpy as np
+    
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for i, text in enumerate(texts):
+        indices, values = student_features(text, dimensions)
+        vectors[i, indices] = values
+    return vectors
+
+class VectorIndex:
+    """
+    Fixed-capacity index of unit vectors searched by inner product, evicting the least recently used vector when full.
+    With partitions > 0 the vectors are clustered by spherical k-means once the index holds 32 vectors per
+    partition (IVF). Every partition then keeps its vectors in one contiguous matrix, and a search only scans
+    the probes partitions whose centroids are closest to the query.
+    """
+    def __init__(self, capacity, dimensions, partitions=0, probes=4, seed=0):
+        import numpy as np
+        
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.values = [None] * capacity
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.clock = 0
+        self.partitions = partitions
+        self.probes = probes
+        self.seed = seed
+        
+        # IVF state, set by train: centroids, the mean subtracted before clustering, and per partition
+        # a matrix of vectors with the slots they belong to. assignments and positions locate a slot's vector.
+        self.centroids = None
+        self.mean = None
+        self.lists = []
+        self.members = []
+        self.counts = []
+        self.assignments = np.full(capacity, -1, dtype=np.int64)
+        self.positions = np.zeros(capacity, dtype=np.int64)
+    
+    def search(self, query):
+        """
+        Return the slot of the vector most similar to query and its cosine similarity, or (None, -1.0)
+        """
+        import numpy as np
+        
+        if self.centroids is None:
+            if not self.size:
+                return None, -1.0
+            similarities = self.vectors[:self.size] @ query
+            best = int(similarities.argmax())
+            return best, float(similarities[best])
+        
+        best_slot, best_similarity = None, -1.0
+        for partition in np.argsort(self.centroids @ (query - self.mean))[-self.probes:]:
+            count = self.counts[partition]
+            if not count:
+                continue
+            similarities = self.lists[partition][:count] @ query
+            best = int(similarities.argmax())
+            if similarities[best] > best_similarity:
+                best_slot, best_similarity = int(self.members[partition][best]), float(similarities[best])
+        return best_slot, best_similarity
+    
+    def touch(self, slot):
+        self.clock += 1
+        self.last_used[slot] = self.clock
+    
+    def add(self, vector, value):
+        """
+        Store a vector and its value, replacing the least recently used entry when the index is full
+        """
+        if self.size < len(self.values):
+            slot = self.size
+            self.size += 1
+        else:
+            slot = int(self.last_used.argmin())
+            if self.centroids is not None:
+                self.remove(slot)
+        self.values[slot] = value
+        self.touch(slot)
+        
+        if self.centroids is not None:
+            self.append(int((self.centroids @ (vector - self.mean)).argmax()), slot, vector)
+            return slot
+        
+        self.vectors[slot] = vector
+        if self.partitions and self.size >= self.partitions * 32:
+            self.train()
+        return slot
+    
+    def append(self, partition, slot, vector):
+        import numpy as np
+        
+        count = self.counts[partition]
+        if count == len(self.members[partition]):
+            # Grow the partition's matrix geometrically, so appends stay amortized constant time
+            grown = max(2 * count, 32)
+            self.lists[partition] = np.resize(self.lists[partition], (grown, self.lists[partition].shape[1]))
+            self.members[partition] = np.resize(self.members[partition], grown)
+        self.lists[partition][count] = vector
+        self.members[partition][count] = slot
+        self.assignments[slot] = partition
+        self.positions[slot] = count
+        self.counts[partition] = count + 1
+    
+    def remove(self, slot):
+        # Move the partition's last vector into the freed position
+        partition, position = self.assignments[slot], self.positions[slot]
+        last = self.counts[partition] - 1
+        moved = self.members[partition][last]
+        self.lists[partition][position] = self.lists[partition][last]
+        self.members[partition][position] = moved
+        self.positions[moved] = position
+        self.counts[partition] = last
+    
+    def train(self, iterations=10):
+        """
+        Cluster the stored vectors into partitions with spherical k-means and move every vector to the list of
+        its closest centroid. The vectors are centered first: hashed n-gram vectors share their common n-grams,
+        and uncentered clusters collapse into a few large partitions.
+        """
+        import numpy as np
+        
+        vectors = self.vectors[:self.size]
+        self.mean = vectors.mean(axis=0)
+        centered = vectors - self.mean
+        centered /= np.maximum(np.linalg.norm(centered, axis=1, keepdims=True), 1e-12)
+        
+        random_state = np.random.RandomState(self.seed)
+        centroids = centered[random_state.choice(self.size, self.partitions, replace=False)]
+        for _ in range(iterations):
+            assignments = (centered @ centroids.T).argmax(axis=1)
+            for partition in range(self.partitions):
+                total = centered[assignments == partition].sum(axis=0)
+                norm = np.linalg.norm(total)
+                if norm > 0:
+                    centroids[partition] = total / norm
+        self.centroids = centroids
+        
+        assignments = (centered @ centroids.T).argmax(axis=1)
+        for partition in range(self.partitions):
+            slots = np.flatnonzero(assignments == partition)
+            self.lists.append(vectors[slots].copy())
+            self.members.append(slots)
+            self.counts.append(len(slots))
+            self.assignments[slots] = partition
+            self.positions[slots] = np.arange(len(slots))
+        # The vectors now live in the partition lists
+        self.vectors = None
+
+class EmbeddingCache:
+    """
+    Nearest-neighbour cache of model outputs for lightly edited resends, which miss the exact-hash result cache.
+    A message whose embedding is within radius (cosine similarity) of a cached message reuses that message's
+    category probabilities, provided they are at least margin away from every policy threshold.
+    Entries live in the model instance, so they never outlive the model version that produced them.
+    """
+    def __init__(self, max_entries=5000, radius=0.95, margin=0.25, partitions=0, probes=4, dimensions=EMBEDDING_DIMENSIONS):
+        self.index = VectorIndex(max_entries, dimensions, partitions, probes)
+        self.radius = radius
+        self.margin = margin
+        self.dimensions = dimensions
+        self.hits = 0
+        self.misses = 0
+    
+    @classmethod
+    def from_environment(cls):
+        """
+        Build the cache configured through the EMBEDDING_CACHE* environment variables.
+        Returns None when EMBEDDING_CACHE is "off".
+        """
+        if os.environ.get("EMBEDDING_CACHE", "off") == "off":
+            return None
+        return cls(
+            int(os.environ.get("EMBEDDING_CACHE_SIZE", 5000)),
+            float(os.environ.get("EMBEDDING_CACHE_RADIUS", 0.95)),
+            float(os.environ.get("EMBEDDING_CACHE_MARGIN", 0.25)),
+            int(os.environ.get("EMBEDDING_CACHE_PARTITIONS", 0)),
+            int(os.environ.get("EMBEDDING_CACHE_PROBES", 4))
+        )
+    
+    def lookup(self, texts, policy):
+        """
+        Return the reusable probabilities of each text, None when it has no confident neighbour,
+        and the embeddings of the texts for add
+        """
+        embeddings = embed(texts, self.dimensions)
+        neighbours = [self.index.search(embedding) for embedding in embeddings]
+        close = [i for i, (slot, similarity) in enumerate(neighbours) if similarity >= self.radius]
+        
+        rows = [None] * len(texts)
+        if close:
+            candidates = [self.index.values[neighbours[i][0]] for i in close]
+            for i, row, confident in zip(close, candidates, policy.confident(candidates, self.margin)):
+                if confident:
+                    self.index.touch(neighbours[i][0])
+                    rows[i] = row
+        
+        hits = sum(row is not None for row in rows)
+        self.hits += hits
+        self.misses += len(texts) - hits
+        return rows, embeddings
+    
+    def add(self, embeddings, rows):
+        for embedding, row in zip(embeddings, rows):
+            self.index.add(embedding, row)
+    
+    def stats(self):
+        """
+        Return the hit and miss counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self.index.size
+        }
@@ -1,8 +1,252 @@
 import os
+import csv
+import json
+import shutil
+import argparse
+import inspect
 import torch
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
-def export_model():
+# Category order of the classification head, see fine_tune_koala.CATEGORIES
+CATEGORIES = ['S', 'H', 'V', 'HR', 'SH', 'S3', 'H2', 'V2', 'OK']
+
+# Precisions the torch weights can be saved in, the ONNX graphs are always exported from float32
+DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16
+}
+
+# Labels whose messages should be blocked, see RESULT_MAPPING in koala.py
+BLOCK_LABELS = ('TP', 'FN')
+PASS_LABELS = ('TN', 'FP')
+
+def classifier_layer(model):
+    """
+    Find the output projection of the classification head, the last Linear layer with one output per label.
+    Returns the module holding it and its attribute name.
+    """
+    found = None
+    for name, module in model.named_modules():
+        for child_name, child in module.named_children():
+            if isinstance(child, torch.nn.Linear) and child.out_features == model.config.num_labels:
+                found = (module, child_name)
+    if found is None:
+        raise ValueError("No classification head with one output per label found")
+    return found
+
+def slice_classifier(model, active_categories):
+    """
+    Keep only the rows of the classification head for active_categories,
+    and declare them in the config so the inference code knows which logits it gets
+    """
+    parent, name = classifier_layer(model)
+    layer = getattr(parent, name)
+    rows = [CATEGORIES.index(category) for category in active_categories]
+    
+    sliced = torch.nn.Linear(layer.in_features, len(rows), bias=layer.bias is not None)
+    with torch.no_grad():
+        sliced.weight.copy_(layer.weight[rows])
+        if layer.bias is not None:
+            sliced.bias.copy_(layer.bias[rows])
+    setattr(parent, name, sliced)
+    
+    model.config.num_labels = len(rows)
+    model.config.id2label = {i: category for i, category in enumerate(active_categories)}
+    model.config.label2id = {category: i for i, category in enumerate(active_categories)}
+    model.config.problem_type = "multi_label_classification"
+    model.config.active_categories = list(active_categories)
+
+def prune_layers(model, count):
+    """
+    Drop the top count transformer layers of the encoder
+    """
+    encoder = model.base_model.encoder
+    if count >= len(encoder.layer):
+        raise ValueError(f"Cannot prune {count} of {len(encoder.layer)} layers")
+    encoder.layer = encoder.layer[:len(encoder.layer) - count]
+    model.config.num_hidden_layers = len(encoder.layer)
+
+def s3_index(model):
+    """
+    Column of the S3 logit in the model output
+    """
+    return getattr(model.config, 'active_categories', CATEGORIES).index('S3')
+
+def prune_heads(model, heads):
+    """
+    Drop attention heads, given as {layer: [heads]}, where the architecture supports it
+    """
+    try:
+        model.prune_heads({int(layer): layer_heads for layer, layer_heads in heads.items()})
+    except (AttributeError, NotImplementedError):
+        raise ValueError(f"{type(model).__name__} does not support attention head pruning, prune layers instead")
+
+# Execution modes of the torch backend that export_model.py can write artifacts for, see koala_lambda.TORCH_MODES
+TORCH_ARTIFACT_MODES = ("torchscript", "compile")
+
+# Messages written to calibration.json for the TORCH_MODE=auto self-check, and per forward pass when tracing and compiling
+CALIBRATION_MESSAGES = 32
+CALIBRATION_BATCH_SIZE = 8
+
+class LogitsOnly(torch.nn.Module):
+    """
+    Return only the logits, so the traced graph takes two tensors and returns one
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+def load_labelled(file_path):
+    """
+    Load the messages of a test cases CSV with a known label, and whether each should be blocked
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        rows = [
+            (row["message"].strip(), row["result"] in BLOCK_LABELS)
+            for row in csv.DictReader(file, delimiter=';')
+            if row.get("message") and row["message"].strip() and row.get("result") in BLOCK_LABELS + PASS_LABELS
+        ]
+    return [message for message, _ in rows], [label for _, label in rows]
+
+def s3_probabilities(model, tokenizer, messages, batch_size=32, max_length=256):
+    """
+    Return the S3 probability (as a fraction) of every message
+    """
+    column = s3_index(model)
+    model.eval()
+    probabilities = []
+    with torch.no_grad():
+        for start in range(0, len(messages), batch_size):
+            inputs = tokenizer(messages[start:start + batch_size], return_tensors="pt", truncation=True, padding=True, max_length=max_length)
+            probabilities.extend(torch.sigmoid(model(**inputs).logits[:, column].float()).tolist())
+    return probabilities
+
+def check_accuracy(original, exported, tokenizer, file_path, threshold, max_accuracy_drop):
+    """
+    Compare the S3 decisions of the exported model with the original one on a labelled test cases CSV.
+    Raises ValueError when the accuracy drops by more than max_accuracy_drop percentage points.
+    """
+    messages, labels = load_labelled(file_path)
+    reference = s3_probabilities(original, tokenizer, messages)
+    candidate = s3_probabilities(exported, tokenizer, messages)
+    
+    def accuracy(probabilities):
+        return sum((probability >= threshold) == label for probability, label in zip(probabilities, labels)) / len(labels) * 100
+    
+    reference_accuracy = accuracy(reference)
+    candidate_accuracy = accuracy(candidate)
+    max_difference = max(abs(a - b) for a, b in zip(reference, candidate)) * 100
+    flips = sum(1 for a, b in zip(reference, candidate) if (a >= threshold) != (b >= threshold))
+    
+    print(f"Accuracy check on {len(messages)} labelled messages from {file_path}:")
+    print(f"Original accuracy:  {reference_accuracy:.2f}%")
+    print(f"Exported accuracy:  {candidate_accuracy:.2f}%")
+    print(f"Max S3 difference:  {max_difference:.4f} percentage points")
+    print(f"Decision flips:     {flips}")
+    
+    if reference_accuracy - candidate_accuracy > max_accuracy_drop:
+        raise ValueError(f"Exported model loses {reference_accuracy - candidate_accuracy:.2f} accuracy points, more than {max_accuracy_drop}")
+
+def export_onnx(model, tokenizer, onnx_path):
+    """
+    Export the model to an ONNX graph with dynamic batch and sequence axes
+    """
+    print(f"Exporting ONNX model to {onnx_path}")
+    model.eval()
+    sample = tokenizer(["This is a test message"], return_tensors="pt")
+    
+    # Newer torch exports with dynamo by default, whose graphs quantize_dynamic cannot infer shapes for
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(
+        model,
+        (sample["input_ids"], sample["attention_mask"]),
+        onnx_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"}
+        },
+        opset_version=14,
+        do_constant_folding=True,
+        **options
+    )
+
+def quantize_onnx(onnx_path, quantized_path):
+    """
+    Write a dynamically INT8-quantized copy of an ONNX graph
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    
+    print(f"Quantizing ONNX model to {quantized_path}")
+    quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+
+def write_calibration(file_path, calibration_path, count=CALIBRATION_MESSAGES):
+    """
+    Write count messages of a test cases CSV, spread evenly over the message lengths,
+    so the self-check sees short and long inputs
+    """
+    messages, _ = load_labelled(file_path)
+    messages = sorted(set(messages), key=len)
+    step = max(len(messages) / count, 1)
+    selected = [messages[int(i * step)] for i in range(min(count, len(messages)))]
+    print(f"Writing {len(selected)} calibration messages to {calibration_path}")
+    with open(calibration_path, 'w', encoding='utf-8') as file:
+        json.dump({'source': os.path.basename(file_path), 'messages': selected}, file, indent=4)
+    return selected
+
+def calibration_batches(tokenizer, messages, max_length=256):
+    # A single message first, batches of one get their own specialization in traced and compiled graphs
+    batches = [messages[:1]] + [messages[start:start + CALIBRATION_BATCH_SIZE] for start in range(0, len(messages), CALIBRATION_BATCH_SIZE)]
+    return [tokenizer(batch, return_tensors="pt", truncation=True, padding=True, max_length=max_length) for batch in batches]
+
+def max_logit_difference(model, forward, batches):
+    """
+    Largest difference, in percentage points, between the sigmoid outputs of model and forward
+    """
+    with torch.inference_mode():
+        return max(
+            float((torch.sigmoid(model(**inputs).logits.float()) - torch.sigmoid(forward(inputs).float())).abs().max()) * 100
+            for inputs in batches
+        )
+
+def export_torchscript(model_dir, tokenizer, torchscript_path, messages):
+    """
+    Trace the saved model with eager attention into a frozen TorchScript module. The fused attention paths
+    skip the mask for unpadded batches, a branch a trace would bake in; the eager one has no such branch.
+    """
+    print(f"Tracing TorchScript model to {torchscript_path}")
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir, torch_dtype="auto", attn_implementation="eager").eval()
+    batches = calibration_batches(tokenizer, messages)
+    # Trace on a padded batch, so the attention mask is part of the graph
+    sample = max(batches, key=lambda inputs: int((inputs["attention_mask"] == 0).sum()))
+    with torch.inference_mode():
+        traced = torch.jit.trace(LogitsOnly(model), (sample["input_ids"], sample["attention_mask"]))
+    traced = torch.jit.freeze(traced.eval())
+    torch.jit.save(traced, torchscript_path)
+    
+    difference = max_logit_difference(model, lambda inputs: traced(inputs["input_ids"], inputs["attention_mask"]), batches)
+    print(f"Max TorchScript difference: {difference:.6f} percentage points")
+
+def export_compile_cache(model_dir, tokenizer, cache_dir, messages):
+    """
+    Compile the saved model with torch.compile on the calibration batches, keeping the TorchInductor cache in cache_dir.
+    The cache only serves the same torch version on the same CPU, so export in the image that serves the model.
+    """
+    print(f"Compiling the model into {cache_dir}")
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir, torch_dtype="auto").eval()
+    compiled = torch.compile(model, dynamic=True)
+    difference = max_logit_difference(model, lambda inputs: compiled(**inputs).logits, calibration_batches(tokenizer, messages))
+    print(f"Max torch.compile difference: {difference:.6f} percentage points")
+
+def export_model(active_categories=None, pruned_layers=0, pruned_heads=None, check_file=None, max_accuracy_drop=1.0,
+                 dtype="float32", output_dir="models", torch_modes=(), onnx=False):
     # Load the model and tokenizer
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     model_name = os.path.join(base_dir, "models", "text_moderation_model_20241204_221216")
@@ -13,20 +257,84 @@ def export_model():
     print(f"Loading tokenizer from {tokenizer_name}")
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
     
+    # Specialize the serving model to the categories that are actually used
+    if active_categories and 'S3' not in active_categories:
+        raise ValueError("The active categories must include S3, the category the Lambda decides on")
+    if active_categories or pruned_layers or pruned_heads or dtype != "float32":
+        import copy
+        
+        original = copy.deepcopy(model)
+        if active_categories:
+            print(f"Slicing the classification head to {', '.join(active_categories)}")
+            slice_classifier(model, active_categories)
+        if pruned_layers:
+            print(f"Pruning the top {pruned_layers} layers")
+            prune_layers(model, pruned_layers)
+        if pruned_heads:
+            print(f"Pruning attention heads {pruned_heads}")
+            prune_heads(model, pruned_heads)
+        
+        threshold = 0.60
+        threshold_file = os.path.join(base_dir, "threshold.json")
+        if os.path.exists(threshold_file):
+            with open(threshold_file, 'r', encoding='utf-8') as file:
+                threshold = json.load(file)['threshold']
+        exported = copy.deepcopy(model).to(DTYPES[dtype]) if dtype != "float32" else model
+        check_accuracy(original, exported, tokenizer, check_file or os.path.join(base_dir, "test_cases.csv"), threshold, max_accuracy_drop)
+    
     # Create output directories
-    os.makedirs("models", exist_ok=True)
-    model_output_dir = os.path.join("models", "model")
-    tokenizer_output_dir = os.path.join("models", "tokenizer")
+    os.makedirs(output_dir, exist_ok=True)
+    model_output_dir = os.path.join(output_dir, "model")
+    tokenizer_output_dir = os.path.join(output_dir, "tokenizer")
     os.makedirs(model_output_dir, exist_ok=True)
     os.makedirs(tokenizer_output_dir, exist_ok=True)
     
-    # Save the model and tokenizer
-    print(f"Saving model to {model_output_dir}")
-    model.save_pretrained(model_output_dir)
+    # Save the model and tokenizer, the torch weights as safetensors in the serving precision
+    print(f"Saving {dtype} model to {model_output_dir}")
+    if dtype != "float32":
+        import copy
+        
+        copy.deepcopy(model).to(DTYPES[dtype]).save_pretrained(model_output_dir, safe_serialization=True)
+    else:
+        model.save_pretrained(model_output_dir, safe_serialization=True)
     print(f"Saving tokenizer to {tokenizer_output_dir}")
     tokenizer.save_pretrained(tokenizer_output_dir)
     
+    # Export the ONNX graphs used by the onnx and onnx-int8 inference backends, from the float32 model
+    if onnx:
+        onnx_path = os.path.join(output_dir, "model.onnx")
+        export_onnx(model, tokenizer, onnx_path)
+        quantize_onnx(onnx_path, os.path.join(output_dir, "model.int8.onnx"))
+    
+    # Ship the decision threshold chosen by the evaluation sweep in koala.py
+    threshold_file = os.path.join(base_dir, "threshold.json")
+    if os.path.exists(threshold_file):
+        print(f"Copying threshold from {threshold_file}")
+        shutil.copy(threshold_file, os.path.join(output_dir, "threshold.json"))
+    
+    # Calibration messages and the artifacts of the torch execution modes, so TORCH_MODE does not trace
+    # or compile on a cold start
+    messages = write_calibration(check_file or os.path.join(base_dir, "test_cases.csv"), os.path.join(output_dir, "calibration.json"))
+    if "torchscript" in torch_modes:
+        export_torchscript(model_output_dir, tokenizer, os.path.join(output_dir, "model.torchscript.pt"), messages)
+    if "compile" in torch_modes:
+        export_compile_cache(model_output_dir, tokenizer, os.path.join(output_dir, "compile_cache"), messages)
+    
     print("Model and tokenizer exported successfully!")
 
 if __name__ == "__main__":
-    export_model()
+    parser = argparse.ArgumentParser(description="Export the model, tokenizer and ONNX graphs used by the Lambda")
+    parser.add_argument("--active-categories", nargs="+", choices=CATEGORIES, help="Keep only these rows of the classification head, e.g. S3")
+    parser.add_argument("--prune-layers", type=int, default=0, help="Drop this many top transformer layers")
+    parser.add_argument("--prune-heads", type=json.loads, help='Attention heads to drop per layer, e.g. \'{"11": [0, 3]}\'')
+    parser.add_argument("--check-file", help="Labelled test cases CSV for the accuracy check, defaults to ../test_cases.csv")
+    parser.add_argument("--max-accuracy-drop", type=float, default=1.0, help="Maximum accuracy loss of a pruned or reduced-precision model, in percentage points")
+    parser.add_argument("--dtype", choices=list(DTYPES), default="float32", help="Precision of the saved torch weights, bfloat16 halves their memory")
+    parser.add_argument("--output-dir", default="models", help="Directory the model, tokenizer and ONNX graphs are written to")
+    parser.add_argument("--torch-modes", nargs="*", choices=TORCH_ARTIFACT_MODES, default=[],
+                        help="Torch execution modes to write artifacts for, none by default; compile needs a C++ compiler and the serving image's torch and CPU")
+    parser.add_argument("--onnx", action="store_true", help="Also export the ONNX graphs of the onnx and onnx-int8 backends, needs onnxruntime")
+    args = parser.parse_args()
+    
+    export_model(args.active_categories, args.prune_layers, args.prune_heads, args.check_file, args.max_accuracy_drop, args.dtype, args.output_dir,
+                 args.torch_modes, args.onnx)
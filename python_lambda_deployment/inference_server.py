@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from koala_lambda import MAX_BATCH_MESSAGES, MAX_BATCH_TOKENS, TextModerationLambda, format_result
+from metrics import REGISTRY, RequestMetrics
+
+# Micro-batching limits, configurable through the environment
+MICROBATCH_MAX_SIZE = int(os.environ.get("MICROBATCH_MAX_SIZE", 16))        # Messages per forward pass
+MICROBATCH_MAX_WAIT_MS = float(os.environ.get("MICROBATCH_MAX_WAIT_MS", 5))  # Time the first message waits for others
+MICROBATCH_MAX_QUEUE = int(os.environ.get("MICROBATCH_MAX_QUEUE", 256))     # Queued messages before answering 429
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 1024 * 1024
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+class QueueFullError(Exception):
+    pass
+
+class MicroBatcher:
+    """
+    Collects concurrently submitted messages into micro-batches for TextModerationLambda.predict_batch.
+    A batch is run as soon as it holds max_batch_size messages, or max_wait_ms after its first message arrived.
+    Inference runs on a single dedicated worker thread so the event loop keeps accepting requests.
+    When a micro-batch fails, its messages are scored one by one so only the failing ones get the error.
+    """
+    def __init__(self, model, max_batch_size=MICROBATCH_MAX_SIZE, max_wait_ms=MICROBATCH_MAX_WAIT_MS, max_queue=MICROBATCH_MAX_QUEUE):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.batches = 0             # Forward passes run so far
+        self.batched_messages = 0    # Messages scored in them
+        self.task = None
+    
+    def average_batch_size(self):
+        return self.batched_messages / self.batches if self.batches else 0.0
+    
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True)
+    
+    async def submit(self, texts):
+        """
+        Queue texts for moderation and wait for their results.
+        Raises QueueFullError when the queue cannot take all of them.
+        """
+        if self.queue.maxsize - self.queue.qsize() < len(texts):
+            raise QueueFullError(f"Inference queue is full ({self.queue.maxsize} messages)")
+        
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self.queue.put_nowait((text, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+    
+    async def next_batch(self):
+        """
+        Wait for a first message, then collect more until the batch is full or max_wait has passed
+        """
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            # Callers that gave up while waiting do not need a result
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+            
+            self.batches += 1
+            self.batched_messages += len(batch)
+            metrics = RequestMetrics()
+            try:
+                results = await loop.run_in_executor(self.executor, self.model.predict_batch, [text for text, _ in batch], metrics)
+            except Exception as e:
+                print(f"Error processing batch: {str(e)}")
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                results = await self.score_separately(batch, metrics)
+            
+            # Model stages, token counts and batch sizes are recorded once per micro-batch
+            if REGISTRY is not None:
+                REGISTRY.record(metrics)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+    
+    async def score_separately(self, batch, metrics):
+        """
+        Score the messages of a failed micro-batch one at a time, returning the exception in place of a result
+        for the messages that fail on their own
+        """
+        loop = asyncio.get_running_loop()
+        results = []
+        for text, _ in batch:
+            try:
+                results.extend(await loop.run_in_executor(self.executor, self.model.predict_batch, [text], metrics))
+            except Exception as e:
+                print(f"Error processing message: {str(e)}")
+                results.append(e)
+        return results
+
+class InferenceServer:
+    """
+    Minimal HTTP/1.1 server exposing the Lambda request format on POST /, for long-lived containers.
+    GET /health reports the queue depth and the average micro-batch size, and GET /metrics serves
+    the Prometheus-style registry when METRICS_REGISTRY is "on".
+    """
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.server = None
+    
+    async def start(self, host="0.0.0.0", port=8080):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+    
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.batcher.stop()
+    
+    async def handle_connection(self, reader, writer):
+        try:
+            # Keep-alive: serve requests on the connection until the client closes it
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(" ", 2)
+                
+                request_headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    request_headers[name.strip().lower()] = value.strip()
+                
+                length = int(request_headers.get("content-length", 0))
+                if length > MAX_BODY_BYTES:
+                    await self.write_response(writer, 413, {'error': f'Request body exceeds {MAX_BODY_BYTES} bytes'}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                
+                status, response = await self.handle_request(method, path, body)
+                close = request_headers.get("connection", "").lower() == "close"
+                await self.write_response(writer, status, response, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+    
+    async def write_response(self, writer, status, response, close=False):
+        # Text responses are the Prometheus exposition format of GET /metrics
+        if isinstance(response, str):
+            body = response.encode('utf-8')
+            content_type = "text/plain; version=0.0.4"
+        else:
+            body = json.dumps(response).encode('utf-8')
+            content_type = "application/json"
+        head = (
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+    
+    async def handle_request(self, method, path, body):
+        """
+        Return the status code and JSON response for one request
+        """
+        if method == "GET" and path == "/metrics" and REGISTRY is not None:
+            return 200, REGISTRY.render()
+        
+        if method == "GET" and path == "/health":
+            return 200, {
+                'status': 'ok',
+                'queued': self.batcher.queue.qsize(),
+                'batches': self.batcher.batches,
+                'average_batch_size': self.batcher.average_batch_size()
+            }
+        
+        if method != "POST" or path != "/":
+            return 404, {'error': 'Not found'}
+        
+        metrics = RequestMetrics()
+        status, response = await self.moderate(body, metrics)
+        if REGISTRY is not None:
+            REGISTRY.record(metrics, status)
+        return status, response
+    
+    async def moderate(self, body, metrics):
+        """
+        Validate and moderate the body of a POST / request, recording its parse, queue and serialize times
+        """
+        with metrics.stage("parse"):
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                return 400, {'error': 'Request body must be valid JSON'}
+            if not isinstance(request, dict):
+                return 400, {'error': 'Request body must be a JSON object'}
+        
+        message = request.get('message')
+        messages = request.get('messages')
+        if messages is not None:
+            if not isinstance(messages, list) or not messages:
+                return 400, {'error': 'Messages must be a non-empty list'}
+            if len(messages) > MAX_BATCH_MESSAGES:
+                return 400, {'error': f'At most {MAX_BATCH_MESSAGES} messages are allowed per request'}
+            if not all(isinstance(item, str) and item for item in messages):
+                return 400, {'error': 'Every message must be a non-empty string'}
+        elif not message:
+            return 400, {'error': 'Message field is required'}
+        elif not isinstance(message, str):
+            return 400, {'error': 'Message must be a string'}
+        
+        # Token budget of the Lambda handler: the padded batch of a request, or every window of a message in window mode
+        texts = messages if messages is not None else [message]
+        if messages is not None or self.batcher.model.window_mode != "off":
+            # Counted on the inference thread, the tokenizer is not safe to share between threads
+            with metrics.stage("tokenize"):
+                token_counts = await asyncio.get_running_loop().run_in_executor(self.batcher.executor, self.batcher.model.count_tokens, texts)
+            padded_tokens = len(texts) * max(token_counts)
+            if padded_tokens > MAX_BATCH_TOKENS:
+                return 413, {'error': f'Request exceeds the token budget of {MAX_BATCH_TOKENS} tokens ({padded_tokens} padded tokens), split it into smaller requests'}
+        
+        try:
+            # Waiting for a micro-batch and scoring it, the model stages are recorded per micro-batch
+            with metrics.stage("queue"):
+                results = await self.batcher.submit(texts)
+        except QueueFullError as e:
+            return 429, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': f'Internal server error: {str(e)}'}
+        
+        with metrics.stage("serialize"):
+            if messages is not None:
+                return 200, {'results': [format_result(result) for result in results]}
+            return 200, format_result(results[0])
+
+async def serve(host, port, max_batch_size, max_wait_ms, max_queue):
+    model = TextModerationLambda()
+    server = InferenceServer(MicroBatcher(model, max_batch_size, max_wait_ms, max_queue))
+    await server.start(host, port)
+    print(f"Serving on http://{host}:{port} (max batch size {max_batch_size}, max wait {max_wait_ms}ms, max queue {max_queue})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve TextModerationLambda over HTTP with micro-batched inference")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    parser.add_argument("--max-batch-size", type=int, default=MICROBATCH_MAX_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MICROBATCH_MAX_WAIT_MS)
+    parser.add_argument("--max-queue", type=int, default=MICROBATCH_MAX_QUEUE)
+    args = parser.parse_args()
+    
+    try:
+        asyncio.run(serve(args.host, args.port, args.max_batch_size, args.max_wait_ms, args.max_queue))
+    except KeyboardInterrupt:
+        pass
@@ -1,58 +1,648 @@
 import os
 import json
-import torch
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
+import time
+from embedding_cache import EmbeddingCache
+from metrics import RequestMetrics, publish
+from policy import PolicyFile
+from prefilter import PreFilter
+from result_cache import ResultCache, model_fingerprint, normalize_message
+from student import StudentModel
+from tokenization import TokenCache
+
+# Start of the cold start, torch and transformers are imported lazily so that
+# OPTIONS and validation errors can be answered without loading them
+MODULE_LOAD_START = time.perf_counter()
+
+# Limits for the multi-message "messages" request
+MAX_BATCH_MESSAGES = 32     # Maximum number of messages per request
+MAX_BATCH_TOKENS = 4096     # Token budget per request, keeps one padded forward pass well inside the 30s timeout
+
+def load_threshold(path, default=0.60):
+    """
+    Load the decision threshold chosen by the evaluation sweep in koala.py, falling back to default
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return float(json.load(file)['threshold'])
+    except FileNotFoundError:
+        return default
+
+# Categories of the full multi-label head, see fine_tune_koala.CATEGORIES
+CATEGORIES = ['S', 'H', 'V', 'HR', 'SH', 'S3', 'H2', 'V2', 'OK']
+
+def load_categories(model_path):
+    """
+    Load the categories of the model output declared by export_model.py --active-categories,
+    falling back to the full multi-label head
+    """
+    try:
+        with open(os.path.join(model_path, "config.json"), 'r', encoding='utf-8') as file:
+            return json.load(file).get('active_categories', CATEGORIES)
+    except FileNotFoundError:
+        return CATEGORIES
+
+# Inference backends selectable through INFERENCE_BACKEND
+ONNX_MODEL_FILES = {
+    "onnx": "model.onnx",            # fp32 ONNX graph
+    "onnx-int8": "model.int8.onnx"   # Dynamically INT8-quantized ONNX graph
+}
+
+# Weight precisions selectable through MODEL_DTYPE, "auto" keeps the precision the checkpoint was exported in
+MODEL_DTYPES = ("auto", "float32", "bfloat16", "float16")
+
+# Execution modes of the torch backend selectable through TORCH_MODE: "eager" runs the model as loaded, "sdpa" with
+# fused scaled-dot-product attention, "torchscript" and "compile" from the artifacts written by export_model.py.
+# "auto" runs a startup self-check and keeps the fastest mode whose outputs match eager.
+TORCH_MODES = ("eager", "sdpa", "torchscript", "compile", "auto")
+
+# Artifacts written next to the model by export_model.py
+TORCHSCRIPT_FILE = "model.torchscript.pt"   # Frozen TorchScript trace of the model with eager attention
+COMPILE_CACHE_DIR = "compile_cache"         # TorchInductor cache warmed by compiling the model at export
+CALIBRATION_FILE = "calibration.json"       # Messages from test_cases.csv for the TORCH_MODE=auto self-check
+
+# Self-check of TORCH_MODE=auto: messages per forward pass and timed passes over the calibration messages
+CALIBRATION_BATCH_SIZE = 8
+CALIBRATION_REPEATS = 5
+
+def use_compile_cache(cache_dir):
+    """
+    Point TorchInductor at the cache written at export, so torch.compile reuses the compiled kernels.
+    The cache is written to while in use, so a read-only copy (/var/task on Lambda) is copied to /tmp first.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    if not os.access(cache_dir, os.W_OK):
+        import shutil
+        
+        writable = os.path.join("/tmp", COMPILE_CACHE_DIR)
+        shutil.copytree(cache_dir, writable, dirs_exist_ok=True)
+        cache_dir = writable
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+
+def load_calibration(path):
+    """
+    Load the calibration messages written by export_model.py
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)["messages"]
+
+# Sliding-window modes selectable through WINDOW_MODE: "off" scores the first MAX_LENGTH tokens,
+# "max" and "noisy-or" score overlapping windows and combine them
+WINDOW_MODES = ("off", "max", "noisy-or")
 
 class TextModerationLambda:
-    def __init__(self):
-        self.model_dir = os.path.join(os.path.dirname(__file__), "models")
+    def __init__(self, backend=None):
+        self.model_dir = os.environ.get("MODEL_DIR", os.path.join(os.path.dirname(__file__), "models"))
         self.model_path = os.path.join(self.model_dir, "model")
         self.tokenizer_path = os.path.join(self.model_dir, "tokenizer")
+        self.backend = backend or os.environ.get("INFERENCE_BACKEND", "torch")
+        self.model_dtype = os.environ.get("MODEL_DTYPE", "auto")
+        
+        if self.backend != "torch" and self.backend not in ONNX_MODEL_FILES:
+            raise ValueError(f"Unknown inference backend: {self.backend}")
+        if self.model_dtype not in MODEL_DTYPES:
+            raise ValueError(f"Unknown model dtype: {self.model_dtype}")
+        
+        # Sliding-window scoring of long messages
+        self.window_mode = os.environ.get("WINDOW_MODE", "off")
+        self.window_tokens = int(os.environ.get("WINDOW_TOKENS", 128))   # Tokens per window, special tokens included
+        self.window_stride = int(os.environ.get("WINDOW_STRIDE", 96))    # Tokens between window starts
+        self.window_group = int(os.environ.get("WINDOW_GROUP", 4))       # Windows per message per forward pass
+        
+        if self.window_mode not in WINDOW_MODES:
+            raise ValueError(f"Unknown window mode: {self.window_mode}")
+        
+        # Execution mode of the torch forward pass
+        self.torch_mode = os.environ.get("TORCH_MODE", "eager")
+        self.torch_mode_tolerance = float(os.environ.get("TORCH_MODE_TOLERANCE", 0.1))  # In percentage points
+        
+        if self.torch_mode not in TORCH_MODES:
+            raise ValueError(f"Unknown torch mode: {self.torch_mode}")
         
         # Initialize model and tokenizer
         print("Loading model and tokenizer...")
+        print(f"Backend: {self.backend}")
         print(f"Model path: {self.model_path}")
         print(f"Tokenizer path: {self.tokenizer_path}")
         
-        # Load model and tokenizer directly from local paths
-        print("Loading model from local files...")
-        self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
+        # Load model and tokenizer directly from local paths. The loaders add the time spent importing
+        # torch, onnxruntime and transformers to import_seconds, so it is not counted as loading.
+        self.import_seconds = 0.0
+        start_time = time.perf_counter()
+        if self.backend == "torch":
+            weights_path = self.model_path
+            print("Loading model from local files...")
+            self.model = self.load_torch_model()
+            print(f"Model dtype: {self.model.dtype}")
+        else:
+            weights_path = os.path.join(self.model_dir, ONNX_MODEL_FILES[self.backend])
+            self.load_onnx_session(weights_path)
+        model_done = time.perf_counter()
+        model_imports = self.import_seconds
         
         print("Loading tokenizer from local files...")
-        self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path)
+        self.tokenizer = self.load_tokenizer()
+        tokenizer_done = time.perf_counter()
         
-        self.model.eval()  # Set to evaluation mode
+        self.load_timings = {
+            'import_ms': round(self.import_seconds * 1000, 1),
+            'model_load_ms': round((model_done - start_time - model_imports) * 1000, 1),
+            'tokenizer_load_ms': round((tokenizer_done - model_done - (self.import_seconds - model_imports)) * 1000, 1)
+        }
         
         # Constants
-        self.THRESHOLD = 0.60  # 60% threshold based on accuracy statistics
-        self.S3_INDEX = 5     # Index for sexual/minors category
+        self.THRESHOLD = load_threshold(os.path.join(self.model_dir, "threshold.json"))
+        self.categories = load_categories(self.model_path)  # Only S3 for a sliced serving model
+        self.S3_INDEX = self.categories.index('S3')         # Index for sexual/minors category
+        self.MAX_LENGTH = 256  # Maximum number of tokens per message
+        
+        # Per-category thresholds and actions from policy.json, reloaded when the file changes
+        self.policy = PolicyFile.from_environment(self.categories, self.THRESHOLD)
+        
+        # Batched fast tokenization with dynamic padding and token IDs cached per message hash.
+        # Padding to a multiple of PAD_TO_MULTIPLE_OF tokens bounds the number of distinct input shapes,
+        # and with it the kernels the CPU backend caches per shape for reduced-precision weights.
+        self.tokens = TokenCache(self.tokenizer, self.MAX_LENGTH, pad_to_multiple_of=int(os.environ.get("PAD_TO_MULTIPLE_OF", 1)))
+        
+        # Forward pass of the torch backend in the selected execution mode, taking a padded batch and returning logits
+        if self.backend == "torch":
+            mode_start = time.perf_counter()
+            if self.torch_mode == "auto":
+                self.torch_mode, self.model, self.forward = self.select_torch_mode(self.torch_mode_tolerance)
+            else:
+                self.model, self.forward = self.torch_forward(self.torch_mode)
+                if self.torch_mode != "eager" and os.path.exists(os.path.join(self.model_dir, CALIBRATION_FILE)):
+                    # Compile and optimize the graph during the cold start, not on the first request
+                    self.warm_up(self.forward, self.calibration_batches())
+            if self.torch_mode != "eager":
+                self.load_timings['torch_mode_ms'] = round((time.perf_counter() - mode_start) * 1000, 1)
+                print(f"Torch mode: {self.torch_mode}")
+        
+        # Cache of model outputs keyed by message hash, model version and max_length
+        self.model_version = f"{self.backend}:{model_fingerprint(weights_path, self.tokenizer_path)}"
+        if self.window_mode != "off":
+            # Rows stopped early are not cached, so the cached rows only depend on the window settings
+            self.model_version += f":{self.window_mode}/{self.window_tokens}/{self.window_stride}"
+        self.cache = ResultCache.from_environment(self.model_version, self.MAX_LENGTH)
         
-    def predict(self, text):
+        # Nearest-neighbour cache that lets lightly edited resends of a confidently scored message reuse its outputs
+        self.embedding_cache = EmbeddingCache.from_environment()
+        
+        # Keyword pre-filter that decides clear-cut messages without running the model
+        self.prefilter = PreFilter.from_environment()
+        
+        # Distilled student that decides confident messages, only those within CASCADE_BAND
+        # of the threshold are sent to the full model
+        self.student = StudentModel.from_environment(self.model_dir)
+        self.cascade_band = float(os.environ.get("CASCADE_BAND", 0.15))
+    
+    def load_torch_model(self, attn_implementation=None):
         """
-        Run prediction on the input text
+        Load the torch model from local files, with the attention implementation transformers picks unless one is given
         """
-        # Tokenize input
-        inputs = self.tokenizer(
-            text,
-            return_tensors="pt",
-            truncation=True,
-            max_length=256
+        import_start = time.perf_counter()
+        import torch
+        from transformers import AutoModelForSequenceClassification
+        self.import_seconds += time.perf_counter() - import_start
+        
+        # Safetensors weights are memory-mapped instead of read into a temporary copy, and kept
+        # in the precision they were exported in instead of being upcast to float32
+        options = {"attn_implementation": attn_implementation} if attn_implementation else {}
+        model = AutoModelForSequenceClassification.from_pretrained(
+            self.model_path,
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            torch_dtype="auto" if self.model_dtype == "auto" else getattr(torch, self.model_dtype),
+            **options
         )
+        model.eval()  # Set to evaluation mode
+        return model
+    
+    def torch_forward(self, mode):
+        """
+        Build the forward pass of a torch execution mode.
+        Returns the transformers model it runs, None for TorchScript, and a function from a padded batch to logits.
+        """
+        import torch
+        
+        if mode == "torchscript":
+            # The traced module holds its own copy of the weights
+            module = torch.jit.load(os.path.join(self.model_dir, TORCHSCRIPT_FILE))
+            return None, lambda inputs: module(inputs["input_ids"], inputs["attention_mask"])
+        
+        model = self.model
+        if mode == "sdpa" and model.config._attn_implementation != "sdpa":
+            # Raises for architectures without an SDPA attention implementation
+            model = self.load_torch_model("sdpa")
+        if mode == "compile":
+            use_compile_cache(os.path.join(self.model_dir, COMPILE_CACHE_DIR))
+            compiled = torch.compile(model, dynamic=True)
+            return model, lambda inputs: compiled(**inputs).logits
+        return model, lambda inputs: model(**inputs).logits
+    
+    def calibration_batches(self):
+        """
+        Padded batches of the calibration messages written by export_model.py
+        """
+        messages = load_calibration(os.path.join(self.model_dir, CALIBRATION_FILE))
+        return [
+            self.tokens.pad(self.tokens.encode(messages[start:start + CALIBRATION_BATCH_SIZE]))
+            for start in range(0, len(messages), CALIBRATION_BATCH_SIZE)
+        ]
+    
+    def warm_up(self, forward, batches):
+        """
+        Run a forward pass over every batch once; the first passes compile, profile or optimize the graph
+        """
+        import torch
+        
+        with torch.inference_mode():
+            for inputs in batches:
+                forward(inputs)
+    
+    def select_torch_mode(self, tolerance):
+        """
+        Startup self-check of TORCH_MODE=auto. Every available mode scores the calibration messages; the fastest one
+        whose probabilities are within tolerance percentage points of eager is returned with its model and forward pass.
+        Modes that cannot be loaded or run are skipped. torch.compile is only tried with the cache written at export,
+        compiling from scratch takes longer than a cold start may. Without the calibration messages eager is returned.
+        """
+        import torch
         
-        # Run inference
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            probabilities = torch.sigmoid(outputs.logits)
+        calibration_path = os.path.join(self.model_dir, CALIBRATION_FILE)
+        if not os.path.exists(calibration_path):
+            print(f"Warning: {calibration_path} not found, TORCH_MODE=auto falls back to eager; re-run export_model.py to write it")
+            return ("eager",) + self.torch_forward("eager")
         
-        # Get probability for S3 category
-        s3_probability = probabilities[0][self.S3_INDEX].item() * 100
-        should_block = s3_probability >= (self.THRESHOLD * 100)
+        candidates = ["eager", "sdpa"]
+        if os.path.exists(os.path.join(self.model_dir, TORCHSCRIPT_FILE)):
+            candidates.append("torchscript")
+        if os.path.isdir(os.path.join(self.model_dir, COMPILE_CACHE_DIR)):
+            candidates.append("compile")
         
-        return {
-            "should_block": should_block,
-            "probability": s3_probability,
-            "category": "sexual/minors"
-        }
+        batches = self.calibration_batches()
+        reference = None
+        selected = None
+        checks = {}
+        for mode in candidates:
+            try:
+                model, forward = self.torch_forward(mode)
+                self.warm_up(forward, batches)
+                with torch.inference_mode():
+                    probabilities = torch.cat([torch.sigmoid(forward(inputs).float()) for inputs in batches])
+                    
+                    timings = []
+                    for _ in range(CALIBRATION_REPEATS):
+                        start_time = time.perf_counter()
+                        for inputs in batches:
+                            forward(inputs)
+                        timings.append(time.perf_counter() - start_time)
+            except Exception as e:
+                if mode == "eager":
+                    raise
+                print(f"Skipping torch mode {mode}: {str(e)}")
+                checks[mode] = {"error": str(e)}
+                continue
+            
+            # Eager is checked first and is the reference
+            reference = probabilities if reference is None else reference
+            difference = float((probabilities - reference).abs().max()) * 100
+            elapsed = min(timings)
+            checks[mode] = {"ms": round(elapsed * 1000, 2), "max_difference": round(difference, 4)}
+            if difference <= tolerance and (selected is None or elapsed < selected[3]):
+                selected = (mode, model, forward, elapsed)
+        
+        print(json.dumps({
+            'event': 'torch_mode_selected',
+            'mode': selected[0],
+            'calibration_batches': len(batches),
+            'tolerance': tolerance,
+            'modes': checks
+        }))
+        return selected[:3]
+    
+    def load_tokenizer(self):
+        """
+        Load the fast tokenizer from local files
+        """
+        import_start = time.perf_counter()
+        from transformers import AutoTokenizer
+        self.import_seconds += time.perf_counter() - import_start
+        
+        return AutoTokenizer.from_pretrained(self.tokenizer_path, use_fast=True)
+    
+    def load_onnx_session(self, onnx_path):
+        """
+        Create an onnxruntime CPU session for an exported ONNX graph
+        """
+        import_start = time.perf_counter()
+        import onnxruntime as ort
+        self.import_seconds += time.perf_counter() - import_start
+        
+        print(f"Loading ONNX model from {onnx_path}...")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.session_inputs = [session_input.name for session_input in self.session.get_inputs()]
+    
+    def compute_probabilities(self, texts, metrics=None, partial=None):
+        """
+        Return the sigmoid probabilities for every category, one row per text.
+        In window mode the indices of the texts that stopped early are added to partial when given.
+        """
+        metrics = metrics or RequestMetrics()
+        if self.window_mode != "off":
+            return self.compute_window_probabilities(texts, metrics, partial)
+        with metrics.stage("tokenize"):
+            encodings = self.tokens.encode(texts)
+        return self.run_model(encodings, metrics)
+    
+    def run_model(self, encodings, metrics=None):
+        """
+        Pad tokenized inputs into one batch and return the sigmoid probabilities for every category, one row per input
+        """
+        import numpy as np
+        
+        metrics = metrics or RequestMetrics()
+        with metrics.stage("tokenize"):
+            inputs = self.tokens.pad(encodings, return_tensors="pt" if self.backend == "torch" else "np")
+        metrics.add("tokens", int(inputs["attention_mask"].sum()))
+        metrics.add("padded_tokens", int(inputs["attention_mask"].shape[0] * inputs["attention_mask"].shape[1]))
+        metrics.add("forward_passes")
+        
+        with metrics.stage("forward"):
+            if self.backend == "torch":
+                import torch
+                
+                # Run inference, inference mode keeps no autograd state for the activations
+                with torch.inference_mode():
+                    probabilities = torch.sigmoid(self.forward(inputs).float())
+                return probabilities.numpy()
+            
+            feed = {name: inputs[name].astype(np.int64) for name in self.session_inputs}
+            logits = self.session.run(None, feed)[0]
+            return 1 / (1 + np.exp(-logits))
+    
+    def window_encodings(self, texts):
+        """
+        Split every text into overlapping windows of window_tokens tokens, starting every window_stride tokens.
+        Returns the window encodings and, for each window, the index of its text.
+        """
+        overlap = self.window_tokens - self.tokenizer.num_special_tokens_to_add() - self.window_stride
+        if overlap < 0:
+            raise ValueError(f"WINDOW_STRIDE must be at most {self.window_tokens - self.tokenizer.num_special_tokens_to_add()} tokens")
+        
+        windows = []
+        owners = []
+        for i, text_windows in enumerate(self.tokens.windows(texts, self.window_tokens, overlap)):
+            windows.extend(text_windows)
+            owners.extend([i] * len(text_windows))
+        encodings = {name: [window[name] for window in windows] for name in windows[0]}
+        return encodings, owners
+    
+    def combine_windows(self, probabilities, window_probabilities):
+        """
+        Fold one more window into the combined probabilities of a text
+        """
+        import numpy as np
+        
+        if self.window_mode == "max":
+            return np.maximum(probabilities, window_probabilities)
+        # noisy-OR: the text is positive if any window is
+        return 1 - (1 - probabilities) * (1 - window_probabilities)
+    
+    def compute_window_probabilities(self, texts, metrics=None, partial=None):
+        """
+        Score every text on overlapping token windows combined with window_mode.
+        Windows are scored in reading order, window_group per text per forward pass, and, when the
+        policy only enforces S3, a text stops being scored as soon as its combined S3 probability
+        reaches the block threshold. The indices of those texts are added to partial when given.
+        """
+        import numpy as np
+        
+        # Stopping early is only safe when an S3 score over THRESHOLD blocks the message whatever the other windows hold
+        policy = self.policy.current()
+        early_stop = policy.s3_only and policy.threshold('S3') <= self.THRESHOLD
+        stop_threshold = self.THRESHOLD if early_stop else float("inf")
+        
+        metrics = metrics or RequestMetrics()
+        with metrics.stage("tokenize"):
+            encodings, owners = self.window_encodings(texts)
+        metrics.add("windows", len(owners))
+        windows = [[] for _ in texts]
+        for row, owner in enumerate(owners):
+            windows[owner].append(row)
+        
+        probabilities = [None] * len(texts)
+        pending = list(range(len(texts)))
+        while pending:
+            # Next windows of every text still being scored, in one forward pass
+            batch_rows = []
+            batch_owners = []
+            for i in pending:
+                batch_rows.extend(windows[i][:self.window_group])
+                batch_owners.extend([i] * len(windows[i][:self.window_group]))
+                windows[i] = windows[i][self.window_group:]
+            
+            window_probabilities = self.run_model({key: [values[row] for row in batch_rows] for key, values in encodings.items()}, metrics)
+            for i, row in zip(batch_owners, window_probabilities):
+                probabilities[i] = row if probabilities[i] is None else self.combine_windows(probabilities[i], row)
+            
+            stopped = [i for i in pending if windows[i] and probabilities[i][self.S3_INDEX] >= stop_threshold]
+            if partial is not None:
+                partial.update(stopped)
+            pending = [i for i in pending if windows[i] and i not in stopped]
+        
+        return np.array(probabilities)
+    
+    def predict_window_edges(self, text, metrics=None):
+        """
+        Decide a text whose windows exceed the token budget from its first and last windows only.
+        Combining more windows never lowers the max or noisy-OR probability, so when the policy allows early
+        stopping and these two windows already reach the block threshold, the whole text would be blocked too.
+        Returns that prediction, or None when the text cannot be decided without reading every window.
+        """
+        metrics = metrics or RequestMetrics()
+        policy = self.policy.current()
+        result = None
+        with metrics.stage("prefilter"):
+            if self.prefilter:
+                result = self.prefilter.check(text)
+        if not (result and result["should_block"]):
+            if not (policy.s3_only and policy.threshold('S3') <= self.THRESHOLD):
+                return None
+            
+            with metrics.stage("tokenize"):
+                encodings, owners = self.window_encodings([normalize_message(text)])
+            edges = sorted({0, len(owners) - 1})
+            metrics.add("windows", len(edges))
+            window_probabilities = self.run_model({key: [values[row] for row in edges] for key, values in encodings.items()}, metrics)
+            probabilities = window_probabilities[0]
+            for row in window_probabilities[1:]:
+                probabilities = self.combine_windows(probabilities, row)
+            if probabilities[self.S3_INDEX] < self.THRESHOLD:
+                return None
+            with metrics.stage("policy"):
+                result = policy.evaluate([probabilities.tolist()])[0]
+        
+        metrics.add("messages")
+        metrics.add(f"messages_{result['stage']}")
+        return result
+    
+    def build_result(self, probabilities):
+        """
+        Build the prediction for one row of category probabilities
+        """
+        return self.policy.current().evaluate([probabilities])[0]
+        
+    def score(self, texts, metrics=None):
+        """
+        Return the category probabilities for each text, computing only the texts missing from the caches
+        """
+        metrics = metrics or RequestMetrics()
+        texts = [normalize_message(text) for text in texts]
+        if self.cache is None and self.embedding_cache is None:
+            return [row.tolist() for row in self.compute_probabilities(texts, metrics)]
+        
+        rows = [None] * len(texts)
+        if self.cache is not None:
+            with metrics.stage("cache"):
+                rows = [self.cache.get(text) for text in texts]
+            metrics.add("cache_hit", sum(row is not None for row in rows))
+            metrics.add("cache_miss", sum(row is None for row in rows))
+        missing = [i for i, row in enumerate(rows) if row is None]
+        
+        # Messages close to a confidently scored one reuse its probabilities and skip the model entirely
+        embeddings = None
+        if missing and self.embedding_cache is not None:
+            with metrics.stage("embedding"):
+                neighbours, embeddings = self.embedding_cache.lookup([texts[i] for i in missing], self.policy.current())
+            metrics.add("embedding_hit", sum(row is not None for row in neighbours))
+            metrics.add("embedding_miss", sum(row is None for row in neighbours))
+            for i, row in zip(missing, neighbours):
+                rows[i] = row
+            embeddings = [embedding for embedding, row in zip(embeddings, neighbours) if row is None]
+            missing = [i for i in missing if rows[i] is None]
+        
+        if missing:
+            partial = set()
+            probabilities = self.compute_probabilities([texts[i] for i in missing], metrics, partial)
+            for i, row in zip(missing, probabilities):
+                rows[i] = row.tolist()
+            
+            # Windowed rows that stopped early miss windows the policy may need after a reload, so they are not kept
+            complete = [j for j in range(len(missing)) if j not in partial]
+            if self.cache is not None:
+                with metrics.stage("cache"):
+                    for j in complete:
+                        self.cache.set(texts[missing[j]], rows[missing[j]])
+            if embeddings is not None:
+                with metrics.stage("embedding"):
+                    self.embedding_cache.add([embeddings[j] for j in complete], [rows[missing[j]] for j in complete])
+        return rows
+        
+    def predict(self, text, metrics=None):
+        """
+        Run prediction on the input text
+        """
+        return self.predict_batch([text], metrics)[0]
+    
+    def count_tokens(self, texts):
+        """
+        Count the tokens each text is scored on, after truncation, or over all of its windows in window mode
+        """
+        # Normalized like in score, so the token IDs are reused when the texts are scored
+        texts = [normalize_message(text) for text in texts]
+        if self.window_mode != "off":
+            encodings, owners = self.window_encodings(texts)
+            counts = [0] * len(texts)
+            for input_ids, owner in zip(encodings["input_ids"], owners):
+                counts[owner] += len(input_ids)
+            return counts
+        
+        return self.tokens.lengths(texts)
+    
+    def run_student(self, texts, pending, results, threshold):
+        """
+        Score the pending texts with the student and fill in the results it is confident about.
+        Returns the texts that are within cascade_band of the threshold and need the full model.
+        """
+        probabilities = self.student.probabilities([normalize_message(texts[i]) for i in pending])
+        escalate = []
+        for i, probability in zip(pending, probabilities):
+            if abs(probability - threshold) < self.cascade_band:
+                escalate.append(i)
+            else:
+                results[i] = {
+                    "should_block": bool(probability >= threshold),
+                    "probability": float(probability) * 100,
+                    "category": "sexual/minors",
+                    "stage": "student"
+                }
+        return escalate
+    
+    def predict_batch(self, texts, metrics=None):
+        """
+        Run prediction on a list of texts in a single padded forward pass.
+        Texts decided by the pre-filter, or confidently by the student, are not sent to the model.
+        The policy is applied to all model rows at once. Results are returned in the same order as the input texts.
+        Stage timings and counts are added to metrics when given.
+        """
+        metrics = metrics or RequestMetrics()
+        metrics.add("messages", len(texts))
+        policy = self.policy.current()
+        with metrics.stage("prefilter"):
+            results = [self.prefilter.check(text) if self.prefilter else None for text in texts]
+            if not policy.s3_only:
+                # The pre-filter only rules out S3 content, so it can block but not pass messages
+                results = [result if result and result["should_block"] else None for result in results]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if pending and self.student and policy.s3_only:
+            with metrics.stage("student"):
+                pending = self.run_student(texts, pending, results, policy.threshold('S3'))
+        if pending:
+            rows = self.score([texts[i] for i in pending], metrics)
+            with metrics.stage("policy"):
+                for i, result in zip(pending, policy.evaluate(rows)):
+                    results[i] = result
+        for result in results:
+            metrics.add(f"messages_{result['stage']}")
+        return results
+
+def get_model():
+    """
+    Return the shared model instance, initializing it on first use
+    """
+    global model
+    if not globals().get('model'):
+        model = TextModerationLambda()
+        
+        # Log where the cold start went, as one JSON line for CloudWatch Logs Insights
+        print(json.dumps({
+            'event': 'model_loaded',
+            'backend': model.backend,
+            'cold_start_ms': round((time.perf_counter() - MODULE_LOAD_START) * 1000, 1),
+            **model.load_timings
+        }))
+    return model
+
+def format_result(result):
+    """
+    Convert a prediction into the response fields returned to the client
+    """
+    # Pre-filter and student predictions only judge one category
+    triggered = result.get('triggered_categories')
+    if triggered is None:
+        triggered = [{'category': result['category'], 'probability': result['probability'], 'action': 'block'}] if result['should_block'] else []
+    
+    return {
+        'message': 'High-risk content detected' if result['should_block'] else 'Content appears safe',
+        'is_flagged': result['should_block'],
+        'probability': result['probability'],
+        'category': result['category'],
+        'triggered_categories': triggered,
+        'stage': result['stage']
+    }
 
 def lambda_handler(event, context):
     """
@@ -62,14 +652,44 @@ def lambda_handler(event, context):
     {
         "message": "Text to moderate"
     }
+    or, to moderate up to MAX_BATCH_MESSAGES texts in one call:
+    {
+        "messages": ["Text to moderate", ...]
+    }
     
     Returns:
     {
         "message": "High-risk content detected" | "Content appears safe",
         "is_flagged": boolean,
         "probability": float,
-        "category": string
+        "category": string,
+        "triggered_categories": [{"category": string, "probability": float, "action": "block" | "flag"}, ...],
+        "stage": "prefilter" | "student" | "model"
+    }
+    or, for a "messages" request, one such object per input in input order:
+    {
+        "results": [...]
     }
+    
+    Every request except CORS preflights logs one CloudWatch Embedded Metric Format line with its
+    stage timings (parse, tokenize, forward, serialize, ...), token counts, batch size and cache hits.
+    """
+    if event.get('httpMethod') == 'OPTIONS':
+        return handle_request(event, RequestMetrics())
+    
+    metrics = RequestMetrics()
+    response = handle_request(event, metrics)
+    publish(
+        metrics,
+        response['statusCode'],
+        {'Backend': model.backend if model else os.environ.get("INFERENCE_BACKEND", "torch")},
+        {'request_id': getattr(context, 'aws_request_id', None)}
+    )
+    return response
+
+def handle_request(event, metrics):
+    """
+    Validate and moderate one API Gateway event, recording stage timings in metrics
     """
     # CORS headers for API Gateway
     headers = {
@@ -89,11 +709,17 @@ def lambda_handler(event, context):
     
     try:
         # Attempt to parse the input message from the event body
-        message = event.get('message')
-        if not message:
-            # If not directly available, parse the body as JSON
-            body = json.loads(event.get('body', '{}'))
-            message = body.get('message')
+        with metrics.stage("parse"):
+            message = event.get('message')
+            messages = event.get('messages')
+            if not message and messages is None:
+                # If not directly available, parse the body as JSON
+                body = json.loads(event.get('body', '{}'))
+                message = body.get('message')
+                messages = body.get('messages')
+        
+        if messages is not None:
+            return handle_batch(messages, headers, metrics)
         
         # Validate input
         if not message:
@@ -114,26 +740,36 @@ def lambda_handler(event, context):
                 })
             }
         
-        # Initialize model if not already initialized
-        global model
-        if not globals().get('model'):
-            model = TextModerationLambda()
-        
         # Get prediction
-        result = model.predict(message)
+        with metrics.stage("load"):
+            moderation_model = get_model()
+        
+        # In window mode a long message costs one forward pass per window group, so it gets the batch token budget
+        result = None
+        if moderation_model.window_mode != "off":
+            with metrics.stage("tokenize"):
+                tokens = moderation_model.count_tokens([message])[0]
+            if tokens > MAX_BATCH_TOKENS:
+                result = moderation_model.predict_window_edges(message, metrics)
+                if result is None:
+                    return {
+                        'statusCode': 413,
+                        'headers': headers,
+                        'body': json.dumps({
+                            'error': f'Message exceeds the token budget of {MAX_BATCH_TOKENS} tokens ({tokens} tokens over all windows), split it into smaller requests'
+                        })
+                    }
+        if result is None:
+            result = moderation_model.predict(message, metrics)
         
         # Prepare response
-        response = {
-            'message': 'High-risk content detected' if result['should_block'] else 'Content appears safe',
-            'is_flagged': result['should_block'],
-            'probability': result['probability'],
-            'category': result['category']
-        }
+        with metrics.stage("serialize"):
+            body = json.dumps(format_result(result))
         
         return {
             'statusCode': 200,
             'headers': headers,
-            'body': json.dumps(response)
+            'body': body
         }
         
     except Exception as e:
@@ -146,6 +782,71 @@ def lambda_handler(event, context):
             })
         }
 
+def handle_batch(messages, headers, metrics):
+    """
+    Validate and moderate a "messages" array in a single forward pass
+    """
+    if not isinstance(messages, list) or not messages:
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({
+                'error': 'Messages must be a non-empty list'
+            })
+        }
+    
+    if len(messages) > MAX_BATCH_MESSAGES:
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({
+                'error': f'At most {MAX_BATCH_MESSAGES} messages are allowed per request'
+            })
+        }
+    
+    if not all(isinstance(message, str) and message for message in messages):
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({
+                'error': 'Every message must be a non-empty string'
+            })
+        }
+    
+    with metrics.stage("load"):
+        moderation_model = get_model()
+    
+    # The padded batch costs roughly len(messages) * longest message tokens
+    with metrics.stage("tokenize"):
+        token_counts = moderation_model.count_tokens(messages)
+    padded_tokens = len(messages) * max(token_counts)
+    if padded_tokens > MAX_BATCH_TOKENS:
+        return {
+            'statusCode': 413,
+            'headers': headers,
+            'body': json.dumps({
+                'error': f'Batch exceeds the token budget of {MAX_BATCH_TOKENS} tokens ({padded_tokens} padded tokens), split it into smaller requests'
+            })
+        }
+    
+    results = moderation_model.predict_batch(messages, metrics)
+    
+    with metrics.stage("serialize"):
+        body = json.dumps({
+            'results': [format_result(result) for result in results]
+        })
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': body
+    }
+
+# Build the model during the Lambda init phase instead of on the first request
+model = None
+if os.environ.get('PRELOAD_MODEL', 'false').lower() == 'true':
+    get_model()
+
 if __name__ == "__main__":
     # Test the API locally
     model = TextModerationLambda()
@@ -174,4 +875,14 @@ if __name__ == "__main__":
         'body': 'invalid json'
     }
     result = lambda_handler(test_event, None)
-    print(f"\nTest 3 - Invalid JSON: {json.dumps(result, indent=2)}")
\ No newline at end of file
+    print(f"\nTest 3 - Invalid JSON: {json.dumps(result, indent=2)}")
+    
+    # Test case 4: Batch request
+    test_event = {
+        'httpMethod': 'POST',
+        'body': json.dumps({
+            'messages': ["This is a test message", "This is another test message"]
+        })
+    }
+    result = lambda_handler(test_event, None)
+    print(f"\nTest 4 - Batch request: {json.dumps(result, indent=2)}")
\ No newline at end of file
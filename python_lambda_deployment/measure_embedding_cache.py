@@ -0,0 +1,99 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+from koala_lambda import TextModerationLambda
+from embedding_cache import EmbeddingCache
+from result_cache import normalize_message
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cosine radii and confidence margins compared in the report
+REPORT_RADII = [0.85, 0.90, 0.95, 0.98]
+REPORT_MARGINS = [0.10, 0.25, 0.40]
+
+def load_messages(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [normalize_message(row["message"]) for row in csv.DictReader(file, delimiter=';') if row.get("message") and row["message"].strip()]
+
+def model_rows(model, messages, batch_size=32):
+    """
+    Score the distinct messages with the full model and return their category probabilities and the time per message
+    """
+    order = sorted(range(len(messages)), key=lambda i: len(messages[i]))
+    rows = np.zeros((len(messages), len(model.categories)))
+    start_time = time.perf_counter()
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        rows[batch] = model.compute_probabilities([messages[i] for i in batch])
+    return rows, (time.perf_counter() - start_time) / len(messages)
+
+def replay(messages, rows, policy, cache):
+    """
+    Send the messages through the cache in file order, the way score does after the exact-hash result cache.
+    Returns the indices of the messages that reused a neighbour's probabilities, the row each reused,
+    and the lookup time per message.
+    """
+    seen = set()
+    reused, reused_rows = [], []
+    lookup_time = 0.0
+    for i, message in enumerate(messages):
+        if message in seen:
+            continue  # Answered by the result cache
+        seen.add(message)
+        start_time = time.perf_counter()
+        neighbours, embeddings = cache.lookup([message], policy)
+        lookup_time += time.perf_counter() - start_time
+        if neighbours[0] is None:
+            cache.add(embeddings, [rows[i].tolist()])
+        else:
+            reused.append(i)
+            reused_rows.append(neighbours[0])
+    return reused, np.array(reused_rows), lookup_time / len(seen)
+
+def report(file_path, radii, margins, partitions, probes):
+    # Every lookup reaches the model, the replay stands in for both caches
+    os.environ["RESULT_CACHE"] = "off"
+    os.environ["EMBEDDING_CACHE"] = "off"
+    model = TextModerationLambda()
+    policy = model.policy.current()
+    
+    messages = load_messages(file_path)
+    distinct = list(dict.fromkeys(messages))
+    print(f"Scoring {len(distinct)} distinct messages of {len(messages)} in {os.path.basename(file_path)} with the full model...")
+    distinct_rows, model_time = model_rows(model, distinct)
+    position = {message: i for i, message in enumerate(distinct)}
+    rows = distinct_rows[[position[message] for message in messages]]
+    blocks = np.array([result["should_block"] for result in policy.evaluate(rows)])
+    
+    print(f"\nEmbedding cache replay, {len(distinct)} result cache misses, {model_time * 1000:.1f} ms per message on the model:")
+    print(f"|{'Radius':>7}|{'Margin':>7}|{'Index':>9}|{'Reused':>8}|{'Disagree':>9}|{'Max S3 diff':>12}|{'Lookup ms':>10}|{'Saved ms/msg':>13}|")
+    for radius in radii:
+        for margin in margins:
+            for index_partitions in sorted({0, partitions}):
+                cache = EmbeddingCache(max_entries=len(distinct), radius=radius, margin=margin, partitions=index_partitions, probes=probes)
+                reused, reused_rows, lookup_time = replay(messages, rows, policy, cache)
+                disagree = 0
+                max_difference = 0.0
+                if reused:
+                    reused_blocks = np.array([result["should_block"] for result in policy.evaluate(reused_rows)])
+                    disagree = int((reused_blocks != blocks[reused]).sum())
+                    max_difference = float(np.abs(reused_rows[:, model.S3_INDEX] - rows[reused, model.S3_INDEX]).max() * 100)
+                index_name = f"ivf{index_partitions}" if index_partitions else "flat"
+                saved = len(reused) / len(distinct) * model_time - lookup_time
+                print(
+                    f"|{radius:>7.2f}|{margin * 100:>6.0f}%|{index_name:>9}|{len(reused) / len(distinct) * 100:>7.1f}%"
+                    f"|{disagree / max(len(reused), 1) * 100:>8.1f}%|{max_difference:>12.2f}|{lookup_time * 1000:>10.3f}|{saved * 1000:>+13.2f}|"
+                )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the reuse and disagreement rates of the embedding cache on a test cases CSV")
+    parser.add_argument("--file", default=os.path.join(BASE_DIR, "test_cases.csv"))
+    parser.add_argument("--radius", type=float, nargs="+", default=REPORT_RADII, help="Cosine similarity radii")
+    parser.add_argument("--margin", type=float, nargs="+", default=REPORT_MARGINS, help="Confidence margins around the policy thresholds")
+    parser.add_argument("--partitions", type=int, default=16, help="IVF partitions compared against the flat index, 0 to skip")
+    parser.add_argument("--probes", type=int, default=4)
+    args = parser.parse_args()
+    
+    report(args.file, args.radius, args.margin, args.partitions, args.probes)
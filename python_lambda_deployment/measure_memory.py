@@ -0,0 +1,91 @@
+import os
+import sys
+import csv
+import json
+import glob
+import argparse
+import resource
+import subprocess
+
+def load_messages(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [row["message"].strip() for row in csv.DictReader(file, delimiter=';') if row.get("message") and row["message"].strip()]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def current_rss_mb():
+    with open("/proc/self/status", 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def measure(file_path, requests):
+    """
+    Peak RSS of this process at cold start and after requests single-message requests through lambda_handler
+    """
+    messages = load_messages(file_path)
+    from koala_lambda import lambda_handler
+    
+    def request(message):
+        response = lambda_handler({'httpMethod': 'POST', 'body': json.dumps({'message': message})}, None)
+        if response['statusCode'] != 200:
+            raise RuntimeError(response['body'])
+    
+    imported = peak_rss_mb()
+    request(messages[0])
+    cold_start = peak_rss_mb()
+    for i in range(requests):
+        request(messages[i % len(messages)])
+    return {
+        'import_peak_mb': imported,
+        'cold_start_peak_mb': cold_start,
+        'peak_mb': peak_rss_mb(),
+        'current_mb': current_rss_mb()
+    }
+
+def describe(model_dir):
+    """
+    Precision and on-disk size of the torch weights in a Lambda models directory
+    """
+    with open(os.path.join(model_dir, "model", "config.json"), 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(model_dir, "model", "*.safetensors")))
+    return config.get("torch_dtype") or config.get("dtype") or "float32", size / 1024 / 1024
+
+def compare(model_dirs, file_path, requests, memory_size):
+    """
+    Measure every models directory in its own process, so each starts from a cold Python interpreter
+    """
+    print(f"Peak RSS at cold start and after {requests} requests, against the {memory_size} MB Lambda limit:")
+    print(f"|{'Models directory':<30}|{'Dtype':>9}|{'Weights MB':>11}|{'Cold start MB':>14}|{f'After {requests} MB':>15}|{'Current MB':>11}|{'Headroom MB':>12}|")
+    for model_dir in model_dirs:
+        # Every request goes through the model, the way a cold container sees new messages
+        env = dict(os.environ, MODEL_DIR=os.path.abspath(model_dir), RESULT_CACHE="off", PREFILTER="off", METRICS_EMF="off", PRELOAD_MODEL="false")
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--file", file_path, "--requests", str(requests)],
+            env=env, capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout
+        stats = json.loads(output.strip().splitlines()[-1])
+        dtype, weights_mb = describe(model_dir)
+        print(
+            f"|{model_dir[-30:]:<30}|{dtype:>9}|{weights_mb:>11.1f}|{stats['cold_start_peak_mb']:>14.1f}|{stats['peak_mb']:>15.1f}"
+            f"|{stats['current_mb']:>11.1f}|{memory_size - stats['peak_mb']:>12.1f}|"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the peak RSS of the Lambda at cold start and after a number of requests")
+    parser.add_argument("--model-dir", nargs="+", default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")],
+                        help="Models directories to compare, e.g. a float32 and a bfloat16 export")
+    parser.add_argument("--file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_cases.csv"))
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--memory-size", type=int, default=512, help="Lambda memorySize in MB, see serverless.yml")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.child:
+        print(json.dumps(measure(args.file, args.requests)))
+    else:
+        compare(args.model_dir, args.file, args.requests, args.memory_size)
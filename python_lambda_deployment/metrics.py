@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# One CloudWatch Embedded Metric Format log line per Lambda request, "on" or "off"
+METRICS_EMF = os.environ.get("METRICS_EMF", "on")
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "KoalaModeration")
+
+# In-process Prometheus-style registry, served on GET /metrics by inference_server.py, "on" or "off"
+METRICS_REGISTRY = os.environ.get("METRICS_REGISTRY", "off")
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+class RequestMetrics:
+    """
+    Stage timings and counts of one request, or of one micro-batch in the container server.
+    A stage entered several times accumulates its time.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+    
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+    
+    def add(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+    
+    def elapsed(self):
+        return time.perf_counter() - self.start
+    
+    def emf_record(self, dimensions, properties=None):
+        """
+        Return the metrics as a CloudWatch Embedded Metric Format record: stage times in milliseconds,
+        counts as-is, one metric set per request under the given dimensions
+        """
+        values = {f"{name}_ms": round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+        values["total_ms"] = round(self.elapsed() * 1000, 3)
+        values.update(self.counts)
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [
+                        {"Name": name, "Unit": "Milliseconds" if name.endswith("_ms") else "Count"}
+                        for name in values
+                    ]
+                }]
+            },
+            **dimensions,
+            **values,
+            **(properties or {})
+        }
+
+class MetricsRegistry:
+    """
+    Counters and histograms kept in process and rendered in the Prometheus text exposition format.
+    Updates take a lock, so the inference thread and the event loop can share one registry.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}     # (name, labels) -> value
+        self.histograms = {}   # (name, labels) -> [per-bucket counts, sum, count, buckets]
+        self.help = {}
+    
+    def inc(self, name, help_text, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help[name] = ("counter", help_text)
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, help_text, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help[name] = ("histogram", help_text)
+            histogram = self.histograms.setdefault(key, [[0] * (len(buckets) + 1), 0.0, 0, buckets])
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def record(self, metrics, status=None):
+        """
+        Record a finished request, or a micro-batch when status is None
+        """
+        if status is not None:
+            self.inc("koala_requests_total", "Requests answered, by status code", status=str(status))
+            self.observe("koala_request_duration_seconds", "End-to-end request latency", metrics.elapsed())
+        for stage, seconds in metrics.stages.items():
+            self.observe("koala_stage_duration_seconds", "Time spent per stage of a request or micro-batch", seconds, stage=stage)
+        for name, value in metrics.counts.items():
+            if name.startswith("messages_"):
+                self.inc("koala_messages_total", "Messages decided, by stage", value, stage=name[len("messages_"):])
+            elif name.startswith("cache_"):
+                self.inc("koala_cache_lookups_total", "Result cache lookups, by result", value, result=name[len("cache_"):])
+            elif name.startswith("embedding_"):
+                self.inc("koala_embedding_cache_lookups_total", "Embedding cache lookups, by result", value, result=name[len("embedding_"):])
+            elif name in ("tokens", "padded_tokens", "windows", "forward_passes"):
+                self.inc(f"koala_{name}_total", f"Total {name.replace('_', ' ')} scored by the model", value)
+        if "messages" in metrics.counts:
+            self.observe("koala_batch_size", "Messages per predict_batch call", metrics.counts["messages"], BATCH_SIZE_BUCKETS)
+    
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format
+        """
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}" if pairs else ""
+        
+        lines = []
+        with self.lock:
+            for metric, (kind, help_text) in sorted(self.help.items()):
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} {kind}")
+                if kind == "counter":
+                    for (name, labels), value in sorted(self.counters.items()):
+                        if name == metric:
+                            lines.append(f"{name}{label_text(labels)} {value}")
+                    continue
+                for (name, labels), (counts, total, count, buckets) in sorted(self.histograms.items()):
+                    if name != metric:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{label_text(labels)} {total}")
+                    lines.append(f"{name}_count{label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+# Registry shared by the Lambda handler and the container server, None when METRICS_REGISTRY is "off"
+REGISTRY = MetricsRegistry() if METRICS_REGISTRY == "on" else None
+
+def publish(metrics, status, dimensions, properties=None):
+    """
+    Emit the metrics of a finished request as one EMF log line and record them in the registry
+    """
+    if METRICS_EMF == "on":
+        print(json.dumps(metrics.emf_record(dimensions, {"status": status, **(properties or {})})))
+    if REGISTRY is not None:
+        REGISTRY.record(metrics, status)
@@ -0,0 +1,524 @@
+import os
+import re
+import json
+import asyncio
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+# Dependencies of the orchestration, see moderation_api_lambda/handler.ts. Without CUSTOM_MODEL_ENDPOINT
+# messages are scored by the model in this process, see koala_lambda.py
+CUSTOM_MODEL_ENDPOINT = os.environ.get("CUSTOM_MODEL_ENDPOINT")
+CUSTOM_MODEL_AUTH_TOKEN = os.environ.get("CUSTOM_MODEL_AUTH_TOKEN", "")
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_MODERATION_URL = os.environ.get("OPENAI_MODERATION_URL", "https://api.openai.com/v1/moderations")
+SLACK_WEBHOOK_URL = os.environ.get("SLACK_WEBHOOK_URL")
+
+MODERATION_THRESHOLD = 0.60
+S3_LABEL = 'S3'
+OPENAI_BLOCK_SCORE = 0.98   # OpenAI sexual/minors scores above this block without waiting for the model
+
+# Per-dependency timeouts in seconds
+MODEL_TIMEOUT = float(os.environ.get("MODEL_TIMEOUT", 5))
+EXTERNAL_TIMEOUT = float(os.environ.get("EXTERNAL_TIMEOUT", 3))
+NOTIFY_TIMEOUT = float(os.environ.get("NOTIFY_TIMEOUT", 5))
+
+# Seconds before a second copy of a slow HTTP request is sent, 0 disables hedging
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", 0.5))
+
+# Connections kept open per process, shared by every dependency
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+
+# Notifications waiting to be sent before new ones are dropped, and notifications sent at once
+NOTIFY_MAX_QUEUE = int(os.environ.get("NOTIFY_MAX_QUEUE", 100))
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", 2))
+
+# Seconds a response may wait for queued notifications before the function is frozen, and time left
+# in the invocation that this wait never uses
+NOTIFY_FLUSH_SECONDS = float(os.environ.get("NOTIFY_FLUSH_SECONDS", 1))
+NOTIFY_FLUSH_MARGIN = float(os.environ.get("NOTIFY_FLUSH_MARGIN", 0.2))
+
+# Zoophilia and coprophilia terms, blocked without asking any model
+SENSITIVE_CONTENT_REGEX = re.compile(
+    r"\b(zoophilia|coprophilia|coprophagia|scat[\s_-]?fetish|copro[\s_-]?fetish|feces[\s_-]?fetish|excrement[\s_-]?fetish"
+    r"|scat[\s_-]?play|copro[\s_-]?play|feces[\s_-]?play|excrement[\s_-]?play|feces[\s_-]?eating|excrement[\s_-]?eating"
+    r"|feces[\s_-]?consumption|excrement[\s_-]?consumption)\b"
+    r"|\b(zoophilia|zoophile|zoosexual|zoophilic|beast[\s_-]?sex|animal[\s_-]?sex|animal[\s_-]?rape|animal[\s_-]?intercourse"
+    r"|sexual[\s_-]?acts?[\s_-]?with[\s_-]?animals?|sexual[\s_-]?contact[\s_-]?with[\s_-]?animals?|animal[\s_-]?porn"
+    r"|zoo[\s_-]?porn|beast[\s_-]?porn|zoosexual[\s_-]?fetish|animal[\s_-]?fetish)\b",
+    re.IGNORECASE
+)
+
+# Underage or child references, ages 0 to 17 included
+UNDERAGE_CONTENT_REGEX = re.compile(
+    r"\b(child|pedo|raped|underage|infant|toddler|preadolescent|juvenile|preteen|adolescent|young[\s-]?one|youngster"
+    r"|(?:1[0-7]|[0-9])[\s-]?(year[\s-]?old|y[\s/]o))\b",
+    re.IGNORECASE
+)
+
+# Family and age words replaced before a message is sent to a model
+FAMILY_KEYWORDS = [
+    'mom', 'mother', 'mum', 'mama', 'mommy', 'momy', 'mumy', 'mummy', 'momma', 'momm', 'mumzy',
+    'dad', 'father', 'papa', 'daddy', 'dady', 'pappy', 'dadd', 'dada', 'fater', 'faher',
+    'daughter', 'son', 'dauter', 'sunn', 'daugther', 'daughtr', 'daugter', 'dauther',
+    'doughtor', 'dughter', 'daughteer', 'daugthter',
+    'sister', 'sis', 'sissy', 'sist',
+    'sistr', 'siser', 'siste', 'sistter', 'sistor', 'sistur', 'sistir', 'sisterr',
+    'brother', 'bro', 'bruv', 'brther',
+    'brothr', 'broter', 'broher', 'brohter', 'brothre', 'brotther', 'brothur', 'brothir',
+    'fathr', 'fathre', 'fatherr', 'fatther', 'fathur', 'fathir', 'fathar',
+    'aunt', 'auntie', 'uncle', 'ant', 'untie',
+    'cousin', 'niece', 'nephew', 'cusin', 'neice', 'nefew',
+    'grandma', 'grandmother', 'granny', 'nana', 'granma', 'gramma',
+    'grandpa', 'grandfather', 'gramps', 'granpa', 'grampa',
+    'family', 'families', 'parent', 'parents', 'famly', 'parrent',
+    'girl', 'boy', 'teen', 'teenager', 'teenie'
+]
+FAMILY_KEYWORDS_REGEX = re.compile(r"\b(?:" + "|".join(FAMILY_KEYWORDS) + r")\b", re.IGNORECASE)
+
+def replace_family_keywords(text):
+    return FAMILY_KEYWORDS_REGEX.sub('lover', text)
+
+async def hedged(request, delay, attempts=2):
+    """
+    Await request(), sending another copy whenever none has completed within delay seconds, or all copies
+    sent so far failed, up to attempts copies. The first copy to succeed wins and the others are cancelled.
+    Raises the last error when every copy fails. A delay of 0 sends a single request.
+    """
+    if delay <= 0:
+        return await request()
+    
+    pending = {asyncio.ensure_future(request())}
+    sent = 1
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if sent < attempts else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if sent < attempts and (not done or not pending):
+                pending.add(asyncio.ensure_future(request()))
+                sent += 1
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+class HTTPModelClient:
+    """
+    Custom model behind an HTTP endpoint answering [{"label": ..., "score": ...}], e.g. a Hugging Face inference endpoint
+    """
+    def __init__(self, http, endpoint, token, timeout=MODEL_TIMEOUT, hedge_delay=HEDGE_DELAY):
+        self.http = http
+        self.endpoint = endpoint
+        self.token = token
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.requests = 0   # HTTP requests sent, hedges included
+    
+    async def request(self, text):
+        self.requests += 1
+        response = await self.http.post(
+            self.endpoint,
+            json={"inputs": text},
+            headers={"Accept": "application/json", "Authorization": f"Bearer {self.token}"}
+        )
+        response.raise_for_status()
+        return response.json()
+    
+    async def check(self, text):
+        predictions = await asyncio.wait_for(hedged(lambda: self.request(text), self.hedge_delay), self.timeout)
+        prediction = predictions[0] if predictions else {}
+        score = float(prediction.get("score", 0))
+        label = prediction.get("label", "")
+        return {"flagged": label == S3_LABEL and score >= MODERATION_THRESHOLD, "score": score, "label": label}
+
+class LocalModelClient:
+    """
+    Model of koala_lambda.py scored in this process, on a worker thread so the event loop keeps serving the
+    other dependencies. The prediction follows policy.json, so its label is the reported category name.
+    """
+    def __init__(self, model, timeout=MODEL_TIMEOUT):
+        self.model = model
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+    
+    async def check(self, text):
+        loop = asyncio.get_running_loop()
+        result = await asyncio.wait_for(loop.run_in_executor(self.executor, self.model.predict, text), self.timeout)
+        label = S3_LABEL if result["category"] == "sexual/minors" else result["category"]
+        return {"flagged": result["should_block"], "score": result["probability"] / 100, "label": label}
+
+class OpenAIModerationClient:
+    """
+    External moderation through the OpenAI moderation endpoint. Any client with an async check(text)
+    returning flagged, sexual_minors_score and category_scores can take its place in Orchestrator.
+    """
+    def __init__(self, http, api_key, url=OPENAI_MODERATION_URL, model="omni-moderation-latest", timeout=EXTERNAL_TIMEOUT, hedge_delay=HEDGE_DELAY):
+        self.http = http
+        self.api_key = api_key
+        self.url = url
+        self.model = model
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.requests = 0
+    
+    async def request(self, text):
+        self.requests += 1
+        response = await self.http.post(
+            self.url,
+            json={"model": self.model, "input": text},
+            headers={"Authorization": f"Bearer {self.api_key}"}
+        )
+        response.raise_for_status()
+        return response.json()["results"][0]
+    
+    async def check(self, text):
+        result = await asyncio.wait_for(hedged(lambda: self.request(text), self.hedge_delay), self.timeout)
+        # Only sexual/minors content counts as flagged
+        return {
+            **result,
+            "flagged": bool(result["categories"].get("sexual/minors")),
+            "sexual_minors_score": result["category_scores"].get("sexual/minors")
+        }
+
+def slack_payload(title, details, kind="info"):
+    """
+    Format a notification as Slack blocks, one field per detail
+    """
+    emoji = '🚨' if kind == 'warning' else 'ℹ️'
+    fields = [
+        {"type": "mrkdwn", "text": f"*{key}:*\n{json.dumps(value, indent=2) if isinstance(value, (dict, list)) else value}"}
+        for key, value in details.items()
+    ]
+    return {
+        "blocks": [
+            {"type": "header", "text": {"type": "plain_text", "text": f"{emoji} {title}", "emoji": True}},
+            {"type": "divider"},
+            {"type": "section", "fields": fields},
+            {"type": "context", "elements": [{"type": "mrkdwn", "text": f"*Timestamp:* {datetime.now(timezone.utc).isoformat()}"}]}
+        ],
+        "color": '#ff0000' if kind == 'warning' else '#36a64f'
+    }
+
+class NotificationQueue:
+    """
+    Fire-and-forget Slack notifications. notify only queues a message and workers background tasks post them
+    with their own timeout, so a slow or failing webhook never delays a response. When max_queue messages are
+    waiting, new ones are dropped and counted. Notifications still queued when a flush runs out of time are
+    counted as deferred: they are sent during a later invocation, or lost if the function is not invoked again.
+    """
+    def __init__(self, http, webhook_url, max_queue=NOTIFY_MAX_QUEUE, workers=NOTIFY_WORKERS, timeout=NOTIFY_TIMEOUT):
+        self.http = http
+        self.webhook_url = webhook_url
+        self.max_queue = max_queue
+        self.workers = workers
+        self.timeout = timeout
+        self.queue = None
+        self.tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.deferred = 0
+    
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.tasks = [asyncio.get_running_loop().create_task(self.run()) for _ in range(self.workers)]
+    
+    def notify(self, title, details, kind="info"):
+        if not self.webhook_url:
+            print(f"Slack webhook URL not configured, skipping notification: {title}")
+            return
+        try:
+            self.queue.put_nowait(slack_payload(title, details, kind))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"Notification queue is full, dropped notification: {title}")
+    
+    async def run(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                response = await asyncio.wait_for(self.http.post(self.webhook_url, json=payload), self.timeout)
+                if response.status_code >= 400:
+                    self.failed += 1
+                    print(f"Failed to send Slack notification: {response.status_code} {response.text}")
+                else:
+                    self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error sending Slack notification: {type(e).__name__} {str(e)}")
+            finally:
+                self.queue.task_done()
+    
+    async def flush(self, timeout):
+        """
+        Wait up to timeout seconds for the queued notifications to be sent
+        """
+        if self.queue.empty():
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.deferred += self.queue.qsize()
+            print(f"{self.queue.qsize()} notifications still queued after {timeout}s, {self.deferred} deferred so far")
+    
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class Orchestrator:
+    """
+    Moderation flow of moderation_api_lambda/handler.ts with the model and the external moderation queried
+    concurrently instead of one after the other, so a request waits for the slower dependency rather than
+    for their sum. Decisions are the same: when the external moderation alone decides, the model call is
+    cancelled, and notifications never wait for Slack.
+    """
+    def __init__(self, model, external, notifications):
+        self.model = model
+        self.external = external
+        self.notifications = notifications
+    
+    @classmethod
+    def from_environment(cls):
+        """
+        Build the orchestration configured through the environment, with one pooled HTTP client for every
+        dependency. Must be called with the event loop running, which starts the notification queue.
+        """
+        import httpx
+        
+        if not OPENAI_API_KEY:
+            raise ValueError("Missing required environment variable: OPENAI_API_KEY")
+        
+        http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(max(MODEL_TIMEOUT, EXTERNAL_TIMEOUT, NOTIFY_TIMEOUT))
+        )
+        if CUSTOM_MODEL_ENDPOINT:
+            model = HTTPModelClient(http, CUSTOM_MODEL_ENDPOINT, CUSTOM_MODEL_AUTH_TOKEN)
+        else:
+            from koala_lambda import get_model
+            model = LocalModelClient(get_model())
+        
+        notifications = NotificationQueue(http, SLACK_WEBHOOK_URL)
+        notifications.start()
+        return cls(model, OpenAIModerationClient(http, OPENAI_API_KEY), notifications)
+    
+    async def check_external(self, message):
+        try:
+            result = await self.external.check(replace_family_keywords(message))
+        except Exception as e:
+            print(f"Error - External moderation: {type(e).__name__} {str(e)}")
+            return {"isError": True, "flagged": False, "categories": {}, "category_scores": {}}
+        
+        score = result.get("sexual_minors_score")
+        if result["flagged"]:
+            print(f"[CONTENT BLOCKED] External moderation blocked content: \"{message}\" (sexual/minors score: {score})")
+            self.notifications.notify('OpenAI Moderation - might need to be blocked', {
+                'Content': message,
+                'Sexual/Minors Score': score,
+                'Categories': result.get("category_scores")
+            })
+        else:
+            print(f"[MESSAGE PASSED] External moderation passed content: \"{message}\" (sexual/minors score: {score})")
+        return result
+    
+    async def check_model(self, message):
+        try:
+            return await self.model.check(replace_family_keywords(message))
+        except Exception as e:
+            print(f"Error - Custom Moderation API: {type(e).__name__} {str(e)}")
+            return {"isError": True, "flagged": False, "score": 0, "label": ""}
+    
+    def report_model(self, message, result):
+        """
+        Log and notify the model result, once the orchestration has used it
+        """
+        if result.get("isError"):
+            return
+        details = {'Content': message, 'Score': result["score"], 'Label': result["label"]}
+        if result["flagged"]:
+            print(f"[CONTENT BLOCKED] Custom Moderation blocked S3 content: \"{message}\" with score: {result['score']}")
+            self.notifications.notify('Custom Moderation - might need to be blocked', {**details, 'Status': 'Blocked'})
+        elif result["label"] == S3_LABEL:
+            print(f"[MESSAGE PASSED] Custom Moderation passed S3 content: \"{message}\" with score: {result['score']} (below threshold)")
+            self.notifications.notify('Custom Moderation - passed but has S3 content', {**details, 'Status': 'Passed (below threshold)'})
+        else:
+            print(f"[MESSAGE PASSED] Custom Moderation passed non-S3 content: \"{message}\" with label: {result['label']}, score: {result['score']}")
+    
+    async def moderate(self, message):
+        """
+        Moderate one message and return the response body
+        """
+        has_underage = bool(UNDERAGE_CONTENT_REGEX.search(message))
+        print(f"Checking for underage content in: \"{message}\" - Result: {has_underage}")
+        
+        if SENSITIVE_CONTENT_REGEX.search(message):
+            print(f"Sensitive content detected via regex: {message}")
+            self.notifications.notify('Zoophilia and Coprophilia Regex Detection - Final Decision', {
+                'Content': message,
+                'Type': 'Sensitive Content (Extended)',
+                'Pattern': 'SENSITIVE_CONTENT_REGEX'
+            }, 'warning')
+            return {
+                'message': 'High-risk content detected',
+                'is_flagged': True,
+                'flagged_type': 'sensitive_content_via_regex_match',
+                'probability': 1,
+                'details': ['sensitive_content']
+            }
+        
+        # Both dependencies are queried at once, the model call is cancelled when the external moderation decides alone
+        model_task = asyncio.ensure_future(self.check_model(message))
+        try:
+            external = await self.check_external(message)
+            external_score = external.get("category_scores", {}).get("sexual/minors")
+            
+            # Block immediately if the external confidence is very high
+            if not external.get("isError") and external_score is not None and external_score > OPENAI_BLOCK_SCORE:
+                print(f"Blocking content due to high OpenAI confidence: {external_score}")
+                self.notifications.notify('Content Moderation - High Confidence Block', {
+                    'Content': message,
+                    'Decision': 'Blocked',
+                    'Reason': 'High OpenAI confidence score',
+                    'OpenAI Sexual/Minors Score': external_score
+                }, 'warning')
+                return {
+                    'message': message,
+                    'is_flagged': True,
+                    'probability': external_score,
+                    'flagged_type': 'sexual/minors',
+                    'details': {'openai_result': external, 'reason': 'High OpenAI confidence score'}
+                }
+            
+            if not external["flagged"] and not external.get("isError") and not has_underage:
+                print("No content flagged by OpenAI Moderation API - Skipping further checks")
+                return {'message': 'No content flagged by OpenAI Moderation API', 'is_flagged': False}
+            
+            custom = await model_task
+        finally:
+            model_task.cancel()
+        self.report_model(message, custom)
+        
+        is_blocked = custom["flagged"] and external["flagged"] or custom["flagged"] and has_underage
+        block_reason = 'Both APIs flagged content' if is_blocked else 'No content flagged'
+        scores = {
+            'Custom API Score': custom["score"],
+            'Custom API Label': custom["label"],
+            'OpenAI Sexual/Minors Score': external_score
+        }
+        
+        # Fall back on whichever dependency answered, or on the underage regex when neither did
+        if custom.get("isError") or external.get("isError"):
+            fallback = None
+            if not custom.get("isError"):
+                is_blocked = has_underage
+                block_reason = 'Custom API flagged or regex flagged content due to OpenAI not available'
+                fallback = ('Fall back due OpenAI Moderation not available', 'Custom API flagged content')
+            elif not external.get("isError"):
+                is_blocked = external["flagged"]
+                block_reason = 'OpenAI flagged content due to Custom Moderation not available'
+                fallback = ('Fall back due Custom Moderation not available', 'OpenAI flagged content')
+            else:
+                is_blocked = has_underage
+                block_reason = 'Underage regex flagged content due to both APIs not available'
+                fallback = ('Fall back due both APIs not available, using regex', 'Underage content')
+            print(f"One or both APIs not available: {block_reason}")
+            if is_blocked:
+                self.notifications.notify(fallback[0], {'Content': message, 'Decision': 'Blocked', 'Reason': fallback[1], **scores}, 'warning')
+        
+        if is_blocked:
+            self.notifications.notify('Content Moderation - Final Decision', {
+                'Content': message,
+                'Decision': 'Blocked',
+                'Reason': block_reason,
+                **scores
+            }, 'warning')
+        
+        body = {
+            'message': 'High-risk content detected' if is_blocked else 'Content approved',
+            'is_flagged': is_blocked,
+            'custom_score': custom["score"],
+            'custom_flagged': custom["flagged"],
+            'openai_flagged': external["flagged"],
+            'openai_sexual_minors_score': external_score,
+            'block_reason': block_reason
+        }
+        if is_blocked:
+            body['details'] = [f"Custom API Score: {custom['score']}", f"OpenAI Sexual/Minors Score: {external_score}"]
+        return body
+    
+    async def handle_event(self, event):
+        """
+        Validate and moderate one API Gateway event
+        """
+        try:
+            try:
+                body = json.loads(event.get('body') or '{}')
+            except (json.JSONDecodeError, TypeError) as e:
+                print(f"Error parsing request body: {str(e)}")
+                return {'statusCode': 400, 'body': json.dumps({'message': 'Invalid request body', 'is_flagged': False})}
+            if not isinstance(body, dict):
+                return {'statusCode': 400, 'body': json.dumps({'message': 'Request body must be a JSON object', 'is_flagged': False})}
+            
+            if body.get('health_check'):
+                return {'statusCode': 200, 'body': json.dumps({
+                    'status': 'ok',
+                    'message': 'Text moderation API is operational',
+                    'timestamp': datetime.now(timezone.utc).isoformat()
+                })}
+            
+            message = body.get('message') or body.get('inputs')
+            if not message:
+                return {'statusCode': 400, 'body': json.dumps({'message': 'No message provided in the request body', 'is_flagged': False})}
+            
+            return {'statusCode': 200, 'body': json.dumps(await self.moderate(message))}
+        except Exception as e:
+            print(f"Error - Model Inference: {type(e).__name__} {str(e)}")
+            return {'statusCode': 500, 'body': json.dumps({'message': 'Internal server error during content moderation', 'is_flagged': False})}
+
+# Event loop and orchestration kept across warm invocations, so HTTP connections stay pooled.
+# Notifications still queued when the flush budget runs out are sent while the next invocation runs.
+loop = None
+orchestrator = None
+
+async def get_orchestrator():
+    global orchestrator
+    if orchestrator is None:
+        orchestrator = Orchestrator.from_environment()
+    return orchestrator
+
+def notify_flush_budget(context):
+    """
+    Seconds to wait for queued notifications before returning: NOTIFY_FLUSH_SECONDS, cut so that
+    NOTIFY_FLUSH_MARGIN of the invocation's remaining time is left
+    """
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return NOTIFY_FLUSH_SECONDS
+    return max(0.0, min(NOTIFY_FLUSH_SECONDS, context.get_remaining_time_in_millis() / 1000 - NOTIFY_FLUSH_MARGIN))
+
+def lambda_handler(event, context):
+    """
+    AWS Lambda handler for API Gateway integration, with the request and response format of
+    moderation_api_lambda/handler.ts
+    """
+    global loop
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    
+    async def handle():
+        current = await get_orchestrator()
+        response = await current.handle_event(event)
+        
+        # Lambda freezes the process once the response is returned, so give the queued notifications a bounded chance first
+        await current.notifications.flush(notify_flush_budget(context))
+        return response
+    
+    return loop.run_until_complete(handle())
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+
+DEFAULT_POLICY_FILE = os.path.join(os.path.dirname(__file__), "policy.json")
+
+# Seconds between checks of the policy file for changes, configurable through POLICY_RELOAD_SECONDS
+POLICY_RELOAD_SECONDS = float(os.environ.get("POLICY_RELOAD_SECONDS", 30))
+
+# Category names reported to clients, see the model card
+CATEGORY_NAMES = {
+    'S': 'sexual',
+    'H': 'hate',
+    'V': 'violence',
+    'HR': 'harassment',
+    'SH': 'self-harm',
+    'S3': 'sexual/minors',
+    'H2': 'hate/threatening',
+    'V2': 'violence/graphic',
+    'OK': 'OK'
+}
+
+# "block" rules block the message, "flag" rules only report it in triggered_categories
+ACTIONS = ("block", "flag")
+
+class Policy:
+    """
+    Per-category thresholds and actions, compiled against the categories of the model output.
+    The rules become a column index, a threshold vector and a block mask, so every rule is
+    checked on a batch of sigmoid rows with one comparison instead of one pass per category.
+    """
+    def __init__(self, rules, categories, default_threshold):
+        import numpy as np
+        
+        if not rules:
+            raise ValueError("Policy has no rules")
+        
+        self.rules = []
+        for rule in rules:
+            category = rule["category"]
+            action = rule.get("action", "block")
+            # A null threshold is the one tuned by the evaluation sweep in koala.py
+            threshold = default_threshold if rule.get("threshold") is None else float(rule["threshold"])
+            
+            if category not in categories:
+                raise ValueError(f"Policy category {category} is not an output of the model ({', '.join(categories)})")
+            if action not in ACTIONS:
+                raise ValueError(f"Unknown policy action for {category}: {action}")
+            if not 0 <= threshold <= 1:
+                raise ValueError(f"Policy threshold for {category} must be between 0 and 1: {threshold}")
+            self.rules.append({'category': category, 'threshold': threshold, 'action': action})
+        
+        self.categories = [rule['category'] for rule in self.rules]
+        self.names = [CATEGORY_NAMES.get(category, category) for category in self.categories]
+        self.actions = [rule['action'] for rule in self.rules]
+        self.columns = np.array([categories.index(category) for category in self.categories])
+        self.thresholds = np.array([rule['threshold'] for rule in self.rules]) * 100
+        self.blocks = np.array([action == "block" for action in self.actions])
+        
+        # The pre-filter and the student only judge S3, they cannot pass messages for other categories
+        self.s3_only = self.categories == ['S3']
+    
+    @classmethod
+    def from_file(cls, path, categories, default_threshold):
+        """
+        Load a policy from a JSON file with a "rules" list of {"category", "threshold", "action"} objects
+        """
+        with open(path, 'r', encoding='utf-8') as file:
+            return cls(json.load(file)["rules"], categories, default_threshold)
+    
+    def threshold(self, category, default=None):
+        """
+        Return the threshold of a category (as a fraction), or default when the policy has no rule for it
+        """
+        if category not in self.categories:
+            return default
+        return self.rules[self.categories.index(category)]['threshold']
+    
+    def confident(self, rows, margin):
+        """
+        Return, for each row of sigmoid probabilities, whether every rule's probability is at least margin
+        (as a fraction) away from its threshold
+        """
+        import numpy as np
+        
+        percentages = np.asarray(rows, dtype=np.float64)[:, self.columns] * 100
+        return (np.abs(percentages - self.thresholds) >= margin * 100).all(axis=1)
+    
+    def evaluate(self, rows, stage="model"):
+        """
+        Apply the policy to rows of sigmoid probabilities and return one prediction per row.
+        The reported category is the first triggered block rule, then the first triggered flag rule,
+        or the first rule when none triggers.
+        """
+        import numpy as np
+        
+        percentages = np.asarray(rows, dtype=np.float64)[:, self.columns] * 100
+        triggered = percentages >= self.thresholds
+        blocking = triggered & self.blocks
+        blocked = blocking.any(axis=1)
+        primary = np.where(blocked, blocking.argmax(axis=1), np.where(triggered.any(axis=1), triggered.argmax(axis=1), 0))
+        
+        results = []
+        for i, row in enumerate(percentages):
+            results.append({
+                "should_block": bool(blocked[i]),
+                "probability": float(row[primary[i]]),
+                "category": self.names[primary[i]],
+                "stage": stage,
+                "probabilities": dict(zip(self.names, row.tolist())),
+                "triggered_categories": [
+                    {"category": self.names[j], "probability": float(row[j]), "action": self.actions[j]}
+                    for j in np.flatnonzero(triggered[i])
+                ]
+            })
+        return results
+
+class PolicyFile:
+    """
+    Policy loaded from a file and recompiled when the file changes, without reloading the model.
+    The file's modification time is checked at most every reload_seconds; a changed file that does
+    not compile is reported and the previous policy is kept.
+    """
+    def __init__(self, path, categories, default_threshold, reload_seconds=POLICY_RELOAD_SECONDS):
+        self.path = path
+        self.categories = categories
+        self.default_threshold = default_threshold
+        self.reload_seconds = reload_seconds
+        self.mtime = os.stat(path).st_mtime
+        self.policy = Policy.from_file(path, categories, default_threshold)
+        self.checked = time.monotonic()
+    
+    @classmethod
+    def from_environment(cls, categories, default_threshold):
+        """
+        Load the policy configured through POLICY_PATH
+        """
+        return cls(os.environ.get("POLICY_PATH", DEFAULT_POLICY_FILE), categories, default_threshold)
+    
+    def current(self):
+        """
+        Return the current policy, reloading the file first if it changed
+        """
+        now = time.monotonic()
+        if now - self.checked < self.reload_seconds:
+            return self.policy
+        self.checked = now
+        
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self.mtime:
+                self.policy = Policy.from_file(self.path, self.categories, self.default_threshold)
+                self.mtime = mtime
+                print(f"Reloaded policy from {self.path}: {', '.join(self.policy.categories)}")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Keeping the previous policy, {self.path} could not be loaded: {str(e)}")
+        return self.policy
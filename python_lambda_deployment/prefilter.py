@@ -0,0 +1,76 @@
+import os
+import re
+import json
+
+DEFAULT_PATTERN_FILE = os.path.join(os.path.dirname(__file__), "prefilter_patterns.json")
+
+# "block-only" only short-circuits block matches; "pass-unmatched" also passes messages without any block or
+# escalate match, so a phrasing the patterns miss is never seen by the model. Check it with benchmark_prefilter.py
+# before enabling it. "on" is kept as an alias of "block-only" for existing configurations.
+PREFILTER_MODES = ("block-only", "pass-unmatched")
+MODE_ALIASES = {"on": "block-only"}
+
+class PreFilter:
+    """
+    Keyword pre-filter that decides clear-cut messages before they reach the model.
+    All patterns are compiled into a single case-insensitive regex, so a message is scanned once:
+    - a "block" pattern match flags the message immediately (zoophilia / coprophilia terms)
+    - in "pass-unmatched" mode only, a message without any "block" or "escalate" match passes without the model
+    - everything else is left to the model
+    """
+    def __init__(self, block_patterns, escalate_patterns, mode="block-only"):
+        mode = MODE_ALIASES.get(mode, mode)
+        if mode not in PREFILTER_MODES:
+            raise ValueError(f"Unknown pre-filter mode: {mode}")
+        self.mode = mode
+        self.regex = re.compile(
+            r"\b(?:(?P<block>" + "|".join(block_patterns) + r")|(?P<escalate>" + "|".join(escalate_patterns) + r"))\b",
+            re.IGNORECASE
+        )
+    
+    @classmethod
+    def from_file(cls, path=DEFAULT_PATTERN_FILE, mode="block-only"):
+        """
+        Load the pre-filter from a JSON file with "block" and "escalate" pattern lists
+        """
+        with open(path, 'r', encoding='utf-8') as file:
+            patterns = json.load(file)
+        return cls(patterns["block"], patterns["escalate"], mode)
+    
+    @classmethod
+    def from_environment(cls):
+        """
+        Build the pre-filter configured through PREFILTER and PREFILTER_PATTERNS.
+        Returns None when PREFILTER is "off".
+        """
+        mode = os.environ.get("PREFILTER", "block-only")
+        if mode == "off":
+            return None
+        return cls.from_file(os.environ.get("PREFILTER_PATTERNS", DEFAULT_PATTERN_FILE), mode)
+    
+    def check(self, text):
+        """
+        Return a prediction for clear-cut messages, or None when the model has to decide
+        """
+        needs_model = False
+        for match in self.regex.finditer(text):
+            if match.lastgroup == "block":
+                return {
+                    "should_block": True,
+                    "probability": 100.0,
+                    "category": "sensitive_content",
+                    "stage": "prefilter",
+                    "matched_pattern": match.group(0)
+                }
+            needs_model = True
+        
+        if needs_model or self.mode != "pass-unmatched":
+            return None
+        
+        return {
+            "should_block": False,
+            "probability": 0.0,
+            "category": "sexual/minors",
+            "stage": "prefilter",
+            "matched_pattern": None
+        }
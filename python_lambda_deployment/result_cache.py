@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import unicodedata
+from collections import OrderedDict
+
+def normalize_message(text):
+    """
+    Normalize a message before hashing and scoring, so trivially different resends share one entry
+    """
+    return unicodedata.normalize("NFC", text).strip()
+
+def model_fingerprint(*paths):
+    """
+    Fingerprint the files under the given model paths from their names, sizes and modification times.
+    Any change to the model directory produces a new fingerprint and therefore new cache keys.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                stat = os.stat(file_path)
+                digest.update(f"{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+class MemoryStore:
+    """
+    In-process LRU store with per-entry expiry
+    """
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        self.entries[key] = (time.time() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def clear(self):
+        self.entries.clear()
+
+class FileStore:
+    """
+    SQLite-backed store shared by every process that points at the same file.
+    Expired and least recently used entries are evicted every evict_every inserts, so the table can exceed
+    max_entries by up to evict_every entries between two evictions.
+    """
+    def __init__(self, path, max_entries, ttl_seconds, evict_every=100):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evict_every = evict_every
+        self.inserts = 0
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, last_access REAL)"
+        )
+        # Eviction finds expired and least recently used entries through these instead of sorting the table
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at)")
+    
+    def get(self, key):
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT value FROM results WHERE key = ? AND expires_at >= ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+    
+    def set(self, key, value):
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + self.ttl_seconds, now)
+        )
+        self.inserts += 1
+        if self.inserts % self.evict_every == 0:
+            self.evict(now)
+    
+    def evict(self, now):
+        """
+        Drop expired entries, then the least recently used ones beyond max_entries
+        """
+        self.connection.execute("DELETE FROM results WHERE expires_at < ?", (now,))
+        excess = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access LIMIT ?)",
+                (excess,)
+            )
+    
+    def clear(self):
+        self.connection.execute("DELETE FROM results")
+
+class RedisStore:
+    """
+    Store backed by a Redis-compatible server, e.g. a local redis or valkey sidecar.
+    Expiry uses Redis TTLs, LRU eviction is left to the server's maxmemory-policy.
+    """
+    def __init__(self, url, ttl_seconds):
+        import redis
+        
+        self.ttl_seconds = ttl_seconds
+        self.client = redis.Redis.from_url(url)
+    
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+    
+    def set(self, key, value):
+        self.client.set(key, json.dumps(value), ex=self.ttl_seconds)
+    
+    def clear(self):
+        for key in self.client.scan_iter("moderation:*"):
+            self.client.delete(key)
+
+class ResultCache:
+    """
+    Content-hash cache of model outputs.
+    Keys combine the normalized message, the model fingerprint and max_length, so entries from another
+    model version or truncation length are never returned. An in-process LRU always sits in front of the
+    optional shared store.
+    """
+    def __init__(self, model_version, max_length, max_entries=10000, ttl_seconds=3600, shared_store=None):
+        self.model_version = model_version
+        self.max_length = max_length
+        self.memory = MemoryStore(max_entries, ttl_seconds)
+        self.shared_store = shared_store
+        self.hits = 0
+        self.misses = 0
+    
+    @classmethod
+    def from_environment(cls, model_version, max_length):
+        """
+        Build the cache configured through the RESULT_CACHE* environment variables.
+        Returns None when RESULT_CACHE is "off".
+        """
+        mode = os.environ.get("RESULT_CACHE", "memory")
+        if mode == "off":
+            return None
+        
+        max_entries = int(os.environ.get("RESULT_CACHE_SIZE", 10000))
+        ttl_seconds = int(os.environ.get("RESULT_CACHE_TTL", 3600))
+        
+        shared_store = None
+        if mode == "file":
+            shared_store = FileStore(os.environ.get("RESULT_CACHE_PATH", "/tmp/moderation_cache.sqlite"), max_entries, ttl_seconds)
+        elif mode == "redis":
+            shared_store = RedisStore(os.environ.get("REDIS_URL", "redis://localhost:6379/0"), ttl_seconds)
+        elif mode != "memory":
+            raise ValueError(f"Unknown result cache mode: {mode}")
+        
+        return cls(model_version, max_length, max_entries, ttl_seconds, shared_store)
+    
+    def key(self, text):
+        """
+        Return the cache key for an already normalized message
+        """
+        digest = hashlib.sha256(f"{self.model_version}\0{self.max_length}\0{text}".encode("utf-8")).hexdigest()
+        return f"moderation:{digest}"
+    
+    def get(self, text):
+        key = self.key(text)
+        value = self.memory.get(key)
+        if value is None and self.shared_store is not None:
+            value = self.shared_store.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+    
+    def set(self, text, value):
+        key = self.key(text)
+        self.memory.set(key, value)
+        if self.shared_store is not None:
+            self.shared_store.set(key, value)
+    
+    def clear(self):
+        self.memory.clear()
+        if self.shared_store is not None:
+            self.shared_store.clear()
+    
+    def stats(self):
+        """
+        Return the hit and miss counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.memory.entries)
+        }
@@ -0,0 +1,87 @@
+import os
+import re
+import zlib
+import math
+import unicodedata
+from collections import Counter
+
+# Number of hash buckets of the student's n-gram features
+STUDENT_BUCKETS = 2 ** 18
+
+# Character n-gram lengths, taken over the lowercased words
+CHAR_NGRAMS = (3, 4, 5)
+
+WORD_REGEX = re.compile(r"\w+")
+
+def student_features(text, buckets=STUDENT_BUCKETS):
+    """
+    Hash the word unigrams, word bigrams and character n-grams of a text into buckets.
+    Returns the bucket indices and their log-scaled, L2-normalized counts.
+    """
+    words = WORD_REGEX.findall(unicodedata.normalize("NFC", text).lower())
+    grams = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    
+    # Character n-grams catch misspellings and word variants ("daughters", "daughter's")
+    joined = f" {' '.join(words)} "
+    for n in CHAR_NGRAMS:
+        grams.extend(joined[i:i + n] for i in range(len(joined) - n + 1))
+    
+    counts = Counter(zlib.crc32(gram.encode('utf-8')) % buckets for gram in grams)
+    values = [math.log1p(count) for count in counts.values()]
+    norm = math.sqrt(sum(value * value for value in values)) or 1.0
+    return list(counts.keys()), [value / norm for value in values]
+
+class StudentModel:
+    """
+    Linear model over hashed n-gram features, distilled from the S3 logits of the full model.
+    Scoring a message is a hash of its n-grams and a sparse dot product, so it needs neither torch nor the tokenizer.
+    """
+    def __init__(self, weights, bias, buckets=STUDENT_BUCKETS):
+        self.weights = weights
+        self.bias = float(bias)
+        self.buckets = buckets
+    
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a student written by distill_student.py
+        """
+        import numpy as np
+        
+        with np.load(path) as data:
+            return cls(data["weights"], data["bias"], int(data["buckets"]))
+    
+    @classmethod
+    def from_environment(cls, model_dir):
+        """
+        Load the student configured through CASCADE and STUDENT_PATH.
+        Returns None when CASCADE is "off".
+        """
+        if os.environ.get("CASCADE", "off") == "off":
+            return None
+        return cls.from_file(os.environ.get("STUDENT_PATH", os.path.join(model_dir, "student.npz")))
+    
+    def save(self, path):
+        import numpy as np
+        
+        np.savez(path, weights=self.weights, bias=np.float32(self.bias), buckets=np.int64(self.buckets))
+    
+    def logits(self, texts):
+        """
+        Return the student's S3 logit for each text
+        """
+        import numpy as np
+        
+        logits = np.empty(len(texts), dtype=np.float64)
+        for i, text in enumerate(texts):
+            indices, values = student_features(text, self.buckets)
+            logits[i] = float(np.dot(self.weights[indices], values)) + self.bias
+        return logits
+    
+    def probabilities(self, texts):
+        """
+        Return the student's S3 probability (as a fraction) for each text
+        """
+        import numpy as np
+        
+        return 1 / (1 + np.exp(-self.logits(texts)))
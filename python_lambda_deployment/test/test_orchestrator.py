@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark_orchestrator import StubServer, build_orchestrator
+from orchestrator import HTTPModelClient, NotificationQueue, notify_flush_budget
+
+# Markers in a message that script the stub dependencies' answers, see StubServer
+# (name, message, expected is_flagged, notifications handler.ts sends)
+SCENARIOS = [
+    ("regex", "they talk about zoophilia", True, 1),
+    ("external_certain", "certain @omax", True, 2),
+    ("external_pass", "a harmless message", False, 0),
+    ("both_flag", "both agree @omin @s3", True, 3),
+    ("external_only", "only external @omin", False, 1),
+    ("underage_model", "a child @s3", True, 2),
+    ("model_below", "a child @s3low", False, 1),
+    ("model_down", "model is down @omin @merr", True, 3),
+    ("external_down", "a child @oerr", True, 2),
+    ("both_down", "nothing answers @oerr @merr", False, 0),
+    ("external_down_adult", "adult content @oerr @s3", False, 1)
+]
+
+def start_stubs(latencies, slow_every=0, slow_factor=10):
+    stubs = StubServer(latencies, slow_every, slow_factor)
+    threading.Thread(target=stubs.serve_forever, daemon=True).start()
+    return stubs
+
+@pytest.fixture(scope="module")
+def stubs():
+    stubs = start_stubs({"/model": 0.01, "/moderations": 0.02, "/slack": 0.01})
+    yield stubs
+    stubs.shutdown()
+
+async def moderate(stubs, message, hedge_delay=0):
+    """
+    Moderate one message against the stubs and wait for its notifications.
+    Returns the response body, the seconds moderate took and the notifications sent.
+    """
+    async with httpx.AsyncClient() as http:
+        orchestrator = build_orchestrator(http, stubs, hedge_delay)
+        start_time = time.perf_counter()
+        body = await orchestrator.moderate(message)
+        elapsed = time.perf_counter() - start_time
+        await orchestrator.notifications.flush(5)
+        await orchestrator.notifications.stop()
+        return body, elapsed, orchestrator.notifications.sent
+
+@pytest.mark.parametrize("name, message, expected, notifications", SCENARIOS, ids=[scenario[0] for scenario in SCENARIOS])
+def test_decisions_match_handler(stubs, name, message, expected, notifications):
+    body, _, sent = asyncio.run(moderate(stubs, message))
+    assert body["is_flagged"] == expected
+    assert sent == notifications
+
+def test_external_decision_does_not_wait_for_model():
+    stubs = start_stubs({"/model": 1.0, "/moderations": 0.02, "/slack": 0.01})
+    try:
+        body, elapsed, _ = asyncio.run(moderate(stubs, "certain @omax"))
+    finally:
+        stubs.shutdown()
+    assert body["is_flagged"]
+    assert elapsed < 0.5
+
+def test_hedged_request_cuts_slow_answer():
+    # Every second model request takes 0.5s; the first one sent is the second the stub sees
+    stubs = start_stubs({"/model": 0.02, "/moderations": 0.02, "/slack": 0.01}, slow_every=2, slow_factor=25)
+    stubs.counts["/model"] = 1
+    
+    async def check(hedge_delay):
+        async with httpx.AsyncClient() as http:
+            client = HTTPModelClient(http, stubs.url("/model"), "token", hedge_delay=hedge_delay)
+            start_time = time.perf_counter()
+            result = await client.check("a child @s3")
+            return result, time.perf_counter() - start_time, client.requests
+    
+    try:
+        result, elapsed, requests = asyncio.run(check(0.05))
+    finally:
+        stubs.shutdown()
+    assert result["flagged"]
+    assert requests == 2
+    assert elapsed < 0.3
+
+def test_flush_sends_queued_notifications(stubs):
+    async def notify_and_flush():
+        async with httpx.AsyncClient() as http:
+            notifications = NotificationQueue(http, stubs.url("/slack"))
+            notifications.start()
+            for i in range(3):
+                notifications.notify(f"Notification {i}", {"Message": "details"})
+            await notifications.flush(5)
+            await notifications.stop()
+            return notifications
+    
+    notifications = asyncio.run(notify_and_flush())
+    assert notifications.sent == 3
+    assert notifications.deferred == 0
+
+def test_flush_counts_deferred_notifications():
+    stubs = start_stubs({"/model": 0.01, "/moderations": 0.01, "/slack": 0.5})
+    
+    async def notify_and_flush():
+        async with httpx.AsyncClient() as http:
+            notifications = NotificationQueue(http, stubs.url("/slack"), workers=1)
+            notifications.start()
+            for i in range(3):
+                notifications.notify(f"Notification {i}", {"Message": "details"})
+            await notifications.flush(0.05)
+            await notifications.stop()
+            return notifications
+    
+    try:
+        notifications = asyncio.run(notify_and_flush())
+    finally:
+        stubs.shutdown()
+    assert notifications.sent == 0
+    assert notifications.deferred == 2
+
+def test_flush_budget_leaves_invocation_margin():
+    class Context:
+        def __init__(self, remaining_ms):
+            self.remaining_ms = remaining_ms
+        
+        def get_remaining_time_in_millis(self):
+            return self.remaining_ms
+    
+    assert notify_flush_budget(None) == 1
+    assert notify_flush_budget(Context(60000)) == 1
+    assert notify_flush_budget(Context(600)) == pytest.approx(0.4)
+    assert notify_flush_budget(Context(100)) == 0
+
+@pytest.mark.parametrize("body", ["[1, 2]", "\"a message\"", "42"])
+def test_non_object_body_is_rejected(stubs, body):
+    async def handle():
+        async with httpx.AsyncClient() as http:
+            orchestrator = build_orchestrator(http, stubs, 0)
+            response = await orchestrator.handle_event({"body": body})
+            await orchestrator.notifications.stop()
+            return response
+    
+    response = asyncio.run(handle())
+    assert response["statusCode"] == 400
+    assert not json.loads(response["body"])["is_flagged"]
@@ -0,0 +1,141 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+# Number of tokenized messages kept in memory, configurable through TOKEN_CACHE_SIZE
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+
+class TokenCache:
+    """
+    Tokenization shared by koala.py, fine_tune_koala.py and the Lambda.
+    Messages are tokenized together in one call to the Rust fast tokenizer, without padding,
+    and the token IDs of each message are kept in an LRU keyed by the message hash, as int32
+    arrays rather than lists of Python ints. Batches are padded to their own longest message, not to max_length,
+    rounded up to a multiple of pad_to_multiple_of tokens.
+    """
+    def __init__(self, tokenizer, max_length, max_entries=TOKEN_CACHE_SIZE, pad_to_multiple_of=1):
+        if not tokenizer.is_fast:
+            raise ValueError(f"{type(tokenizer).__name__} is not a fast tokenizer, install the tokenizers package")
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.max_entries = max_entries
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    @classmethod
+    def from_pretrained(cls, tokenizer_path, max_length, max_entries=TOKEN_CACHE_SIZE):
+        from transformers import AutoTokenizer
+        
+        return cls(AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True), max_length, max_entries)
+    
+    def encode(self, texts):
+        """
+        Return the unpadded encoding of each text, a dict of token arrays, in input order
+        """
+        import numpy as np
+        
+        def tokenize(unique_texts):
+            batch = self.tokenizer(unique_texts, truncation=True, max_length=self.max_length)
+            return [{name: np.asarray(values[j], dtype=np.int32) for name, values in batch.items()} for j in range(len(unique_texts))]
+        
+        return self.cached([hashlib.sha1(text.encode('utf-8')).digest() for text in texts], texts, tokenize)
+    
+    def windows(self, texts, window_tokens, overlap):
+        """
+        Return the overlapping windows of window_tokens tokens of each text, consecutive windows sharing overlap
+        tokens, as a list of encodings per text. Cached like encode, so counting the windows of a message and
+        scoring them tokenize it once.
+        """
+        import numpy as np
+        
+        def tokenize(unique_texts):
+            batch = self.tokenizer(
+                unique_texts,
+                truncation=True,
+                max_length=window_tokens,
+                stride=overlap,
+                return_overflowing_tokens=True
+            )
+            owners = batch.pop("overflow_to_sample_mapping")
+            windows = [[] for _ in unique_texts]
+            for row, owner in enumerate(owners):
+                windows[owner].append({name: np.asarray(values[row], dtype=np.int32) for name, values in batch.items()})
+            return windows
+        
+        return self.cached([(window_tokens, overlap, hashlib.sha1(text.encode('utf-8')).digest()) for text in texts], texts, tokenize)
+    
+    def cached(self, keys, texts, tokenize):
+        """
+        Look up the entries of texts by key, tokenizing the missing texts once each with tokenize
+        """
+        encodings = [self.entries.get(key) for key in keys]
+        
+        missing = {}
+        for i, (key, encoding) in enumerate(zip(keys, encodings)):
+            if encoding is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                self.entries.move_to_end(key)
+        self.hits += len(texts) - sum(len(rows) for rows in missing.values())
+        self.misses += len(missing)
+        
+        if missing:
+            tokenized = tokenize([texts[rows[0]] for rows in missing.values()])
+            for encoding, (key, rows) in zip(tokenized, missing.items()):
+                for i in rows:
+                    encodings[i] = encoding
+                if self.max_entries > 0:
+                    self.entries[key] = encoding
+            
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        
+        return encodings
+    
+    def pad(self, encodings, return_tensors="pt"):
+        """
+        Pad encodings, a list of dicts or a dict of lists, to the longest one and return them as a batch of
+        "pt" tensors or "np" arrays. Padding in NumPy avoids the per-token Python loop of tokenizer.pad.
+        """
+        import numpy as np
+        
+        if isinstance(encodings, dict):
+            encodings = [{name: values[i] for name, values in encodings.items()} for i in range(len(encodings["input_ids"]))]
+        
+        pad_values = {
+            "input_ids": self.tokenizer.pad_token_id or 0,
+            "token_type_ids": self.tokenizer.pad_token_type_id,
+            "attention_mask": 0
+        }
+        longest = max(len(encoding["input_ids"]) for encoding in encodings)
+        longest = -(-longest // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        batch = {}
+        for name in encodings[0]:
+            array = np.full((len(encodings), longest), pad_values.get(name, 0), dtype=np.int64)
+            for row, encoding in enumerate(encodings):
+                values = encoding[name]
+                if self.tokenizer.padding_side == "left":
+                    array[row, longest - len(values):] = values
+                else:
+                    array[row, :len(values)] = values
+            batch[name] = array
+        
+        if return_tensors == "pt":
+            import torch
+            
+            return {name: torch.from_numpy(array) for name, array in batch.items()}
+        return batch
+    
+    def __call__(self, texts, return_tensors="pt"):
+        return self.pad(self.encode(texts), return_tensors)
+    
+    def lengths(self, texts):
+        """
+        Count the tokens of each text after truncation
+        """
+        return [len(encoding["input_ids"]) for encoding in self.encode(texts)]
+    
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
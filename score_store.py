@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# Same order as fine_tune_koala.CATEGORIES
+CATEGORIES = ['S', 'H', 'V', 'HR', 'SH', 'S3', 'H2', 'V2', 'OK']
+
+# Default location of the score store
+SCORE_STORE_DIR = "scores"
+
+def message_hash(message):
+    """
+    Return the 20-byte SHA-1 digest identifying a message in the score store
+    """
+    return hashlib.sha1(message.encode('utf-8')).digest()
+
+def model_key(model_dir):
+    """
+    Identify a model directory by its name and a fingerprint of its files,
+    so retraining into the same directory does not reuse old scores
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(model_dir):
+        dirs.sort()
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return f"{os.path.basename(os.path.normpath(model_dir))}_{digest.hexdigest()[:12]}"
+
+class ScoreStore:
+    """
+    Per-message logits for every category, stored as .npy files per model directory:
+    hashes.npy holds the sorted message hashes and logits.npy the matching float32 logits rows.
+    flush_segment writes buffered rows as an extra sorted segment (hashes.N.npy / logits.N.npy) without
+    reading the rest of the store, and flush merges every segment back into hashes.npy / logits.npy.
+    All files are memory-mapped when read, so looking up a whole test set does not load the model.
+    """
+    def __init__(self, model_dir, root=SCORE_STORE_DIR):
+        self.path = os.path.join(root, model_key(model_dir))
+        self.hashes_path = os.path.join(self.path, "hashes.npy")
+        self.logits_path = os.path.join(self.path, "logits.npy")
+        os.makedirs(self.path, exist_ok=True)
+        
+        # Rows added with flush=False, written on the next flush
+        self.pending_hashes = []
+        self.pending_logits = []
+        
+        metadata_path = os.path.join(self.path, "metadata.json")
+        if not os.path.exists(metadata_path):
+            with open(metadata_path, 'w', encoding='utf-8') as file:
+                json.dump({'model_dir': os.path.abspath(model_dir), 'categories': CATEGORIES}, file, indent=4)
+        
+        self.load()
+    
+    def segment_numbers(self):
+        return sorted(int(name.split(".")[1]) for name in os.listdir(self.path) if name.startswith("hashes.") and name.count(".") == 2)
+    
+    def load(self):
+        # The main files first, then the segments in the order they were written
+        self.segments = []
+        paths = [(self.hashes_path, self.logits_path)] + [
+            (os.path.join(self.path, f"hashes.{number}.npy"), os.path.join(self.path, f"logits.{number}.npy"))
+            for number in self.segment_numbers()
+        ]
+        for hashes_path, logits_path in paths:
+            if os.path.exists(hashes_path):
+                self.segments.append((np.load(hashes_path, mmap_mode='r'), np.load(logits_path, mmap_mode='r')))
+    
+    def __len__(self):
+        return sum(len(hashes) for hashes, _ in self.segments)
+    
+    @property
+    def pending_rows(self):
+        return sum(len(hashes) for hashes in self.pending_hashes)
+    
+    def lookup(self, hashes):
+        """
+        Return the stored logits for each hash and a mask of the hashes that were found.
+        Rows of missing hashes are NaN.
+        """
+        hashes = np.asarray(hashes, dtype='S20')
+        columns = self.segments[0][1].shape[1] if self.segments else len(CATEGORIES)
+        logits = np.full((len(hashes), columns), np.nan, dtype=np.float32)
+        found = np.zeros(len(hashes), dtype=bool)
+        for segment_hashes, segment_logits in self.segments:
+            if not len(segment_hashes):
+                continue
+            positions = np.minimum(np.searchsorted(segment_hashes, hashes), len(segment_hashes) - 1)
+            hits = ~found & (segment_hashes[positions] == hashes)
+            logits[hits] = segment_logits[positions[hits]]
+            found |= hits
+        return logits, found
+    
+    def add(self, hashes, logits, flush=True):
+        """
+        Add newly scored messages. With flush=False they are buffered until the next flush,
+        so a streaming run does not rewrite the store for every chunk.
+        """
+        self.pending_hashes.append(np.asarray(hashes, dtype='S20'))
+        self.pending_logits.append(np.asarray(logits, dtype=np.float32))
+        if flush:
+            self.flush()
+    
+    def take_pending(self, arrays=()):
+        """
+        Return the buffered rows together with the given (hashes, logits) arrays, deduplicated and sorted by hash
+        """
+        all_hashes = np.concatenate([np.asarray(hashes) for hashes, _ in arrays] + self.pending_hashes)
+        all_logits = np.concatenate([np.asarray(logits) for _, logits in arrays] + self.pending_logits)
+        self.pending_hashes = []
+        self.pending_logits = []
+        all_hashes, first = np.unique(all_hashes, return_index=True)
+        return all_hashes, all_logits[first]
+    
+    def write(self, hashes_path, logits_path, hashes, logits):
+        # Write to temporary files first so an interrupted run never leaves a half-written store.
+        # The logits go first: a hashes file is only present once its logits are.
+        for path, array in ((logits_path, logits), (hashes_path, hashes)):
+            with open(path + ".tmp", 'wb') as file:
+                np.save(file, array)
+            os.replace(path + ".tmp", path)
+    
+    def flush_segment(self):
+        """
+        Write the buffered rows as a new segment. Only the buffered rows are held in memory,
+        so a streaming run can flush every few chunks whatever the size of the store.
+        """
+        if not self.pending_hashes:
+            return
+        hashes, logits = self.take_pending()
+        number = max(self.segment_numbers(), default=0) + 1
+        self.write(os.path.join(self.path, f"hashes.{number}.npy"), os.path.join(self.path, f"logits.{number}.npy"), hashes, logits)
+        self.load()
+    
+    def flush(self):
+        """
+        Merge the buffered rows and every segment into the main files, keeping them sorted by hash
+        """
+        numbers = self.segment_numbers()
+        if not self.pending_hashes and not numbers:
+            return
+        all_hashes, all_logits = self.take_pending(self.segments)
+        self.segments = []
+        self.write(self.hashes_path, self.logits_path, all_hashes, all_logits)
+        for number in numbers:
+            os.remove(os.path.join(self.path, f"hashes.{number}.npy"))
+            os.remove(os.path.join(self.path, f"logits.{number}.npy"))
+        self.load()
@@ -0,0 +1,115 @@
+import os
+import csv
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import koala
+
+# Rows sent to a worker at a time; small enough to stream results back, large enough to fill batches
+SHARD_SIZE = 256
+
+def init_worker(num_threads):
+    """
+    Load the model once per worker process, with its own share of the CPU cores
+    """
+    import torch
+    
+    torch.set_num_threads(num_threads)
+    koala.get_model()
+
+def score_shard(shard):
+    """
+    Score one shard in a worker process and return it with its start row
+    """
+    start, messages, batch_size = shard
+    return start, koala.score_messages(messages, batch_size, report=False)
+
+def threads_per_worker(workers):
+    """
+    Split the available CPU cores evenly between the worker processes
+    """
+    return max(1, (os.cpu_count() or 1) // workers)
+
+def create_pool(workers, num_threads=None):
+    """
+    Start worker processes that each load the model once; reuse the pool for every call that scores messages
+    """
+    context = multiprocessing.get_context("spawn")
+    return context.Pool(workers, initializer=init_worker, initargs=(num_threads or threads_per_worker(workers),))
+
+def score_messages_sharded(messages, workers, batch_size=koala.EVAL_BATCH_SIZE, num_threads=None, pool=None, report=True):
+    """
+    Score messages across a pool of worker processes and return the logits in input order.
+    Shards are streamed back as they finish and written to their original rows.
+    """
+    shards = [(start, messages[start:start + SHARD_SIZE], batch_size) for start in range(0, len(messages), SHARD_SIZE)]
+    own_pool = pool is None
+    if own_pool:
+        pool = create_pool(workers, num_threads)
+    
+    start_time = time.perf_counter()
+    logits = None
+    try:
+        for start, shard_logits in pool.imap_unordered(score_shard, shards):
+            if logits is None:
+                logits = np.zeros((len(messages), shard_logits.shape[1]), dtype=np.float32)
+            logits[start:start + len(shard_logits)] = shard_logits
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+    
+    elapsed = time.perf_counter() - start_time
+    if report:
+        print(f"Scored {len(messages)} messages in {elapsed:.2f}s "
+              f"({len(messages) / elapsed if elapsed > 0 else 0:.1f} rows/sec, {workers} workers, batch size {batch_size})")
+    return logits
+
+def load_messages(file_path):
+    """
+    Load the non-empty messages from a ;-delimited test cases CSV
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        reader = csv.DictReader(file, delimiter=';')
+        return [row["message"].strip() for row in reader if row.get("message") and row["message"].strip()]
+
+def benchmark_scaling(file_path, max_workers, batch_size=koala.EVAL_BATCH_SIZE):
+    """
+    Report scoring throughput for 1..max_workers worker processes.
+    Each pool is warmed up first so model loading is not counted.
+    """
+    messages = load_messages(file_path)
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    
+    for workers in range(1, max_workers + 1):
+        num_threads = threads_per_worker(workers)
+        with context.Pool(workers, initializer=init_worker, initargs=(num_threads,)) as pool:
+            # Warm up every worker with a tiny shard before timing
+            pool.map(score_shard, [(0, messages[:1], batch_size)] * workers, chunksize=1)
+            
+            start_time = time.perf_counter()
+            score_messages_sharded(messages, workers, batch_size, pool=pool)
+            elapsed = time.perf_counter() - start_time
+        rows.append((workers, num_threads, elapsed, len(messages) / elapsed))
+    
+    print(f"\nScaling on {len(messages)} messages ({os.cpu_count()} CPUs):")
+    print(f"|{'Workers':>8}|{'Threads':>8}|{'Seconds':>9}|{'Rows/sec':>10}|{'Speedup':>8}|")
+    for workers, num_threads, elapsed, throughput in rows:
+        print(f"|{workers:>8}|{num_threads:>8}|{elapsed:>9.2f}|{throughput:>10.1f}|{throughput / rows[0][3]:>7.2f}x|")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate test cases with the model sharded across worker processes")
+    parser.add_argument("file", nargs="?", default="test_cases.csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=koala.EVAL_BATCH_SIZE)
+    parser.add_argument("--benchmark", action="store_true", help="Report throughput for 1..workers worker processes")
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        benchmark_scaling(args.file, args.workers, args.batch_size)
+    else:
+        results, category_totals = koala.evaluate_test_cases(args.file, batch_size=args.batch_size, workers=args.workers)
+        koala.print_results(results, category_totals)